@@ -19,8 +19,9 @@ Functions:
 
 from __future__ import annotations
 
-from typing import TYPE_CHECKING, Any, Optional
+from typing import TYPE_CHECKING, Any, Optional, Union
 
+from .body_spool import LazyBody, StoredBody
 from .http_types import Cookie, parse_cookie
 
 if TYPE_CHECKING:
@@ -93,6 +94,23 @@ class HttpAction(BrowserAction):
         if request_data is not None:
             self.update_info(request_data)
 
+    @property
+    def body(self) -> Optional[bytes]:
+        # The body is stored in the instance's dict, so it's compared and
+        # printed like the other attributes. A LazyBody is decoded when read.
+        # A StoredBody is decompressed at each read, and isn't kept decoded.
+        body: Union[bytes, LazyBody, StoredBody, None] = self.__dict__["body"]
+        if isinstance(body, StoredBody):
+            return body.read()
+        if isinstance(body, LazyBody):
+            body = body.decode()
+            self.__dict__["body"] = body
+        return body
+
+    @body.setter
+    def body(self, body: Union[bytes, LazyBody, StoredBody, None]) -> None:
+        self.__dict__["body"] = body
+
     def update_info(self, data: RequestInfo) -> None:
         if getattr(data, "headers", None):
             for key, val in data.headers.items():
@@ -117,14 +135,15 @@ class HttpAction(BrowserAction):
         if hasattr(data, "status_code") and data.status_code is not None:
             self.status = data.status_code
 
-    def set_body(self, body: bytes) -> None:
+    def set_body(self, body: Union[bytes, LazyBody, StoredBody]) -> None:
         self.body = body
 
     def shallow_copy_from_action(self, action: HttpAction) -> None:
         self.method = action.method
         self.headers = action.headers
         self.url = action.url
-        self.body = action.body
+        # Copies a lazy body as it is, without reading it
+        self.body = action.__dict__["body"]
         self.cookies = action.cookies
         self.status = action.status
 
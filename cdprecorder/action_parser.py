@@ -0,0 +1,360 @@
+"""
+This module turns recorded communications into actions, as a stream.
+
+A communication holds the CDP events of one request id: the request, its
+redirects, the extra info events, and the responses with their bodies. The
+events are read in order, and a RequestAction and its ResponseAction are
+yielded as soon as the pair is complete, so the actions of a whole
+recording never have to be built in one list. Communications read lazily,
+like those of `CaptureLogReader.recover_communications`, are only kept
+while they're parsed.
+
+The communications don't depend on each other, so they can also be parsed
+in a pool of processes. Only their events are sent to the workers: the
+bodies, which can be large, or in temporary files, or in a BodyStore, stay
+in this process and are put into the parsed actions afterwards.
+
+Classes:
+    - CommunicationParseError: Raised when the events of a communication
+    are in an order that can't be parsed.
+
+Functions:
+    - extract_redirects: Inserts the responses that are only carried by
+    the redirected requests.
+    - parse_communication: Yields the actions of a communication.
+    - iter_communication_actions: Yields the actions of communications, in
+    this process or in a pool of processes.
+"""
+
+from __future__ import annotations
+
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import TYPE_CHECKING, Any, Iterable, Iterator, NamedTuple, Optional, Union
+
+from pycdp import cdp
+
+from . import logger
+from .action import (
+    BrowserAction,
+    HttpAction,
+    InputAction,
+    RequestAction,
+    ResponseAction,
+)
+from .body_spool import action_body
+from .raw_events import materialize
+
+if TYPE_CHECKING:
+    from .recorder import HttpCommunication
+
+# Communications sent to a worker process at a time
+DEFAULT_PARSE_CHUNK_SIZE = 64
+
+
+class CommunicationParseError(Exception):
+    pass
+
+
+_NO_BODY = object()
+
+
+class _BodySlot(NamedTuple):
+    """Takes the place of a response body in a worker process. The body is
+    put into the action when it's back in this process."""
+
+    position: int
+
+
+# The events of a communication, and a slot for each of its bodies
+_ParseJob = tuple[list[Any], list[Optional[_BodySlot]]]
+
+
+def extract_redirects(events: Iterable[Any]) -> Iterator[Any]:
+    """Yields the events of a communication, with a ResponseReceived before
+    each redirected RequestWillBeSent, made from its redirect response. The
+    extra info events of a redirect are yielded before the events of the next
+    request."""
+    pending: list[Any] = []
+    wait_response_extra = False
+    wait_request_extra = False
+    wait_extra = False
+    for evt in events:
+        if wait_extra:
+            if (
+                isinstance(evt, cdp.network.RequestWillBeSentExtraInfo)
+                and not wait_request_extra
+                or isinstance(evt, cdp.network.ResponseReceivedExtraInfo)
+                and not wait_response_extra
+            ):
+                wait_extra = False
+                yield from pending
+                pending = []
+
+            if isinstance(evt, cdp.network.RequestWillBeSentExtraInfo):
+                wait_request_extra = False
+            elif isinstance(evt, cdp.network.ResponseReceivedExtraInfo):
+                wait_response_extra = False
+            wait_extra = wait_response_extra or wait_request_extra
+
+            yield evt
+            continue
+
+        yield from pending
+        pending = [evt]
+        if not isinstance(evt, cdp.network.RequestWillBeSent):
+            continue
+
+        if not evt.redirect_response:
+            yield from pending
+            pending = []
+            wait_extra = False
+            continue
+
+        if evt.redirect_has_extra_info:
+            wait_response_extra = True
+            wait_request_extra = True
+            wait_extra = True
+
+        yield cdp.network.ResponseReceived(
+            request_id=evt.request_id,
+            loader_id=evt.loader_id,
+            timestamp=evt.timestamp,
+            type_=evt.type_,  # type: ignore[arg-type]
+            response=evt.redirect_response,
+            has_extra_info=evt.redirect_has_extra_info,
+            frame_id=evt.frame_id,
+        )
+
+    yield from pending
+
+
+def parse_communication(comm: Union[HttpCommunication, BrowserAction]) -> Iterator[BrowserAction]:
+    """Yields the actions of a communication: each request, followed by its
+    response if it has one. A request is yielded once its response is
+    complete, with `has_response` set. The actions recorded in the page are
+    yielded as they are, and ignored communications yield nothing."""
+    logger.debug("Comm: %r", comm)
+
+    if isinstance(comm, BrowserAction):
+        yield comm
+        return
+
+    if comm.ignored:
+        return
+
+    yield from _parse_events(comm.events, map(action_body, comm.response_bodies))
+
+
+def _parse_events(events: Iterable[Any], response_bodies: Iterable[Any]) -> Iterator[BrowserAction]:
+    """Yields the actions of the events of a communication. `response_bodies`
+    gives the body of each LoadingFinished, in order."""
+    bodies = iter(response_bodies)
+    curr_request: Optional[RequestAction] = None
+    request_extra: Optional[RequestAction] = None
+    curr_response: Optional[ResponseAction] = None
+    response_extra: Optional[ResponseAction] = None
+    for evt in extract_redirects(map(materialize, events)):
+        if isinstance(evt, cdp.network.RequestWillBeSent):
+            if curr_request is not None:
+                if curr_response is not None:
+                    curr_request.has_response = True
+                yield curr_request
+                if curr_response is not None:
+                    yield curr_response
+
+                curr_request = None
+                request_extra = None
+                curr_response = None
+
+            curr_request = RequestAction()
+            curr_request.update_info(evt.request)
+            if evt.request.has_post_data and evt.request.post_data:
+                # TODO: Check if bytes in other entry
+                curr_request.set_body(evt.request.post_data.encode())
+
+            if request_extra is not None:
+                curr_request.merge(request_extra)
+
+        elif isinstance(evt, cdp.network.RequestWillBeSentExtraInfo):
+            if request_extra is not None:
+                if curr_request is None or curr_response is None:
+                    raise CommunicationParseError(f"Unexpected {evt!r:.100}")
+                # The extra info of the next request
+                curr_request.has_response = True
+                yield curr_request
+                yield curr_response
+                curr_request = None
+                curr_response = None
+
+            request_extra = RequestAction()
+            request_extra.update_info(evt)
+
+            if curr_request is not None:
+                curr_request.merge(request_extra)
+
+        elif isinstance(evt, cdp.network.ResponseReceived):
+            if curr_response is not None:
+                raise CommunicationParseError(f"Unexpected {evt!r:.100}")
+            curr_response = ResponseAction(evt.response)
+
+            if response_extra is not None:
+                # Always merge response_extra over curr_response, not the other way
+                curr_response.merge(response_extra)
+                response_extra = None
+
+        elif isinstance(evt, cdp.network.ResponseReceivedExtraInfo):
+            if curr_response is not None:
+                # Always merge response_extra over curr_response, not the other way
+                curr_response.merge(ResponseAction(evt))
+            elif response_extra is None:
+                response_extra = ResponseAction(evt)
+            else:
+                raise CommunicationParseError(f"Unexpected {evt!r:.100}")
+
+        elif isinstance(evt, cdp.network.LoadingFinished):
+            # Manually inserted
+            response_body: Any = next(bodies, _NO_BODY)
+            if response_body is _NO_BODY:
+                raise CommunicationParseError(f"No body slot for {evt!r:.100}")
+            if response_body is not None:
+                if curr_response:
+                    curr_response.set_body(response_body)
+                elif response_extra:
+                    response_extra.set_body(response_body)
+                else:
+                    raise CommunicationParseError(f"No response for the body of {evt!r:.100}")
+
+            if curr_request is not None:
+                if curr_response or response_extra:
+                    curr_request.has_response = True
+                yield curr_request
+                curr_request = None
+            if curr_response is not None:
+                yield curr_response
+                curr_response = None
+            elif response_extra is not None:
+                yield response_extra
+                response_extra = None
+
+    if curr_request is not None:
+        if curr_response is not None:
+            curr_request.has_response = True
+        curr_request.merge(request_extra)
+        yield curr_request
+    if curr_response is not None:
+        # Always merge response_extra over curr_response, not the other way
+        curr_response.merge(response_extra)
+        yield curr_response
+
+
+def _release(comm: Union[HttpCommunication, BrowserAction]) -> None:
+    if not isinstance(comm, BrowserAction):
+        comm.events = []
+        comm.response_bodies = []
+
+
+def _parse_job(comm: Union[HttpCommunication, BrowserAction]) -> Optional[_ParseJob]:
+    """Returns what a worker needs to parse a communication, or None if it's
+    handled in this process."""
+    if isinstance(comm, BrowserAction) or comm.ignored:
+        return None
+    slots = [None if body is None else _BodySlot(position) for position, body in enumerate(comm.response_bodies)]
+    return list(comm.events), slots
+
+
+def _parse_jobs(jobs: list[Optional[_ParseJob]]) -> list[list[BrowserAction]]:
+    """Runs in a worker process."""
+    return [list(_parse_events(*job)) if job is not None else [] for job in jobs]
+
+
+def _merge_parsed(
+    comm: Union[HttpCommunication, BrowserAction], actions: list[BrowserAction]
+) -> Iterator[BrowserAction]:
+    """Yields the actions parsed in a worker, with the bodies of `comm`."""
+    if isinstance(comm, BrowserAction):
+        yield comm
+        return
+
+    for action in actions:
+        if isinstance(action, HttpAction):
+            slot = action.__dict__["body"]
+            if isinstance(slot, _BodySlot):
+                action.body = action_body(comm.response_bodies[slot.position])
+        yield action
+
+
+def _iter_chunks(
+    communications: Iterable[Union[HttpCommunication, InputAction]], chunk_size: int
+) -> Iterator[list[Union[HttpCommunication, InputAction]]]:
+    chunk: list[Union[HttpCommunication, InputAction]] = []
+    for comm in communications:
+        chunk.append(comm)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _iter_actions_in_processes(
+    communications: Iterable[Union[HttpCommunication, InputAction]], processes: int, chunk_size: int, release: bool
+) -> Iterator[BrowserAction]:
+    # A few chunks per worker are in flight, so the communications are still
+    # read as the actions are consumed
+    max_pending = 2 * processes
+    pending: deque[tuple[list[Union[HttpCommunication, InputAction]], Future[list[list[BrowserAction]]]]] = deque()
+    chunks = _iter_chunks(communications, chunk_size)
+
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        try:
+            while True:
+                for chunk in chunks:
+                    logger.debug("Parsing %d communications in a worker", len(chunk))
+                    pending.append((chunk, pool.submit(_parse_jobs, [_parse_job(comm) for comm in chunk])))
+                    if len(pending) >= max_pending:
+                        break
+                if not pending:
+                    return
+
+                # The chunks are merged in the order they were read
+                chunk, future = pending.popleft()
+                for comm, actions in zip(chunk, future.result()):
+                    yield from _merge_parsed(comm, actions)
+                    if release:
+                        _release(comm)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+def iter_communication_actions(
+    communications: Iterable[Union[HttpCommunication, InputAction]],
+    release: bool = False,
+    processes: Optional[int] = None,
+    chunk_size: int = DEFAULT_PARSE_CHUNK_SIZE,
+) -> Iterator[BrowserAction]:
+    """Yields the actions of the communications, in order. The communications
+    are read one at a time, as the actions are consumed.
+
+    Args:
+        communications: The communications, or the actions recorded in the
+            page, in the order they happened.
+        release: Empties the events and the bodies of each communication once
+            its actions are yielded, for a caller that still holds the
+            communications in a list. The bodies belong to the actions then.
+        processes: If given, the communications are parsed in this many
+            worker processes, `chunk_size` communications at a time. 0 uses
+            a process per CPU. The actions are in the same order as without
+            workers, so the ids numbered from them are the same.
+        chunk_size: Communications sent to a worker at a time.
+    """
+    if processes is not None:
+        yield from _iter_actions_in_processes(communications, processes or os.cpu_count() or 1, chunk_size, release)
+        return
+
+    for comm in communications:
+        yield from parse_communication(comm)
+        if release:
+            _release(comm)
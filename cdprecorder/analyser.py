@@ -2,7 +2,7 @@ import json
 import re
 import urllib.parse
 from dataclasses import dataclass, field
-from typing import Optional, Union, TypeVar, TYPE_CHECKING
+from typing import Iterable, Optional, Union, TypeVar, TYPE_CHECKING
 
 import bs4
 from bs4 import BeautifulSoup
@@ -767,31 +767,57 @@ def search_for_query_string(actions: list, query_list: list[tuple[str, str]]) ->
     return []
 
 
+def analyse_request_action(action: RequestAction, previous_actions: list[BrowserAction]) -> None:
+    """Finds the sources of the request's values in the actions before it,
+    and adds the targets to the request."""
+    for key, value in action.headers.items():
+        targets = search_for_header(previous_actions, key, value)
+        action.targets.extend(targets)
+
+    for cookie in action.cookies:
+        targets = search_for_cookie(previous_actions, cookie)
+        action.targets.extend(targets)
+
+    if action.body:
+        body_bytes = action.body
+        body = body_bytes.decode("utf8")
+        try:
+            json.loads(body)
+            schema = JSONSchema(body)
+            targets = search_for_json(previous_actions, schema)
+            action.targets.extend(targets)
+        except json.JSONDecodeError:
+            pass
+
+        try:
+            query_list = urllib.parse.parse_qsl(body, strict_parsing=True, keep_blank_values=True)
+        except ValueError:
+            return
+        targets = search_for_query_string(previous_actions, query_list)
+        action.targets.extend(targets)
+
+
 def analyse_actions(actions: list[BrowserAction]) -> None:
     for action_idx, action in enumerate(actions):
         if isinstance(action, RequestAction):
-            for key, value in action.headers.items():
-                targets = search_for_header(actions[:action_idx], key, value)
-                action.targets.extend(targets)
-
-            for cookie in action.cookies:
-                targets = search_for_cookie(actions[:action_idx], cookie)
-                action.targets.extend(targets)
-
-            if action.body:
-                body_bytes = action.body
-                body = body_bytes.decode("utf8")
-                try:
-                    json.loads(body)
-                    schema = JSONSchema(body)
-                    targets = search_for_json(actions[:action_idx], schema)
-                    action.targets.extend(targets)
-                except json.JSONDecodeError:
-                    pass
-
-                # try:
-                query_list = urllib.parse.parse_qsl(body, strict_parsing=True, keep_blank_values=True)
-                targets = search_for_query_string(actions[:action_idx], query_list)
-                action.targets.extend(targets)
-                # except ValueError:
-                #    pass
+            analyse_request_action(action, actions[:action_idx])
+
+
+class IncrementalAnalyser:
+    """Analyses the actions while they are recorded. Each new request is
+    analysed against the actions added before it, so the result is the same
+    as analyse_actions on the whole list. The actions are numbered in the
+    order they are added."""
+
+    def __init__(self) -> None:
+        self.actions: list[BrowserAction] = []
+
+    def add_action(self, action: BrowserAction) -> None:
+        action.ID = len(self.actions)
+        if isinstance(action, RequestAction):
+            analyse_request_action(action, self.actions)
+        self.actions.append(action)
+
+    def add_actions(self, actions: Iterable[BrowserAction]) -> None:
+        for action in actions:
+            self.add_action(action)
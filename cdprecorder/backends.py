@@ -0,0 +1,297 @@
+"""
+This module lets the recorder run on Twisted's reactor, or on asyncio.
+
+The recorder awaits the CDP events and commands in coroutines, which run on
+either event loop. What depends on the loop is behind a backend: running
+coroutines concurrently, timeouts, sleeping, threads, the signals that stop
+a recording, the CDP event listeners and the CDP connections. The Twisted
+backend uses pycdp.twisted, and the asyncio backend uses pycdp.asyncio,
+which needs aiohttp to connect to the browser.
+
+Classes:
+    - EventLoopBackend: The event loop primitives that the recorder uses.
+    - TwistedBackend: Runs on Twisted's reactor.
+    - AsyncioBackend: Runs on asyncio.
+    - CDPConnection: pycdp's Twisted connection, without the connection
+    retries.
+
+Functions:
+    - get_backend: Returns the backend of a name.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import importlib
+import sys
+from abc import ABC, abstractmethod
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Awaitable,
+    Callable,
+    Coroutine,
+    Generator,
+    Optional,
+    Protocol,
+    TypeVar,
+    cast,
+)
+
+import pycdp.twisted
+import twisted.internet.reactor
+from pycdp.twisted import CDPConnection as _PyCDPConnection
+from twisted.internet import defer, error, task, threads
+from twisted.python.failure import Failure
+from twisted.web.client import Agent
+
+if TYPE_CHECKING:
+    from .recorder import Reactor
+
+T = TypeVar("T")
+T_co = TypeVar("T_co", covariant=True)
+
+DEFAULT_BACKEND = "twisted"
+
+
+class Task(Protocol[T_co]):
+    """A coroutine running concurrently: a Deferred, or an asyncio Task."""
+
+    def __await__(self) -> Generator[Any, Any, T_co]: ...
+
+    def cancel(self) -> object: ...
+
+
+class CDPConnection(_PyCDPConnection):
+    # Remove `retry_on` wrapper from function
+    connect = _PyCDPConnection.connect.__wrapped__  # type: ignore[attr-defined] # pylint: disable=no-member
+
+
+class EventLoopBackend(ABC):
+    name: str
+    # Raised by `with_timeout`, when the time is up
+    timeout_error: type[BaseException]
+    # Raised when awaiting a cancelled task
+    cancelled_error: type[BaseException]
+    # Raised by `connect`, when no browser listens at the URL
+    connection_refused_error: type[BaseException]
+
+    @abstractmethod
+    def spawn(self, coro: Coroutine[Any, Any, T]) -> Task[T]:
+        """Runs the coroutine concurrently."""
+
+    @abstractmethod
+    def with_timeout(self, coro: Coroutine[Any, Any, T], timeout: float) -> Awaitable[T]:
+        """Runs the coroutine, and cancels it if it takes more than `timeout` seconds."""
+
+    @abstractmethod
+    def sleep(self, seconds: float) -> Awaitable[None]:
+        pass
+
+    @abstractmethod
+    def run_in_thread(self, func: Callable[..., T], *args: Any) -> Awaitable[T]:
+        pass
+
+    @abstractmethod
+    def create_future(self) -> Any:
+        """Returns an unset future: a Deferred, or an asyncio Future."""
+
+    @abstractmethod
+    def set_result(self, future: Any, value: object = None) -> None:
+        pass
+
+    @abstractmethod
+    def is_done(self, future: Any) -> bool:
+        """Tells if a future or a task has its result."""
+
+    @abstractmethod
+    def add_done_callback(self, future: Any, callback: Callable[[], None]) -> None:
+        """Calls `callback` when the future or the task has its result."""
+
+    @abstractmethod
+    def create_event_listener(self, buffer_size: int) -> Any:
+        """Returns a pycdp event listener, to add to a session's listeners."""
+
+    @abstractmethod
+    async def connect(self, cdp_url: str) -> Any:
+        """Returns a pycdp connection to the browser at `cdp_url`."""
+
+    @abstractmethod
+    def run(self, main: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        """Runs the event loop until `main` returns, and returns its result."""
+
+
+class TwistedBackend(EventLoopBackend):
+    name = "twisted"
+    timeout_error = defer.TimeoutError
+    cancelled_error = defer.CancelledError
+    connection_refused_error = error.ConnectionRefusedError
+
+    def __init__(self, reactor: Optional[Reactor] = None):
+        self.reactor = reactor if reactor is not None else cast("Reactor", twisted.internet.reactor)
+
+    def spawn(self, coro: Coroutine[Any, Any, T]) -> defer.Deferred[T]:
+        return defer.ensureDeferred(coro)
+
+    def with_timeout(self, coro: Coroutine[Any, Any, T], timeout: float) -> defer.Deferred[T]:
+        d: defer.Deferred[T] = defer.Deferred.fromCoroutine(coro)
+        d.addTimeout(timeout, self.reactor)
+        return d
+
+    def sleep(self, seconds: float) -> defer.Deferred[None]:
+        return task.deferLater(self.reactor, seconds, lambda: None)
+
+    def run_in_thread(self, func: Callable[..., T], *args: Any) -> defer.Deferred[T]:
+        return threads.deferToThread(func, *args)  # type: ignore[no-untyped-call,no-any-return]
+
+    def create_future(self) -> defer.Deferred[Any]:
+        return defer.Deferred()
+
+    def set_result(self, future: defer.Deferred[Any], value: object = None) -> None:
+        future.callback(value)
+
+    def is_done(self, future: defer.Deferred[Any]) -> bool:
+        return bool(future.called)
+
+    def add_done_callback(self, future: defer.Deferred[Any], callback: Callable[[], None]) -> None:
+        def on_done(result: object) -> object:
+            callback()
+            return result
+
+        future.addBoth(on_done)
+
+    def create_event_listener(self, buffer_size: int) -> pycdp.twisted.CDPEventListener:
+        return pycdp.twisted.CDPEventListener(defer.DeferredQueue(buffer_size))
+
+    async def connect(self, cdp_url: str) -> CDPConnection:
+        conn = CDPConnection(cdp_url, Agent(self.reactor), self.reactor)  # type: ignore[no-untyped-call]
+        await conn.connect()
+        return conn
+
+    def run(self, main: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        """Runs the reactor until `main` returns. The reactor can't be
+        started again afterwards."""
+        results: list[object] = []
+
+        def start() -> None:
+            d = defer.ensureDeferred(main())
+
+            def on_done(result: object) -> None:
+                results.append(result)
+                self.reactor.stop()
+
+            d.addBoth(on_done)
+
+        self.reactor.callWhenRunning(start)
+        self.reactor.run()
+
+        if not results:
+            raise RuntimeError("The reactor stopped before the coroutine returned")
+        if isinstance(results[0], Failure):
+            results[0].raiseException()
+        return cast(T, results[0])
+
+
+def _import_asyncio_modules() -> tuple[Any, Any]:
+    """Imports aiohttp and pycdp.asyncio, which are needed only by the
+    asyncio backend."""
+    try:
+        aiohttp = importlib.import_module("aiohttp")
+    except ImportError as exc:
+        raise ImportError("The asyncio backend needs aiohttp: pip install aiohttp") from exc
+    return aiohttp, importlib.import_module("pycdp.asyncio")
+
+
+@functools.cache
+def _asyncio_connection_class() -> type:
+    aiohttp, pycdp_asyncio = _import_asyncio_modules()
+    base: Any = pycdp_asyncio.CDPConnection
+
+    class AsyncioCDPConnection(base):  # type: ignore[misc,no-any-unimported]
+        """Owns the HTTP session that it connects through."""
+
+        # Remove `retry_on` wrapper from function
+        connect = getattr(base.connect, "__wrapped__", base.connect)
+
+        def __init__(self, debugging_url: str):
+            self.http_session = aiohttp.ClientSession()
+            super().__init__(debugging_url, self.http_session)
+
+        async def close(self) -> None:
+            try:
+                await super().close()
+            finally:
+                await self.http_session.close()
+
+    return AsyncioCDPConnection
+
+
+class AsyncioBackend(EventLoopBackend):
+    name = "asyncio"
+    timeout_error = asyncio.TimeoutError
+    cancelled_error = asyncio.CancelledError
+    # aiohttp's connection errors are OSErrors
+    connection_refused_error = OSError
+
+    def spawn(self, coro: Coroutine[Any, Any, T]) -> asyncio.Task[T]:
+        return asyncio.ensure_future(coro)
+
+    async def with_timeout(self, coro: Coroutine[Any, Any, T], timeout: float) -> T:
+        if sys.version_info >= (3, 11):
+            # Unlike wait_for, it doesn't run the coroutine in a new task
+            async with asyncio.timeout(timeout):
+                return await coro
+        return await asyncio.wait_for(coro, timeout)
+
+    def sleep(self, seconds: float) -> Awaitable[None]:
+        return asyncio.sleep(seconds)
+
+    def run_in_thread(self, func: Callable[..., T], *args: Any) -> Awaitable[T]:
+        return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+    def create_future(self) -> asyncio.Future[Any]:
+        return asyncio.get_running_loop().create_future()
+
+    def set_result(self, future: asyncio.Future[Any], value: object = None) -> None:
+        future.set_result(value)
+
+    def is_done(self, future: asyncio.Future[Any]) -> bool:
+        return future.done()
+
+    def add_done_callback(self, future: asyncio.Future[Any], callback: Callable[[], None]) -> None:
+        future.add_done_callback(lambda _: callback())
+
+    def create_event_listener(self, buffer_size: int) -> Any:
+        _, pycdp_asyncio = _import_asyncio_modules()
+        return pycdp_asyncio.CDPEventListener(asyncio.Queue(buffer_size))
+
+    async def connect(self, cdp_url: str) -> Any:
+        conn = _asyncio_connection_class()(cdp_url)
+        try:
+            await conn.connect()
+        except BaseException:
+            await conn.http_session.close()
+            raise
+        return conn
+
+    def run(self, main: Callable[[], Coroutine[Any, Any, T]]) -> T:
+        return asyncio.run(main())
+
+
+_BACKEND_CLASSES: dict[str, Callable[[], EventLoopBackend]] = {
+    TwistedBackend.name: TwistedBackend,
+    AsyncioBackend.name: AsyncioBackend,
+}
+_BACKENDS: dict[str, EventLoopBackend] = {}
+
+
+def get_backend(name: str = DEFAULT_BACKEND) -> EventLoopBackend:
+    """Returns the backend of a name: "twisted" or "asyncio"."""
+    if name not in _BACKENDS:
+        try:
+            backend_class = _BACKEND_CLASSES[name]
+        except KeyError:
+            raise ValueError(f"Unknown event loop backend {name!r}") from None
+        _BACKENDS[name] = backend_class()
+    return _BACKENDS[name]
@@ -0,0 +1,168 @@
+"""
+This module contains the BodyFetchPool, which retrieves HTTP bodies from
+Chrome without blocking the dispatch of CDP events.
+
+Classes:
+    - BodyFetchPool: Runs body fetches concurrently, with a limit on the
+    commands in flight, and a limit on the fetches waiting to run.
+
+Functions:
+    - decode_body: Converts a body returned by CDP to bytes, or to a
+    BodySpool if it is large.
+"""
+
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Any, Callable, Coroutine, Optional, TypeVar
+
+import pycdp
+from pycdp import cdp
+from twisted.internet import defer, threads
+
+from . import logger
+from .body_spool import Body, body_from_cdp
+
+if TYPE_CHECKING:
+    import pycdp.twisted
+
+
+T = TypeVar("T")
+
+# Bodies shorter than this are decoded inline, because the thread hop costs more than the decoding
+DECODE_IN_THREAD_THRESHOLD = 64 * 1024
+
+
+async def decode_body(data: str, is_base64: bool, spool_threshold: Optional[int] = None) -> Body:
+    """Converts a body returned by CDP. Large bodies are decoded in a thread,
+    to keep the reactor free for incoming events. Bodies longer than
+    `spool_threshold` are written to a BodySpool."""
+    if len(data) < DECODE_IN_THREAD_THRESHOLD:
+        return body_from_cdp(data, is_base64, spool_threshold)
+
+    decoded: Body = await threads.deferToThread(  # type: ignore[no-untyped-call]
+        body_from_cdp, data, is_base64, spool_threshold
+    )
+    return decoded
+
+
+async def fetch_response_body(
+    session: pycdp.twisted.CDPSession, request_id: cdp.network.RequestId, spool_threshold: Optional[int] = None
+) -> Optional[Body]:
+    try:
+        data, is_base64 = await session.execute(cdp.network.get_response_body(request_id))
+    except pycdp.exceptions.CDPBrowserError:
+        logger.debug("Could not get the response body of %s", request_id)
+        return None
+
+    return await decode_body(data, is_base64, spool_threshold)
+
+
+async def fetch_request_post_data(
+    session: pycdp.twisted.CDPSession, request_id: cdp.network.RequestId
+) -> Optional[str]:
+    try:
+        return await session.execute(cdp.network.get_request_post_data(request_id))
+    except pycdp.exceptions.CDPBrowserError:
+        logger.debug("Could not get the post data of %s", request_id)
+        return None
+
+
+class BodyFetchPool:
+    """Runs body fetches in the background.
+
+    At most `concurrency` CDP commands are in flight at a time. When
+    `max_pending` fetches are already running or waiting, `submit` waits for
+    one of them to finish. This slows down the consumption of events, instead
+    of letting the fetches grow without limit.
+
+    The fetches can go through a session other than the one that receives
+    the events. That session must have the Network domain enabled.
+    """
+
+    def __init__(
+        self,
+        session: pycdp.twisted.CDPSession,
+        concurrency: int = 8,
+        max_pending: int = 256,
+        spool_threshold: Optional[int] = None,
+    ):
+        if concurrency < 1 or max_pending < concurrency:
+            raise ValueError("Expected 1 <= concurrency <= max_pending")
+
+        self.session = session
+        self.spool_threshold = spool_threshold
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._running = defer.DeferredSemaphore(concurrency)
+        self._pending = defer.DeferredSemaphore(max_pending)
+        self._tasks: set[defer.Deferred[None]] = set()
+
+        self.fetched = 0
+        self.failed = 0
+        self.peak_pending = 0
+
+    @property
+    def pending(self) -> int:
+        return len(self._tasks)
+
+    async def submit(
+        self,
+        fetch: Callable[[], Coroutine[Any, Any, T]],
+        on_done: Callable[[Optional[T]], None],
+    ) -> None:
+        """Schedules `fetch`, and calls `on_done` with its result. The result
+        is None if the fetch failed."""
+        await self._pending.acquire()
+
+        async def run() -> None:
+            result = None
+            try:
+                result = await self._running.run(lambda: defer.ensureDeferred(fetch()))
+            except Exception:  # pylint: disable=broad-exception-caught
+                logger.exception("Body fetch failed")
+
+            if result is None:
+                self.failed += 1
+            else:
+                self.fetched += 1
+            on_done(result)
+
+        task = defer.ensureDeferred(run())
+        if not task.called:
+            self._tasks.add(task)
+            self.peak_pending = max(self.peak_pending, len(self._tasks))
+        task.addBoth(self._on_task_done, task)
+
+    def _on_task_done(self, result: object, task: defer.Deferred[None]) -> object:
+        self._tasks.discard(task)
+        self._pending.release()
+        return result
+
+    async def submit_response_body(
+        self,
+        request_id: cdp.network.RequestId,
+        on_done: Callable[[Optional[Body]], None],
+        session: Optional[pycdp.twisted.CDPSession] = None,
+    ) -> None:
+        """Fetches a response body through `session`, or through the pool's
+        session if None."""
+        session = session or self.session
+        await self.submit(lambda: fetch_response_body(session, request_id, self.spool_threshold), on_done)
+
+    async def submit_request_post_data(
+        self,
+        request_id: cdp.network.RequestId,
+        on_done: Callable[[Optional[str]], None],
+        session: Optional[pycdp.twisted.CDPSession] = None,
+    ) -> None:
+        session = session or self.session
+        await self.submit(lambda: fetch_request_post_data(session, request_id), on_done)
+
+    async def join(self) -> None:
+        """Waits for all the submitted fetches to finish."""
+        while self._tasks:
+            await defer.DeferredList(list(self._tasks))
+
+        logger.debug(
+            "Body fetch pool: %d fetched, %d failed, %d peak pending", self.fetched, self.failed, self.peak_pending
+        )
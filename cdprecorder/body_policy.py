@@ -0,0 +1,149 @@
+"""
+This module contains the declarative policy that decides how much of each
+response body the recorder keeps. The analyser only looks for strings in
+text bodies, so media and binary bodies can be skipped before they are
+fetched, and large bodies can be truncated or replaced with their hash.
+
+Classes:
+    - BodyCaptureMode: What to keep of a body.
+    - BodyCaptureRule: Selects bodies by MIME type, size and URL.
+    - BodyCapturePolicy: An ordered list of rules; the first match wins.
+
+Functions:
+    - apply_capture_rule: Reduces a fetched body according to a rule.
+"""
+
+from __future__ import annotations
+
+import enum
+import fnmatch
+import hashlib
+import re
+from dataclasses import dataclass
+from typing import Optional, Union
+
+from .body_spool import Body, BodyDigest, BodySpool, StoredBody
+
+DEFAULT_TRUNCATE_SIZE = 64 * 1024
+
+
+class BodyCaptureMode(enum.Enum):
+    FULL = "full"
+    # Keep only the first `max_bytes` bytes
+    TRUNCATE = "truncate"
+    # Keep only the SHA-256 of the body, and its size
+    HASH = "hash"
+    # Don't fetch the body at all
+    SKIP = "skip"
+
+
+@dataclass(frozen=True)
+class BodyCaptureRule:
+    """Matches a response if all the given conditions hold.
+
+    Attributes:
+        mode: What to keep of the matched bodies.
+        mime_types: Shell-style patterns, e.g. "image/*". If empty, any MIME
+            type matches.
+        min_size: The minimum encodedDataLength reported by Chrome.
+        url_pattern: A regex searched in the request URL.
+        max_bytes: The number of bytes kept in TRUNCATE mode.
+    """
+
+    mode: BodyCaptureMode
+    mime_types: tuple[str, ...] = ()
+    min_size: Optional[int] = None
+    url_pattern: Optional[str] = None
+    max_bytes: int = DEFAULT_TRUNCATE_SIZE
+
+    def matches(self, mime_type: Optional[str], encoded_length: float, url: Optional[str]) -> bool:
+        if self.mime_types:
+            if mime_type is None:
+                return False
+            mime_type = mime_type.lower()
+            if not any(fnmatch.fnmatchcase(mime_type, pattern) for pattern in self.mime_types):
+                return False
+
+        if self.min_size is not None and encoded_length < self.min_size:
+            return False
+
+        if self.url_pattern is not None and (url is None or re.search(self.url_pattern, url) is None):
+            return False
+
+        return True
+
+
+@dataclass(frozen=True)
+class BodyCapturePolicy:
+    rules: tuple[BodyCaptureRule, ...] = ()
+
+    def select(self, mime_type: Optional[str], encoded_length: float, url: Optional[str]) -> Optional[BodyCaptureRule]:
+        """Returns the first rule that matches the response, or None if the
+        body should be kept whole."""
+        for rule in self.rules:
+            if rule.matches(mime_type, encoded_length, url):
+                return rule
+
+        return None
+
+
+# Bodies that the analyser can't search, because they aren't text
+DEFAULT_BODY_CAPTURE_POLICY = BodyCapturePolicy(
+    (
+        BodyCaptureRule(
+            BodyCaptureMode.SKIP,
+            mime_types=(
+                "image/*",
+                "font/*",
+                "video/*",
+                "audio/*",
+                "application/font-*",
+                "application/x-font-*",
+                "application/vnd.ms-fontobject",
+                "application/x-protobuf",
+                "application/vnd.google.protobuf",
+                "application/grpc*",
+                "application/octet-stream",
+            ),
+        ),
+    )
+)
+
+
+def _hash_body(body: Union[bytes, BodySpool, StoredBody]) -> BodyDigest:
+    if isinstance(body, StoredBody):
+        return BodyDigest("sha256", body.digest, body.size)
+    if isinstance(body, BodySpool):
+        sha = hashlib.sha256()
+        for chunk in body.iter_chunks():
+            sha.update(chunk)
+        return BodyDigest("sha256", sha.hexdigest(), body.size)
+
+    return BodyDigest("sha256", hashlib.sha256(body).hexdigest(), len(body))
+
+
+def _truncate_body(body: Union[bytes, BodySpool, StoredBody], max_bytes: int) -> bytes:
+    if isinstance(body, BodySpool):
+        return next(body.iter_chunks(max_bytes), b"")
+    if isinstance(body, StoredBody):
+        return body.read()[:max_bytes]
+
+    return body[:max_bytes]
+
+
+def apply_capture_rule(body: Optional[Body], rule: Optional[BodyCaptureRule]) -> Optional[Body]:
+    """Returns what should be kept of a fetched body. A spooled body that
+    isn't kept whole is closed."""
+    if body is None or rule is None or rule.mode == BodyCaptureMode.FULL or isinstance(body, BodyDigest):
+        return body
+
+    reduced: Optional[Body] = None
+    if rule.mode == BodyCaptureMode.TRUNCATE:
+        reduced = _truncate_body(body, rule.max_bytes)
+    elif rule.mode == BodyCaptureMode.HASH:
+        reduced = _hash_body(body)
+
+    if isinstance(body, BodySpool):
+        body.close()
+
+    return reduced
@@ -0,0 +1,192 @@
+"""
+This module contains helpers for keeping large HTTP bodies out of memory.
+A body above a size threshold is decoded in chunks, straight into a
+temporary file, and only the file is kept until the body is needed.
+
+Classes:
+    - BodySpool: An HTTP body stored in a temporary file.
+    - BodyDigest: Stands for a body that was kept only as a hash.
+    - LazyBody: A body kept as text or base64, decoded when it is read.
+    - StoredBody: A handle to a body kept in a BodyStore.
+
+Functions:
+    - decode_to_spool: Decodes a CDP body into a BodySpool, chunk by chunk.
+    - body_from_cdp: Converts a CDP body to bytes or to a BodySpool.
+    - read_body: Returns the bytes of a body, whatever its storage.
+    - action_body: Returns what an action keeps of a recorded body.
+"""
+
+from __future__ import annotations
+
+import base64
+import os
+import tempfile
+import weakref
+from typing import TYPE_CHECKING, Iterator, NamedTuple, Optional, Union
+
+if TYPE_CHECKING:
+    from .body_store import BodyStore
+
+# Number of base64 characters decoded at a time. Must be a multiple of 4.
+DECODE_CHUNK_SIZE = 1024 * 1024
+
+
+def _remove_file(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class BodySpool:
+    """An HTTP body stored in a temporary file. The file is open only while
+    it's written or read, so that a recording with many spooled bodies
+    doesn't run out of file descriptors. It is deleted when the spool is
+    closed or garbage collected."""
+
+    def __init__(self) -> None:
+        fd, self.path = tempfile.mkstemp(prefix="cdprecorder-body-")
+        os.close(fd)
+        self.size = 0
+        self._remove_file = weakref.finalize(self, _remove_file, self.path)
+
+    def write(self, chunk: bytes) -> None:
+        with open(self.path, "ab") as file:
+            file.write(chunk)
+        self.size += len(chunk)
+
+    def iter_chunks(self, chunk_size: int = DECODE_CHUNK_SIZE) -> Iterator[bytes]:
+        with open(self.path, "rb") as file:
+            while chunk := file.read(chunk_size):
+                yield chunk
+
+    def read(self) -> bytes:
+        with open(self.path, "rb") as file:
+            return file.read()
+
+    def close(self) -> None:
+        self._remove_file()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __eq__(self, obj: object) -> bool:
+        if isinstance(obj, BodySpool):
+            return self.size == obj.size and self.read() == obj.read()
+        if isinstance(obj, bytes):
+            return self.size == len(obj) and self.read() == obj
+        return False
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(size={self.size})"
+
+
+class BodyDigest(NamedTuple):
+    algorithm: str
+    hexdigest: str
+    size: int
+
+
+class StoredBody:
+    """A body kept in a BodyStore, by its SHA-256. Reading it decompresses
+    the stored body, unless it was read recently."""
+
+    __slots__ = ("store", "digest", "size")
+
+    def __init__(self, store: BodyStore, digest: str, size: int):
+        self.store = store
+        self.digest = digest
+        self.size = size
+
+    def read(self) -> bytes:
+        return self.store.get(self.digest)
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __eq__(self, obj: object) -> bool:
+        if isinstance(obj, StoredBody):
+            if self.digest == obj.digest:
+                return True
+            return self.size == obj.size and self.read() == obj.read()
+        if isinstance(obj, bytes):
+            return self.size == len(obj) and self.read() == obj
+        return False
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(sha256={self.digest[:12]}, size={self.size})"
+
+
+Body = Union[bytes, BodySpool, BodyDigest, StoredBody]
+
+
+class LazyBody:
+    """An HTTP body kept the way it was received, as text or as base64, and
+    decoded only when its bytes are needed. A large text can be kept in a
+    BodySpool, encoded as UTF-8."""
+
+    def __init__(self, data: Union[str, BodySpool], is_base64: bool):
+        self.data = data
+        self.is_base64 = is_base64
+
+    def decode(self) -> bytes:
+        data = self.data.read() if isinstance(self.data, BodySpool) else self.data
+        if self.is_base64:
+            return base64.b64decode(data)
+        if isinstance(data, str):
+            return data.encode()
+        return data
+
+    def __eq__(self, obj: object) -> bool:
+        if isinstance(obj, LazyBody):
+            return self.decode() == obj.decode()
+        if isinstance(obj, bytes):
+            return self.decode() == obj
+        return False
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}(size={len(self.data)}, is_base64={self.is_base64})"
+
+
+def decode_to_spool(data: str, is_base64: bool, chunk_size: int = DECODE_CHUNK_SIZE) -> BodySpool:
+    """Decodes a body received from CDP into a BodySpool. At most one chunk
+    of decoded bytes is held in memory at a time."""
+    spool = BodySpool()
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start : start + chunk_size]
+        if is_base64:
+            spool.write(base64.b64decode(chunk))
+        else:
+            spool.write(chunk.encode())
+
+    return spool
+
+
+def body_from_cdp(data: str, is_base64: bool, spool_threshold: Optional[int] = None) -> Body:
+    """Converts a body received from CDP. If it is longer than
+    `spool_threshold`, it is stored in a BodySpool."""
+    if spool_threshold is not None and len(data) > spool_threshold:
+        return decode_to_spool(data, is_base64)
+
+    if is_base64:
+        return base64.b64decode(data)
+    return data.encode()
+
+
+def read_body(body: Optional[Body]) -> Optional[bytes]:
+    """Returns the bytes of a body. A BodyDigest has no bytes, so it gives
+    None."""
+    if isinstance(body, (BodySpool, StoredBody)):
+        return body.read()
+    if isinstance(body, BodyDigest):
+        return None
+    return body
+
+
+def action_body(body: Optional[Body]) -> Union[bytes, StoredBody, None]:
+    """Returns what an action keeps of a recorded body: a StoredBody as it
+    is, so that it's decompressed only when read, and the bytes of the
+    others."""
+    if isinstance(body, StoredBody):
+        return body
+    return read_body(body)
@@ -0,0 +1,182 @@
+"""
+This module keeps the response bodies of a recording once per content.
+Polling endpoints and reloaded pages return the same bodies again and again,
+so the bodies are stored by their SHA-256, and each copy is only a handle
+to the stored one.
+
+The stored bodies are compressed with zlib, in memory or in files of a
+directory. They are decompressed when they are read, and the most recently
+read ones are kept decompressed, up to a number of bytes.
+
+Classes:
+    - BodyStoreStats: The deduplication and compression counters of a store.
+    - BodyStore: Stores bodies by content, compressed, and returns
+    StoredBody handles.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Iterable, NamedTuple, Optional, Union
+
+from . import logger
+from .body_spool import BodySpool, StoredBody
+
+DEFAULT_COMPRESSION_LEVEL = 6
+# Bytes of decompressed bodies kept for the next reads
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024
+
+
+@dataclass
+class BodyStoreStats:
+    # Bodies added, and their bytes, counting the duplicates
+    added: int = 0
+    added_bytes: int = 0
+    # Distinct bodies, and their bytes before compression
+    unique: int = 0
+    unique_bytes: int = 0
+    # Bytes of the distinct bodies after compression
+    stored_bytes: int = 0
+
+    @property
+    def dedup_ratio(self) -> float:
+        return self.added_bytes / self.unique_bytes if self.unique_bytes else 1.0
+
+    @property
+    def compression_ratio(self) -> float:
+        return self.unique_bytes / self.stored_bytes if self.stored_bytes else 1.0
+
+
+class _Entry(NamedTuple):
+    size: int
+    stored_size: int
+    # Bodies that zlib doesn't make smaller are stored as they are
+    compressed: bool
+
+
+def _iter_chunks(body: Union[bytes, BodySpool]) -> Iterable[bytes]:
+    return body.iter_chunks() if isinstance(body, BodySpool) else (body,)
+
+
+class BodyStore:
+    """Stores bodies by their SHA-256, compressed with zlib. A body that was
+    already stored is not stored again.
+
+    Args:
+        directory: If given, the compressed bodies are written to files in
+            it, named by their hash. Otherwise, they are kept in memory.
+        compression_level: The zlib level, from 1 (fastest) to 9 (smallest).
+        cache_size: Bytes of decompressed bodies kept for the next reads.
+    """
+
+    def __init__(
+        self,
+        directory: Optional[str] = None,
+        compression_level: int = DEFAULT_COMPRESSION_LEVEL,
+        cache_size: int = DEFAULT_CACHE_SIZE,
+    ):
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.compression_level = compression_level
+        self.cache_size = cache_size
+        self.stats = BodyStoreStats()
+
+        self._entries: dict[str, _Entry] = {}
+        self._blobs: dict[str, bytes] = {}
+        self._cache: OrderedDict[str, bytes] = OrderedDict()
+        self._cache_bytes = 0
+        # The analyser reads the bodies in a thread, while the recorder adds more
+        self._lock = threading.Lock()
+
+    def _path(self, digest: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, digest)
+
+    def _compress(self, chunks: Iterable[bytes]) -> bytes:
+        compressor = zlib.compressobj(self.compression_level)
+        blob = b"".join(compressor.compress(chunk) for chunk in chunks)
+        return blob + compressor.flush()
+
+    def add(self, body: Union[bytes, BodySpool]) -> StoredBody:
+        """Stores a body, unless it's already stored, and returns its handle.
+        A BodySpool is read chunk by chunk, and can be closed afterwards."""
+        sha = hashlib.sha256()
+        for chunk in _iter_chunks(body):
+            sha.update(chunk)
+        digest = sha.hexdigest()
+        size = len(body)
+
+        with self._lock:
+            self.stats.added += 1
+            self.stats.added_bytes += size
+            if digest in self._entries:
+                return StoredBody(self, digest, size)
+
+        blob = self._compress(_iter_chunks(body))
+        compressed = len(blob) < size
+        if not compressed:
+            blob = body.read() if isinstance(body, BodySpool) else body
+
+        if self.directory is not None:
+            with open(self._path(digest), "wb") as file:
+                file.write(blob)
+
+        with self._lock:
+            if digest not in self._entries:
+                self._entries[digest] = _Entry(size, len(blob), compressed)
+                if self.directory is None:
+                    self._blobs[digest] = blob
+                self.stats.unique += 1
+                self.stats.unique_bytes += size
+                self.stats.stored_bytes += len(blob)
+        return StoredBody(self, digest, size)
+
+    def get(self, digest: str) -> bytes:
+        """Returns the bytes of a stored body."""
+        with self._lock:
+            data = self._cache.get(digest)
+            if data is not None:
+                self._cache.move_to_end(digest)
+                return data
+            entry = self._entries[digest]
+            blob = self._blobs.get(digest)
+
+        if blob is None:
+            with open(self._path(digest), "rb") as file:
+                blob = file.read()
+        data = zlib.decompress(blob) if entry.compressed else blob
+
+        if len(data) <= self.cache_size:
+            with self._lock:
+                if digest not in self._cache:
+                    self._cache[digest] = data
+                    self._cache_bytes += len(data)
+                while self._cache_bytes > self.cache_size:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._cache_bytes -= len(evicted)
+        return data
+
+    def __contains__(self, digest: str) -> bool:
+        return digest in self._entries
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def log_stats(self) -> None:
+        stats = self.stats
+        logger.info(
+            "Body store: %d bodies (%d bytes), %d distinct (%d bytes, dedup %.1fx), %d bytes stored (compression %.1fx)",
+            stats.added,
+            stats.added_bytes,
+            stats.unique,
+            stats.unique_bytes,
+            stats.dedup_ratio,
+            stats.stored_bytes,
+            stats.compression_ratio,
+        )
@@ -0,0 +1,167 @@
+"""
+This module pushes the recorder's ignore rules into Chrome, so that the
+blocked requests never reach the recorder as response events, and their
+bodies are never fetched.
+
+Only the rules that can't change what gets recorded are pushed. The
+`.js`, `.css` and `.svg` files ignored by `is_url_ignored` are still needed
+by the page, so they are left alone.
+
+Classes:
+    - ResourceTypeBlocker: Fails the requests of some resource types, e.g.
+    media and fonts, through the Fetch domain.
+
+Functions:
+    - blocked_domains: Extracts the plain domain rules of a URLFilter.
+    - domain_url_patterns: Converts domains to Network.setBlockedURLs
+    patterns.
+    - block_filtered_urls: Makes Chrome block the domains of a URLFilter.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import TYPE_CHECKING, AsyncIterable, Iterable, Optional, cast
+
+import pycdp
+from pycdp import cdp
+
+from . import filters, logger
+from .backends import EventLoopBackend, Task, get_backend
+
+if TYPE_CHECKING:
+    import pycdp.twisted
+
+
+# Chrome matches every request against all the patterns, so very long lists slow down the page
+MAX_BLOCKED_URL_PATTERNS = 20000
+
+_DOMAIN_RULE_RE = re.compile(r"^\|\|([a-z0-9.-]+)\^?$")
+_EXCEPTION_DOMAIN_RE = re.compile(r"^\|\|([a-z0-9.-]+)")
+
+
+def blocked_domains(urlfilter: filters.URLFilter) -> list[str]:
+    """Returns the domains blocked by `||domain^` rules without options.
+
+    A domain is left out if an exception rule allows any URL on it or on one
+    of its subdomains, because Chrome can't apply exception rules.
+    """
+    domains: list[str] = []
+    exception_domains: set[str] = set()
+    for rule in urlfilter.rules:
+        if rule.is_exception:
+            match = _EXCEPTION_DOMAIN_RE.match(rule.rule_text)
+            if match is not None:
+                exception_domains.add(match.group(1))
+            continue
+
+        if rule.options:
+            continue
+        match = _DOMAIN_RULE_RE.match(rule.rule_text)
+        if match is not None:
+            domains.append(match.group(1))
+
+    def has_exception(domain: str) -> bool:
+        return any(
+            exception == domain or exception.endswith("." + domain) or domain.endswith("." + exception)
+            for exception in exception_domains
+        )
+
+    return [domain for domain in dict.fromkeys(domains) if not has_exception(domain)]
+
+
+def domain_url_patterns(domains: Iterable[str]) -> list[str]:
+    patterns = []
+    for domain in domains:
+        patterns.append(f"*://{domain}/*")
+        patterns.append(f"*://*.{domain}/*")
+
+    return patterns
+
+
+async def block_filtered_urls(
+    session: pycdp.twisted.CDPSession,
+    urlfilter: filters.URLFilter,
+    max_patterns: int = MAX_BLOCKED_URL_PATTERNS,
+) -> int:
+    """Makes Chrome block the domains of the URLFilter. Chrome still sends
+    RequestWillBeSent for the blocked requests, but no responses.
+
+    Returns:
+        The number of patterns sent to Chrome.
+    """
+    patterns = domain_url_patterns(blocked_domains(urlfilter))
+    if len(patterns) > max_patterns:
+        logger.warning("Blocking only %d of the %d URL patterns in Chrome", max_patterns, len(patterns))
+        patterns = patterns[:max_patterns]
+
+    await session.execute(cdp.network.set_blocked_ur_ls(patterns))
+    return len(patterns)
+
+
+class ResourceTypeBlocker:
+    """Fails the requests of the given resource types, before they are sent.
+
+    It enables the Fetch domain only for these resource types, so the other
+    requests are not paused.
+    """
+
+    def __init__(
+        self,
+        session: pycdp.twisted.CDPSession,
+        resource_types: Iterable[cdp.network.ResourceType],
+        backend: Optional[EventLoopBackend] = None,
+    ):
+        self.session = session
+        self.resource_types = tuple(resource_types)
+        self.backend = backend if backend is not None else get_backend()
+        self.blocked = 0
+        self._receiver: Optional[pycdp.twisted.CDPEventListener] = None
+        self._task: Optional[Task[None]] = None
+
+    async def start(self) -> None:
+        if not self.resource_types:
+            return
+
+        # Don't call session.listen because we need the receiver object to close it at the end
+        self._receiver = self.backend.create_event_listener(1024)
+        listeners = self.session._listeners  # type: ignore[attr-defined] # pylint: disable=protected-access
+        listeners[cdp.fetch.RequestPaused].add(self._receiver)
+
+        patterns = [
+            cdp.fetch.RequestPattern(resource_type=resource_type, request_stage=cdp.fetch.RequestStage.REQUEST)
+            for resource_type in self.resource_types
+        ]
+        await self.session.execute(cdp.fetch.enable(patterns))
+        self._task = self.backend.spawn(self._run(cast(AsyncIterable[cdp.fetch.RequestPaused], self._receiver)))
+
+    async def _run(self, listener: AsyncIterable[cdp.fetch.RequestPaused]) -> None:
+        async for evt in listener:
+            try:
+                await self.session.execute(
+                    cdp.fetch.fail_request(evt.request_id, cdp.network.ErrorReason.BLOCKED_BY_CLIENT)
+                )
+                self.blocked += 1
+            except pycdp.exceptions.CDPBrowserError:
+                logger.debug("Could not fail the paused request %s", evt.request_id)
+            except self.backend.cancelled_error:
+                raise
+            except Exception:  # pylint: disable=broad-exception-caught
+                # The next requests of these types must still be failed, or they stay paused
+                logger.exception("Failed to block the paused request %s", evt.request_id)
+
+    async def stop(self) -> None:
+        if self._receiver is None:
+            return
+
+        try:
+            # Otherwise the page's requests of these types stay paused, with nothing to fail them
+            await self.session.execute(cdp.fetch.disable())
+        except pycdp.exceptions.CDPBrowserError:
+            logger.debug("Could not disable the Fetch domain")
+        self._receiver.close()
+        self._receiver = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        logger.debug("Blocked %d requests by resource type", self.blocked)
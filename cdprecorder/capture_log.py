@@ -0,0 +1,310 @@
+"""
+This module contains an append-only, segmented on-disk log for recorded CDP
+traffic. The recorder writes every network event and response body to the
+log as soon as it arrives, and keeps in memory only the locations of the
+records. The communications are rebuilt lazily, when they are read back.
+
+A segment is a sequence of records. Each record is a JSON header line,
+followed by `size` bytes of payload:
+    {"kind": "event", "request_id": "1.2", "size": 1534}\\n<payload>
+
+Record kinds:
+    - event: a CDP event, serialized as {"method": ..., "params": ...}. The
+    header holds the id of the target that sent it, if several targets are
+    recorded.
+    - body: a response body; the header holds the body's slot. A body kept
+    only as a hash has no payload, and its digest is in the header.
+    - post_data: the post data of a request, fetched after its event was
+    written; the header holds the index of the event.
+    - ignored: marks a request id as ignored; it has no payload.
+    - input: an InputAction, serialized as JSON.
+
+Classes:
+    - RecordLocation: The position of a record in the log.
+    - CaptureLogWriter: Appends records to the segments of a directory.
+    - CaptureLogReader: Reads records and rebuilds communications.
+
+Functions:
+    - event_to_json: Serializes a CDP event with its method name.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Any,
+    Iterable,
+    Iterator,
+    NamedTuple,
+    Optional,
+    Union,
+    cast,
+)
+
+from pycdp import cdp
+
+from .action import InputAction
+from .body_spool import Body, BodyDigest, BodySpool, StoredBody
+from .raw_events import RawEvent, event_type_method
+
+if TYPE_CHECKING:
+    from pycdp.cdp.util import T_JSON_DICT
+
+    from .recorder import HttpCommunication
+    from .type_checking import CdpEvent
+
+
+SEGMENT_PREFIX = "segment-"
+SEGMENT_SUFFIX = ".log"
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+def event_method(event: CdpEvent) -> str:
+    """Returns the CDP method name of an event, e.g. "Network.loadingFinished"."""
+    if isinstance(event, RawEvent):
+        return event.method
+    return event_type_method(type(event))
+
+
+def event_to_json(event: CdpEvent) -> T_JSON_DICT:
+    return {"method": event_method(event), "params": event.to_json()}
+
+
+def segment_path(directory: str, segment: int) -> str:
+    return os.path.join(directory, f"{SEGMENT_PREFIX}{segment:06d}{SEGMENT_SUFFIX}")
+
+
+def list_segments(directory: str) -> list[int]:
+    segments = []
+    for name in os.listdir(directory):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            segments.append(int(name[len(SEGMENT_PREFIX) : -len(SEGMENT_SUFFIX)]))
+
+    return sorted(segments)
+
+
+class RecordLocation(NamedTuple):
+    segment: int
+    offset: int
+
+
+class CaptureLogWriter:
+    """Appends records to a directory of segment files. A new segment is
+    started when the current one grows over `segment_size` bytes. Every
+    record is flushed, so a crash loses at most the record being written."""
+
+    def __init__(self, directory: str, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        if list_segments(directory):
+            raise FileExistsError(f"{directory} already contains a capture log")
+
+        self.directory = directory
+        self.segment_size = segment_size
+        self.segment = -1
+        self.bytes_written = 0
+        self._file: Optional[IO[bytes]] = None
+        self._open_next_segment()
+
+    def _open_next_segment(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        self.segment += 1
+        self._file = open(segment_path(self.directory, self.segment), "wb")
+
+    def _write(self, header: dict[str, Any], payload: bytes = b"") -> RecordLocation:
+        return self._write_chunks(header, len(payload), [payload])
+
+    def _write_chunks(self, header: dict[str, Any], size: int, chunks: Iterable[bytes]) -> RecordLocation:
+        if self._file is None:
+            raise ValueError("The capture log is closed")
+
+        offset = self._file.tell()
+        if offset > 0 and offset + size > self.segment_size:
+            self._open_next_segment()
+            return self._write_chunks(header, size, chunks)
+
+        header["size"] = size
+        line = json.dumps(header).encode() + b"\n"
+        self._file.write(line)
+        for chunk in chunks:
+            self._file.write(chunk)
+        self._file.flush()
+        self.bytes_written += len(line) + size
+
+        return RecordLocation(self.segment, offset)
+
+    def append_event(self, request_id: str, event: CdpEvent, target_id: Optional[str] = None) -> RecordLocation:
+        header: dict[str, Any] = {"kind": "event", "request_id": request_id}
+        if target_id is not None:
+            header["target_id"] = target_id
+        payload = json.dumps(event_to_json(event)).encode()
+        return self._write(header, payload)
+
+    def append_body(self, request_id: str, slot: int, body: Optional[Body]) -> RecordLocation:
+        header = {"kind": "body", "request_id": request_id, "slot": slot, "null": body is None}
+        if isinstance(body, BodyDigest):
+            header["digest"] = list(body)
+            return self._write(header)
+        if isinstance(body, BodySpool):
+            # Copied chunk by chunk, so the body is never loaded whole
+            return self._write_chunks(header, body.size, body.iter_chunks())
+        if isinstance(body, StoredBody):
+            return self._write(header, body.read())
+        return self._write(header, body or b"")
+
+    def append_post_data(self, request_id: str, event_index: int, data: str) -> RecordLocation:
+        header = {"kind": "post_data", "request_id": request_id, "event_index": event_index}
+        return self._write(header, data.encode())
+
+    def append_ignored(self, request_id: str) -> RecordLocation:
+        return self._write({"kind": "ignored", "request_id": request_id})
+
+    def append_communication(self, comm: HttpCommunication) -> list[RecordLocation]:
+        """Writes the events and bodies of a communication kept in memory."""
+        locations = [self.append_event(comm.request_id, event, comm.target_id) for event in comm.events]
+        for slot, body in enumerate(comm.response_bodies):
+            locations.append(self.append_body(comm.request_id, slot, body))
+        if comm.ignored:
+            locations.append(self.append_ignored(comm.request_id))
+        return locations
+
+    def append_input_action(self, action: InputAction) -> RecordLocation:
+        data = {"text": action.text, "selector": action.selector, "timestamp": action.timestamp}
+        return self._write({"kind": "input"}, json.dumps(data).encode())
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class CaptureLogReader:
+    """Reads records from the segments written by a CaptureLogWriter."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._files: dict[int, IO[bytes]] = {}
+
+    def _get_file(self, segment: int) -> IO[bytes]:
+        if segment not in self._files:
+            self._files[segment] = open(segment_path(self.directory, segment), "rb")
+        return self._files[segment]
+
+    @staticmethod
+    def _read_from(file: IO[bytes]) -> Optional[tuple[dict[str, Any], bytes]]:
+        line = file.readline()
+        if not line.endswith(b"\n"):
+            # End of segment, or a header truncated by a crash
+            return None
+        header = json.loads(line)
+        payload = file.read(header["size"])
+        if len(payload) != header["size"]:
+            return None
+
+        return header, payload
+
+    def read_record(self, location: RecordLocation) -> tuple[dict[str, Any], bytes]:
+        file = self._get_file(location.segment)
+        file.seek(location.offset)
+        record = self._read_from(file)
+        if record is None:
+            raise EOFError(f"No complete record at {location}")
+
+        return record
+
+    def scan(self) -> Iterator[tuple[RecordLocation, dict[str, Any]]]:
+        """Yields the location and the header of every complete record, in
+        the order they were written."""
+        for segment in list_segments(self.directory):
+            file = self._get_file(segment)
+            file.seek(0)
+            while True:
+                offset = file.tell()
+                record = self._read_from(file)
+                if record is None:
+                    break
+                yield RecordLocation(segment, offset), record[0]
+
+    def load_communication(self, request_id: str, locations: Iterable[RecordLocation]) -> HttpCommunication:
+        from .recorder import HttpCommunication
+
+        comm = HttpCommunication(cdp.network.RequestId(request_id))
+        bodies: dict[int, Optional[Body]] = {}
+        post_data: dict[int, str] = {}
+        for location in locations:
+            header, payload = self.read_record(location)
+            if header["kind"] == "event":
+                # Parsed only when the actions are generated
+                comm.add_event(RawEvent.from_json(json.loads(payload)))
+                if "target_id" in header:
+                    comm.target_id = cdp.target.TargetID(header["target_id"])
+            elif header["kind"] == "body":
+                if header["null"]:
+                    bodies[header["slot"]] = None
+                elif "digest" in header:
+                    bodies[header["slot"]] = BodyDigest(*header["digest"])
+                else:
+                    bodies[header["slot"]] = payload
+            elif header["kind"] == "post_data":
+                post_data[header["event_index"]] = payload.decode()
+            elif header["kind"] == "ignored":
+                comm.ignored = True
+
+        for event_index, data in post_data.items():
+            cast(RawEvent, comm.events[event_index]).set_request_post_data(data)
+
+        if bodies:
+            comm.response_bodies = [bodies.get(slot) for slot in range(max(bodies) + 1)]
+
+        return comm
+
+    def iter_communications(
+        self,
+        entries: Iterable[Union[HttpCommunication, InputAction]],
+        index: dict[cdp.network.RequestId, list[RecordLocation]],
+    ) -> Iterator[Union[HttpCommunication, InputAction]]:
+        """Rebuilds the communications lazily. `entries` are the in-memory
+        placeholders kept by the recorder, in recording order."""
+        try:
+            for entry in entries:
+                if isinstance(entry, InputAction) or entry.ignored:
+                    yield entry
+                    continue
+
+                yield self.load_communication(entry.request_id, index.get(entry.request_id, []))
+        finally:
+            self.close()
+
+    def recover_communications(self) -> Iterator[Union[HttpCommunication, InputAction]]:
+        """Rebuilds all the communications only from the log, without the
+        recorder's index. Used to read the capture of a crashed session."""
+        order: list[Union[str, RecordLocation]] = []
+        index: dict[str, list[RecordLocation]] = {}
+        for location, header in self.scan():
+            if header["kind"] == "input":
+                order.append(location)
+                continue
+
+            request_id = header["request_id"]
+            if request_id not in index:
+                index[request_id] = []
+                order.append(request_id)
+            index[request_id].append(location)
+
+        try:
+            for entry in order:
+                if isinstance(entry, RecordLocation):
+                    data = json.loads(self.read_record(entry)[1])
+                    yield InputAction(data["text"], data["selector"], data["timestamp"])
+                else:
+                    yield self.load_communication(entry, index[entry])
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        for file in self._files.values():
+            file.close()
+        self._files = {}
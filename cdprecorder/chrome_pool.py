@@ -0,0 +1,235 @@
+"""
+This module keeps Chrome browsers running between recordings, so that a
+recording doesn't wait for a browser to start.
+
+A browser is ready when its DevTools endpoint answers `/json/version`. The
+pool launches its browsers ahead of time, and waits until they are ready.
+Each recording gets a new browser context in a pooled browser, so the
+cookies, the storage and the cache of the previous recordings are not
+shared. Disposing of a browser context is much faster than restarting the
+browser.
+
+Classes:
+    - PooledBrowser: A browser of the pool, with its DevTools port.
+    - ChromePool: Launches browsers ahead of time, and lends them.
+
+Functions:
+    - wait_for_devtools: Waits until a browser accepts DevTools connections.
+    - open_isolated_target: Opens a page in a new browser context.
+    - close_isolated_target: Disposes of the browser context of a page.
+"""
+
+from __future__ import annotations
+
+import shutil
+import tempfile
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Optional
+
+import pycdp
+import requests
+from pycdp import cdp
+from pycdp.browser import ChromeLauncher
+from twisted.internet import defer, threads
+from twisted.python.failure import Failure
+
+from . import logger
+
+if TYPE_CHECKING:
+    import pycdp.twisted
+
+
+DEFAULT_POOL_BASE_PORT = 9250
+DEFAULT_LAUNCH_TIMEOUT = 30.0
+# A browser is restarted after this many recordings, so the memory it leaks doesn't add up
+DEFAULT_MAX_RECORDINGS = 50
+READINESS_POLL_INTERVAL = 0.05
+
+
+def wait_for_devtools(cdp_url: str, timeout: float) -> None:
+    """Waits until the browser at `cdp_url` accepts DevTools connections.
+    Blocking; run it in a thread."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            requests.get(f"{cdp_url}/json/version", timeout=1).raise_for_status()
+            return
+        except requests.RequestException:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(READINESS_POLL_INTERVAL)
+
+
+async def open_isolated_target(
+    conn: pycdp.twisted.CDPConnection,
+) -> tuple[cdp.browser.BrowserContextID, cdp.target.TargetID]:
+    """Opens a blank page in a new browser context, which shares nothing
+    with the other pages of the browser."""
+    context_id = await conn.execute(cdp.target.create_browser_context())
+    target_id = await conn.execute(cdp.target.create_target("about:blank", browser_context_id=context_id))
+    return context_id, target_id
+
+
+async def close_isolated_target(conn: pycdp.twisted.CDPConnection, context_id: cdp.browser.BrowserContextID) -> None:
+    """Closes the pages of the browser context, and deletes its data."""
+    try:
+        await conn.execute(cdp.target.dispose_browser_context(context_id))
+    except pycdp.exceptions.CDPError as exc:
+        logger.debug("Could not dispose of browser context %s: %s", context_id, exc)
+
+
+@dataclass
+class PooledBrowser:
+    port: int
+    chrome: ChromeLauncher
+    profile_dir: str
+    # Recordings made in this browser
+    recordings: int = 0
+
+    @property
+    def cdp_url(self) -> str:
+        return f"http://localhost:{self.port}"
+
+
+class ChromePool:
+    """Keeps up to `size` Chrome browsers running and ready, each with its
+    own DevTools port and profile.
+
+    `acquire` lends a ready browser, or launches one if none is left. The
+    browsers that are given back with `release` are kept running for the
+    next recordings. A browser that failed, or that made `max_recordings`
+    recordings, is replaced, and the new one is launched in the background.
+
+    Args:
+        binary: The Chrome executable.
+        size: The number of browsers kept running.
+        base_port: The DevTools port of the first browser. The others use the
+            next ports.
+        headless: Run the browsers without windows.
+        launch_timeout: Seconds to wait for a browser to be ready.
+        max_recordings: Recordings after which a browser is restarted.
+    """
+
+    def __init__(
+        self,
+        binary: str,
+        size: int = 1,
+        base_port: int = DEFAULT_POOL_BASE_PORT,
+        headless: bool = False,
+        launch_timeout: float = DEFAULT_LAUNCH_TIMEOUT,
+        max_recordings: int = DEFAULT_MAX_RECORDINGS,
+    ):
+        self.binary = binary
+        self.size = size
+        self.headless = headless
+        self.launch_timeout = launch_timeout
+        self.max_recordings = max_recordings
+
+        self._next_port = base_port
+        self._free_ports: list[int] = []
+        self._idle: list[PooledBrowser] = []
+        self._warming: set[defer.Deferred[Any]] = set()
+        self._closed = False
+
+    @property
+    def idle(self) -> int:
+        return len(self._idle)
+
+    def _take_port(self) -> int:
+        if self._free_ports:
+            return self._free_ports.pop()
+        port = self._next_port
+        self._next_port += 1
+        return port
+
+    async def _launch(self) -> PooledBrowser:
+        port = self._take_port()
+        profile_dir = tempfile.mkdtemp(prefix="cdprecorder-pool-")
+        chrome = ChromeLauncher(
+            binary=self.binary,
+            profile=profile_dir,
+            headless=self.headless,
+            args=[f"--remote-debugging-port={port}", "--no-first-run", "--no-default-browser-check"],
+        )
+        browser = PooledBrowser(port, chrome, profile_dir)
+        start_time = time.monotonic()
+        try:
+            await threads.deferToThread(chrome.launch)  # type: ignore[no-untyped-call]
+            await threads.deferToThread(  # type: ignore[no-untyped-call]
+                wait_for_devtools, browser.cdp_url, self.launch_timeout
+            )
+        except Exception:
+            await self._kill(browser)
+            raise
+
+        logger.debug("Browser on port %d ready in %.2fs", port, time.monotonic() - start_time)
+        return browser
+
+    async def _kill(self, browser: PooledBrowser) -> None:
+        try:
+            await threads.deferToThread(browser.chrome.kill)  # type: ignore[no-untyped-call]
+        finally:
+            shutil.rmtree(browser.profile_dir, ignore_errors=True)
+            self._free_ports.append(browser.port)
+
+    def _warm(self) -> None:
+        """Launches a browser in the background, and makes it idle when it's ready."""
+        warming = defer.ensureDeferred(self._launch())
+        self._warming.add(warming)
+
+        def on_ready(browser: PooledBrowser) -> Optional[defer.Deferred[None]]:
+            self._warming.discard(warming)
+            if self._closed:
+                return defer.ensureDeferred(self._kill(browser))
+            self._idle.append(browser)
+            return None
+
+        def on_error(failure: Failure) -> None:
+            self._warming.discard(warming)
+            logger.error("Could not launch a browser for the pool: %s", failure.getErrorMessage())
+
+        warming.addCallbacks(on_ready, on_error)
+
+    async def start(self) -> None:
+        """Launches the browsers of the pool, and waits until they are ready."""
+        for _ in range(self.size - len(self._idle) - len(self._warming)):
+            self._warm()
+        await defer.DeferredList(list(self._warming))
+
+    async def acquire(self) -> PooledBrowser:
+        """Returns a ready browser. If none is idle, waits for one that is
+        starting, or launches a new one."""
+        if self._closed:
+            raise RuntimeError("The browser pool is closed")
+
+        while not self._idle and self._warming:
+            await defer.DeferredList(list(self._warming), fireOnOneCallback=True)
+        if self._idle:
+            browser = self._idle.pop()
+        else:
+            logger.debug("No browser ready in the pool, launching one")
+            browser = await self._launch()
+        browser.recordings += 1
+        return browser
+
+    async def release(self, browser: PooledBrowser, healthy: bool = True) -> None:
+        """Gives a browser back to the pool. Its browser contexts must be
+        disposed of already. A browser that isn't healthy is replaced."""
+        keep = not self._closed and healthy and browser.recordings < self.max_recordings
+        if keep and len(self._idle) + len(self._warming) < self.size:
+            self._idle.append(browser)
+            return
+
+        await self._kill(browser)
+        if not self._closed and len(self._idle) + len(self._warming) < self.size:
+            self._warm()
+
+    async def close(self) -> None:
+        """Kills the browsers of the pool. The browsers that are lent are
+        killed when they are released."""
+        self._closed = True
+        await defer.DeferredList(list(self._warming))
+        idle, self._idle = self._idle, []
+        for browser in idle:
+            await self._kill(browser)
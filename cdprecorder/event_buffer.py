@@ -0,0 +1,314 @@
+"""
+This module contains an event listener for CDP sessions, that adapts its
+buffer to bursts of events, and counts what happens to them.
+
+pycdp's listeners have a fixed size, and when one is full, the session
+drops the new events with only a log message. Here, a full buffer first
+grows, up to a limit. After that, the events are spilled to a temporary
+file, and read back in order, or, if spilling is disabled, dropped and
+counted.
+
+Classes:
+    - EventBufferStats: Counters of a buffer: events, drops, peak depth
+    and rates.
+    - AdaptiveEventQueue: A FIFO of events that grows and spills instead of
+    dropping. It can be registered as a CDP session listener.
+
+Functions:
+    - listen_adaptive: Listens to events of a session with an
+    AdaptiveEventQueue.
+    - log_buffer_stats: Logs the counters of some buffers.
+    - write_buffer_stats: Writes the counters of some buffers to a JSON file.
+"""
+
+from __future__ import annotations
+
+import collections
+import json
+import pickle
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from typing import IO, TYPE_CHECKING, Any, Generic, Iterable, Optional, TypeVar
+
+import pycdp
+from twisted.internet import defer
+
+from . import logger
+from .raw_events import install_raw_event_hook
+
+if TYPE_CHECKING:
+    import pycdp.twisted
+
+
+T = TypeVar("T")
+
+DEFAULT_CAPACITY = 4096
+# The buffer grows up to this many times its initial capacity, before spilling
+DEFAULT_MAX_GROWTH = 64
+
+
+@dataclass
+class EventBufferStats:
+    name: str
+    capacity: int
+    received: int = 0
+    delivered: int = 0
+    dropped: int = 0
+    spilled: int = 0
+    growths: int = 0
+    peak_depth: int = 0
+    # Most events received in one second
+    peak_events_per_second: int = 0
+    first_event_time: Optional[float] = None
+    last_event_time: Optional[float] = None
+
+    @property
+    def events_per_second(self) -> float:
+        if self.first_event_time is None or self.last_event_time is None:
+            return 0.0
+        elapsed = self.last_event_time - self.first_event_time
+        if elapsed <= 0:
+            return float(self.received)
+        return self.received / elapsed
+
+    def to_json(self) -> dict[str, Any]:
+        data = asdict(self)
+        del data["first_event_time"]
+        del data["last_event_time"]
+        data["events_per_second"] = round(self.events_per_second, 1)
+        return data
+
+
+class AdaptiveEventQueue(Generic[T]):
+    """A FIFO of events, that is iterated asynchronously.
+
+    When the buffer holds `capacity` events, the capacity is doubled, up to
+    `max_capacity`. Then, the new events go to a temporary file, until the
+    consumer catches up. If `spill` is False, they are dropped instead.
+
+    It has the interface of pycdp's CDPEventListener, so it can be added to
+    the listeners of a CDP session. The events of `raw_event_types` are
+    received as RawEvents, if the session's raw event hook is installed.
+
+    The parts of the events that are instances of `keep_in_memory`, e.g.
+    CDP sessions, can't be written to disk. The spilled events refer to
+    them, and they are kept in memory.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        capacity: int = DEFAULT_CAPACITY,
+        max_capacity: Optional[int] = None,
+        spill: bool = True,
+        raw_event_types: Iterable[type] = (),
+        keep_in_memory: tuple[type, ...] = (),
+    ):
+        self.capacity = capacity
+        self.max_capacity = max_capacity if max_capacity is not None else capacity * DEFAULT_MAX_GROWTH
+        self.spill = spill
+        self.stats = EventBufferStats(name, capacity)
+        self.raw_event_types = frozenset(raw_event_types)
+
+        self._events: collections.deque[T] = collections.deque()
+        self._waiting: Optional[defer.Deferred[Optional[T]]] = None
+        self._closed = False
+
+        # Spilled events are read back from `_spill_read_pos`, in the order they were written
+        self._spill_file: Optional[IO[bytes]] = None
+        self._spill_read_pos = 0
+        self._spill_pending = 0
+        self.keep_in_memory = keep_in_memory
+        self._references: dict[int, object] = {}
+
+        self._window_start = 0.0
+        self._window_count = 0
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    @property
+    def depth(self) -> int:
+        return len(self._events) + self._spill_pending
+
+    def _count_received(self) -> None:
+        stats = self.stats
+        now = time.monotonic()
+        stats.received += 1
+        if stats.first_event_time is None:
+            stats.first_event_time = now
+        stats.last_event_time = now
+
+        if now - self._window_start >= 1.0:
+            self._window_start = now
+            self._window_count = 0
+        self._window_count += 1
+        stats.peak_events_per_second = max(stats.peak_events_per_second, self._window_count)
+
+    def put(self, event: T) -> None:
+        if self._closed:
+            raise pycdp.exceptions.CDPEventListenerClosed
+        self._count_received()
+
+        if self._waiting is not None:
+            waiting, self._waiting = self._waiting, None
+            self.stats.delivered += 1
+            waiting.callback(event)
+            return
+
+        if self._spill_pending == 0 and len(self._events) >= self.capacity and self.capacity < self.max_capacity:
+            self.capacity = min(self.capacity * 2, self.max_capacity)
+            self.stats.capacity = self.capacity
+            self.stats.growths += 1
+            logger.debug("Event buffer %s grew to %d events", self.stats.name, self.capacity)
+
+        if self._spill_pending == 0 and len(self._events) < self.capacity:
+            self._events.append(event)
+        elif self.spill:
+            self._spill_event(event)
+        else:
+            if self.stats.dropped == 0:
+                logger.warning("Event buffer %s is full, dropping events", self.stats.name)
+            self.stats.dropped += 1
+            return
+
+        self.stats.peak_depth = max(self.stats.peak_depth, self.depth)
+
+    def _spill_event(self, event: T) -> None:
+        if self._spill_file is None:
+            logger.warning("Event buffer %s is full, spilling events to disk", self.stats.name)
+            self._spill_file = tempfile.TemporaryFile(prefix="cdprecorder-events-")
+        self._spill_file.seek(0, 2)
+        _ReferencingPickler(self._spill_file, self).dump(event)
+        self._spill_pending += 1
+        self.stats.spilled += 1
+
+    def _unspill(self) -> None:
+        """Reads the spilled events back into memory, up to the capacity."""
+        assert self._spill_file is not None
+        self._spill_file.seek(self._spill_read_pos)
+        while self._spill_pending and len(self._events) < self.capacity:
+            self._events.append(_ReferencingUnpickler(self._spill_file, self).load())
+            self._spill_pending -= 1
+        self._spill_read_pos = self._spill_file.tell()
+
+        if self._spill_pending == 0:
+            # Everything was read, so the file can be reused from the start
+            self._spill_file.seek(0)
+            self._spill_file.truncate()
+            self._spill_read_pos = 0
+            self._references.clear()
+
+    def get(self) -> defer.Deferred[Optional[T]]:
+        """Returns the next event, or None if the queue is closed and empty."""
+        if not self._events and self._spill_pending:
+            self._unspill()
+        if self._events:
+            self.stats.delivered += 1
+            return defer.succeed(self._events.popleft())
+        if self._closed:
+            return defer.succeed(None)
+        if self._waiting is not None:
+            raise RuntimeError("Only one consumer can wait for an event")
+
+        self._waiting = defer.Deferred(self._cancel_get)
+        return self._waiting
+
+    def _cancel_get(self, waiting: defer.Deferred[Optional[T]]) -> None:
+        # The timeouts of the recorder cancel the pending reads
+        if self._waiting is waiting:
+            self._waiting = None
+
+    def close(self) -> None:
+        """Stops accepting events. The buffered ones can still be read."""
+        self._closed = True
+        if self._waiting is not None:
+            waiting, self._waiting = self._waiting, None
+            waiting.callback(None)
+
+    def discard(self) -> None:
+        """Closes the queue, and drops the buffered events."""
+        self.close()
+        self._events.clear()
+        self._spill_pending = 0
+        self._references.clear()
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def __aiter__(self) -> AdaptiveEventQueue[T]:
+        return self
+
+    async def __anext__(self) -> T:
+        event = await self.get()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+
+class _ReferencingPickler(pickle.Pickler):
+    def __init__(self, file: IO[bytes], queue: AdaptiveEventQueue[Any]):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.queue = queue
+
+    def persistent_id(self, obj: object) -> Optional[int]:
+        if self.queue.keep_in_memory and isinstance(obj, self.queue.keep_in_memory):
+            self.queue._references[id(obj)] = obj  # pylint: disable=protected-access
+            return id(obj)
+        return None
+
+
+class _ReferencingUnpickler(pickle.Unpickler):
+    def __init__(self, file: IO[bytes], queue: AdaptiveEventQueue[Any]):
+        super().__init__(file)
+        self.queue = queue
+
+    def persistent_load(self, pid: Any) -> object:
+        return self.queue._references[pid]  # pylint: disable=protected-access
+
+
+def listen_adaptive(
+    session: pycdp.twisted.CDPBase,
+    event_types: Iterable[type],
+    name: str,
+    capacity: int = DEFAULT_CAPACITY,
+    max_capacity: Optional[int] = None,
+    spill: bool = True,
+    raw_event_types: Iterable[type] = (),
+) -> AdaptiveEventQueue[Any]:
+    """Like session.listen, but with an AdaptiveEventQueue. The queue is
+    closed by session.close_listeners.
+
+    The events of `raw_event_types` are received unparsed, as RawEvents, if
+    the session supports it.
+    """
+    if raw_event_types and not install_raw_event_hook(session):
+        logger.debug("Session %s can't pass raw events, they are parsed", name)
+        raw_event_types = ()
+    queue: AdaptiveEventQueue[Any] = AdaptiveEventQueue(name, capacity, max_capacity, spill, raw_event_types)
+    for event_type in event_types:
+        session._listeners[event_type].add(queue)  # type: ignore[attr-defined] # pylint: disable=protected-access
+    return queue
+
+
+def log_buffer_stats(buffers: Iterable[AdaptiveEventQueue[Any]]) -> None:
+    for buffer in buffers:
+        stats = buffer.stats
+        logger.info(
+            "Event buffer %s: %d events, %.1f/s (peak %d/s), peak depth %d of %d, %d spilled, %d dropped",
+            stats.name,
+            stats.received,
+            stats.events_per_second,
+            stats.peak_events_per_second,
+            stats.peak_depth,
+            stats.capacity,
+            stats.spilled,
+            stats.dropped,
+        )
+
+
+def write_buffer_stats(path: str, buffers: Iterable[AdaptiveEventQueue[Any]]) -> None:
+    with open(path, "w", encoding="utf8") as file:
+        json.dump([buffer.stats.to_json() for buffer in buffers], file, indent=2)
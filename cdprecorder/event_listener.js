@@ -34,10 +34,80 @@ getElementSelector = (target) => {
     return selector;
 }
 
+// Counters of the recorder's own work in the page, read by Python at the end
+// of the recording. They're lost with the page, so they're also sent to
+// Python when it's left, and counted from zero again. The times are in
+// milliseconds.
+const recorderStats = {
+    events: 0,
+    handlerTime: 0,
+    maxHandlerTime: 0,
+    selectorCacheHits: 0,
+    selectorCacheMisses: 0,
+    selectorInvalidations: 0,
+    observerTime: 0,
+    batches: 0,
+    sendTime: 0,
+};
+
+// The selector of each element among its siblings, from getElementSelector.
+// It changes only with the attributes of the element, or with its siblings,
+// so it's forgotten when the mutation observer sees these change.
+const selectorCache = new WeakMap();
+const observedRoots = new WeakSet();
+
+forgetSelector = (element) => {
+    if (selectorCache.delete(element)) {
+        recorderStats.selectorInvalidations++;
+    }
+}
+
+invalidateSelectors = (mutations) => {
+    const start = performance.now();
+    for (const mutation of mutations) {
+        if (mutation.type == 'attributes') {
+            forgetSelector(mutation.target);
+            continue;
+        }
+        // The indexes of the children may have changed
+        for (const child of mutation.target.children) {
+            forgetSelector(child);
+        }
+    }
+    recorderStats.observerTime += performance.now() - start;
+}
+
+const selectorObserver = new MutationObserver(invalidateSelectors);
+
+observeRoot = (root) => {
+    if (observedRoots.has(root)) {
+        return;
+    }
+    observedRoots.add(root);
+    selectorObserver.observe(root, {subtree: true, childList: true, attributes: true});
+}
+observeRoot(document);
+
+getCachedElementSelector = (target) => {
+    let selector = selectorCache.get(target);
+    if (selector === undefined) {
+        recorderStats.selectorCacheMisses++;
+        selector = getElementSelector(target);
+        selectorCache.set(target, selector);
+    } else {
+        recorderStats.selectorCacheHits++;
+    }
+
+    return selector;
+}
+
 getSelectorToRoot = (target) => {
+    // The page may have changed the DOM since the observer was last called
+    invalidateSelectors(selectorObserver.takeRecords());
+
     let selector = "";
 
-    selector += getElementSelector(target);
+    selector += getCachedElementSelector(target);
     target = target.parentNode;
     while (target) {
         if (!target.tagName) {
@@ -45,39 +115,146 @@ getSelectorToRoot = (target) => {
                 break
             }
             // If shadow root
+            observeRoot(target);
             target = target.host;
         }
-        selector = getElementSelector(target) + '>' + selector;
+        selector = getCachedElementSelector(target) + '>' + selector;
         target = target.parentNode;
     }
 
     return selector;
 }
-addEventListener('click', (event) => {
+
+timeHandler = (handler) => (event) => {
+    const start = performance.now();
+    try {
+        handler(event);
+    } finally {
+        const elapsed = performance.now() - start;
+        recorderStats.events++;
+        recorderStats.handlerTime += elapsed;
+        recorderStats.maxHandlerTime = Math.max(recorderStats.maxHandlerTime, elapsed);
+    }
+}
+
+// The events are sent to Python in batches, because each call of
+// sendRecordedEvent is a CDP message. A batch is sent when no event was
+// recorded for FLUSH_DELAY_MS, when the page is idle, at most
+// MAX_FLUSH_DELAY_MS after its first event, and right away before the page
+// may send the typed values: on clicks, submits, Enter, page hide, and when
+// send_hooks.js sees the page send a request.
+const FLUSH_DELAY_MS = 300;
+const MAX_FLUSH_DELAY_MS = 2000;
+const IDLE_TIMEOUT_MS = 500;
+const MAX_BATCH_SIZE = 100;
+
+let pendingEvents = [];
+let flushTimer = null;
+let maxFlushTimer = null;
+
+takePendingEvents = () => {
+    clearTimeout(flushTimer);
+    clearTimeout(maxFlushTimer);
+    flushTimer = null;
+    maxFlushTimer = null;
+    const events = pendingEvents;
+    pendingEvents = [];
+    return events;
+}
+
+flushRecordedEvents = () => {
+    const events = takePendingEvents();
+    if (events.length == 0) {
+        return;
+    }
+
+    const start = performance.now();
+    sendRecordedEvent(JSON.stringify(events));
+    recorderStats.batches++;
+    recorderStats.sendTime += performance.now() - start;
+}
+
+// Returns the events that weren't sent, without sending them. Python reads
+// them this way when the recording stops, as it doesn't wait for more calls.
+takeRecordedEvents = () => JSON.stringify(takePendingEvents());
+
+flushWhenIdle = () => {
+    if (window.requestIdleCallback) {
+        requestIdleCallback(flushRecordedEvents, {timeout: IDLE_TIMEOUT_MS});
+    } else {
+        flushRecordedEvents();
+    }
+}
+
+recordEvent = (recordedEvent) => {
+    if (recordedEvent.event == 'input') {
+        // Only the last value typed in an element is kept in a batch
+        const lastInput = pendingEvents.findLastIndex(e => e.event == 'input');
+        if (lastInput != -1 && pendingEvents[lastInput].selector == recordedEvent.selector) {
+            pendingEvents.splice(lastInput, 1);
+        }
+    }
+    pendingEvents.push(recordedEvent);
+
+    if (pendingEvents.length >= MAX_BATCH_SIZE) {
+        flushRecordedEvents();
+        return;
+    }
+    clearTimeout(flushTimer);
+    flushTimer = setTimeout(flushWhenIdle, FLUSH_DELAY_MS);
+    if (maxFlushTimer === null) {
+        maxFlushTimer = setTimeout(flushRecordedEvents, MAX_FLUSH_DELAY_MS);
+    }
+}
+
+// Registered for the capture phase, to run before the page's own listeners
+addEventListener('click', timeHandler((event) => {
     // Try to get the original target, even if in shadow DOM
     const timestamp = event.timeStamp;
     const target = event.composedPath()[0];
     const selector = getSelectorToRoot(target);
 
-    sendRecordedEvent(JSON.stringify({"event": "click", timestamp, selector}));
-});
+    recordEvent({"event": "click", timestamp, selector});
+    flushRecordedEvents();
+}), true);
 
-addEventListener('keypress', (event) => {
+addEventListener('keypress', timeHandler((event) => {
     const charCode = event.charCode;
     const timestamp = event.timeStamp;
     const target = event.composedPath()[0];
     const selector = getSelectorToRoot(target);
     const value = target.value;
 
-    sendRecordedEvent(JSON.stringify({"event": "keypress", timestamp, selector, value, charCode}));
-});
+    recordEvent({"event": "keypress", timestamp, selector, value, charCode});
+}));
 
-addEventListener('input', (event) => {
+addEventListener('input', timeHandler((event) => {
     const target = event.composedPath()[0];
     const selector = getSelectorToRoot(target);
     const value = target.value;
     const timestamp = event.timeStamp;
 
-    sendRecordedEvent(JSON.stringify({"event": "input", timestamp, selector, value}));
-});
+    recordEvent({"event": "input", timestamp, selector, value});
+}));
 
+addEventListener('keydown', (event) => {
+    if (event.key == 'Enter') {
+        flushRecordedEvents();
+    }
+}, true);
+addEventListener('submit', flushRecordedEvents, true);
+document.addEventListener('cdprecorder-flush', flushRecordedEvents);
+addEventListener('pagehide', () => {
+    flushRecordedEvents();
+    sendRecordedEvent(JSON.stringify([{"event": "stats", "stats": recorderStats}]));
+    // The page may be shown again from the back-forward cache
+    for (const key in recorderStats) {
+        recorderStats[key] = 0;
+    }
+});
+addEventListener('beforeunload', flushRecordedEvents);
+addEventListener('visibilitychange', () => {
+    if (document.visibilityState == 'hidden') {
+        flushRecordedEvents();
+    }
+});
@@ -0,0 +1,432 @@
+"""
+This module records many scripted flows in parallel, each one in its own
+headless Chrome, without the control window. Each flow is written to its
+own capture log.
+
+Usage:
+    python3 -m cdprecorder.farm flows.json --output captures
+
+The flows file is a JSON list of flows:
+    [
+        {
+            "name": "login",
+            "start_url": "https://example.com/login",
+            "timeout": 60,
+            "steps": [
+                {"action": "type", "selector": "#user", "value": "alice"},
+                {"action": "click", "selector": "button[type=submit]"},
+                {"action": "wait", "seconds": 2}
+            ]
+        }
+    ]
+
+Classes:
+    - FlowStep: One action of a flow: navigate, click, type, evaluate or wait.
+    - Flow: A start URL and the steps that drive the page from there.
+    - FlowResult: Where a flow was recorded, or why it failed.
+    - BrowserScheduler: Limits the number of browsers that run at the same
+    time, by the CPUs and the memory of the machine.
+    - RecordingFarm: Records flows in parallel, in headless browsers.
+
+Functions:
+    - load_flows: Reads the flows from a JSON file.
+    - run_flow_steps: Drives a page through the steps of a flow.
+"""
+
+from __future__ import annotations
+
+import argparse
+import dataclasses
+import json
+import math
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+from collections import deque
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Iterable, Optional
+
+from pycdp import cdp
+from pycdp.browser import ChromeLauncher
+from twisted.internet import defer, task
+
+from . import configure_root_logger, enable_logger, filters, logger
+from .backends import EventLoopBackend, get_backend
+from .chrome_pool import ChromePool, wait_for_devtools
+from .recorder import CHROME_BINARY, RecorderOptions, RecordingScript, record
+
+if TYPE_CHECKING:
+    import pycdp.twisted
+
+
+# A headless Chrome with one recorded page usually needs about this much
+DEFAULT_MEMORY_PER_BROWSER = 512 * 1024 * 1024
+DEFAULT_CPUS_PER_BROWSER = 1.0
+DEFAULT_BASE_PORT = 9300
+# How often the scheduler checks if the machine has room for another browser
+LOAD_POLL_INTERVAL = 1.0
+STEP_POLL_INTERVAL = 0.1
+# Names the capture log of each run, in the directory of the flow
+RUN_NAME_FORMAT = "%Y%m%d-%H%M%S"
+
+FLOW_ACTIONS = frozenset({"navigate", "click", "type", "evaluate", "wait"})
+
+
+class FlowError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class FlowStep:
+    action: str
+    # CSS selector of the element to click or type into
+    selector: Optional[str] = None
+    # URL to navigate to, text to type, or JavaScript expression to evaluate
+    value: Optional[str] = None
+    # Seconds to wait, for the `wait` action
+    seconds: float = 0.0
+    # Seconds to wait for the element or the page load
+    timeout: float = 10.0
+
+    def __post_init__(self) -> None:
+        if self.action not in FLOW_ACTIONS:
+            raise ValueError(f"Unknown flow action {self.action!r}")
+        if self.action in ("click", "type") and self.selector is None:
+            raise ValueError(f"The {self.action} action needs a selector")
+        if self.action in ("navigate", "type", "evaluate") and self.value is None:
+            raise ValueError(f"The {self.action} action needs a value")
+
+
+@dataclass(frozen=True)
+class Flow:
+    name: str
+    start_url: str
+    steps: tuple[FlowStep, ...] = ()
+    # Seconds after which the recording stops, even if the steps didn't end
+    timeout: float = 60.0
+
+    @classmethod
+    def from_json(cls, data: dict[str, Any]) -> Flow:
+        steps = tuple(FlowStep(**step) for step in data.get("steps", ()))
+        return cls(data["name"], data["start_url"], steps, float(data.get("timeout", 60.0)))
+
+    @property
+    def directory_name(self) -> str:
+        return re.sub(r"[^\w.-]+", "_", self.name).strip("._") or "flow"
+
+
+@dataclass(frozen=True)
+class FlowResult:
+    flow: Flow
+    capture_dir: str
+    duration: float
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+
+def load_flows(path: str) -> list[Flow]:
+    with open(path, encoding="utf8") as file:
+        data = json.load(file)
+
+    flows = [Flow.from_json(item) for item in data]
+    names = [flow.directory_name for flow in flows]
+    if len(set(names)) != len(names):
+        raise ValueError("The flow names must be unique")
+    return flows
+
+
+async def _evaluate(session: pycdp.twisted.CDPSession, expression: str, user_gesture: bool = False) -> Any:
+    result, exception = await session.execute(
+        cdp.runtime.evaluate(expression, return_by_value=True, await_promise=True, user_gesture=user_gesture)
+    )
+    if exception is not None:
+        raise FlowError(f"{expression!r} raised: {exception.text}")
+    return result.value
+
+
+async def _wait_until(
+    session: pycdp.twisted.CDPSession, expression: str, timeout: float, backend: EventLoopBackend
+) -> None:
+    deadline = time.monotonic() + timeout
+    while not await _evaluate(session, expression):
+        if time.monotonic() > deadline:
+            raise FlowError(f"Timed out waiting for {expression!r}")
+        await backend.sleep(STEP_POLL_INTERVAL)
+
+
+async def _wait_for_element(session: pycdp.twisted.CDPSession, step: FlowStep, backend: EventLoopBackend) -> str:
+    """Waits for the element of the step, and returns the JavaScript
+    expression that finds it."""
+    element = f"document.querySelector({json.dumps(step.selector)})"
+    await _wait_until(session, f"{element} !== null", step.timeout, backend)
+    return element
+
+
+async def run_flow_steps(
+    session: pycdp.twisted.CDPSession, steps: Iterable[FlowStep], backend: Optional[EventLoopBackend] = None
+) -> None:
+    """Drives the page through the steps. The clicks and the typed text go
+    through the page's DOM, so the recorder sees them as user input. The
+    waits run on `backend`, by default Twisted's reactor."""
+    backend = backend if backend is not None else get_backend()
+    for step in steps:
+        logger.debug("Flow step: %s", step)
+        if step.action == "navigate":
+            await session.execute(cdp.page.navigate(str(step.value)))
+            await _wait_until(session, "document.readyState === 'complete'", step.timeout, backend)
+        elif step.action == "click":
+            element = await _wait_for_element(session, step, backend)
+            await _evaluate(session, f"{element}.click()", user_gesture=True)
+        elif step.action == "type":
+            element = await _wait_for_element(session, step, backend)
+            await _evaluate(session, f"{element}.focus()")
+            # Inserted text fires trusted input events, like typing does
+            await session.execute(cdp.input_.insert_text(str(step.value)))
+        elif step.action == "evaluate":
+            await _evaluate(session, str(step.value), user_gesture=True)
+        elif step.action == "wait":
+            await backend.sleep(step.seconds)
+
+
+def available_memory() -> Optional[int]:
+    """Returns the bytes of memory available to new processes, or None if
+    it can't be found on this platform."""
+    try:
+        with open("/proc/meminfo", encoding="ascii") as file:
+            for line in file:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class BrowserScheduler:
+    """Limits the number of browsers that run at the same time.
+
+    The limit is computed once, from the number of CPUs and the available
+    memory. Before each browser starts, the scheduler also waits while the
+    machine is overloaded, unless no browser is running.
+    """
+
+    def __init__(
+        self,
+        max_browsers: Optional[int] = None,
+        cpus_per_browser: float = DEFAULT_CPUS_PER_BROWSER,
+        memory_per_browser: int = DEFAULT_MEMORY_PER_BROWSER,
+        backend: Optional[EventLoopBackend] = None,
+    ):
+        self.backend = backend if backend is not None else get_backend()
+        self.cpus_per_browser = cpus_per_browser
+        self.memory_per_browser = memory_per_browser
+        self.cpu_count = os.cpu_count() or 1
+
+        limit = max(1, math.floor(self.cpu_count / cpus_per_browser))
+        memory = available_memory()
+        if memory is not None:
+            limit = min(limit, max(1, memory // memory_per_browser))
+        if max_browsers is not None:
+            limit = min(limit, max_browsers)
+        self.limit = max(1, limit)
+
+        self.running = 0
+        # Browsers that may start, and the recordings that wait for one
+        self._free = self.limit
+        self._waiters: deque[Any] = deque()
+
+    def is_overloaded(self) -> bool:
+        memory = available_memory()
+        if memory is not None and memory < self.memory_per_browser:
+            return True
+        if hasattr(os, "getloadavg"):
+            return os.getloadavg()[0] > self.cpu_count
+        return False
+
+    async def acquire(self) -> None:
+        while self._free == 0:
+            waiter = self.backend.create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self._free -= 1
+        while self.running > 0 and self.is_overloaded():
+            await self.backend.sleep(LOAD_POLL_INTERVAL)
+        self.running += 1
+
+    def release(self) -> None:
+        self.running -= 1
+        self._free += 1
+        if self._waiters:
+            self.backend.set_result(self._waiters.popleft())
+
+
+class RecordingFarm:
+    """Records flows in parallel. Each flow runs in a new headless Chrome,
+    with its own DevTools port and profile, and is written to its own
+    capture log, in `output_dir/<flow name>/<run time>`. So each run keeps
+    the capture logs of the previous ones.
+
+    With a browser pool, the flows run in new browser contexts of the
+    pool's browsers instead, which are kept running between flows.
+
+    Args:
+        output_dir: The directory of the capture logs.
+        scheduler: Limits the number of browsers. By default, by the CPUs and
+            the memory of the machine.
+        options: The options of the recordings. The start URL, the port,
+            the capture directory and the timeout are set for each flow.
+        urlfilter: Shared by all the recordings. If None, the cached filter
+            list is loaded once.
+        chrome_pool: The browsers to record in. If None, each flow launches
+            its own browser.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        scheduler: Optional[BrowserScheduler] = None,
+        options: Optional[RecorderOptions] = None,
+        urlfilter: Optional[filters.URLFilter] = None,
+        base_port: int = DEFAULT_BASE_PORT,
+        launch_timeout: float = 30.0,
+        chrome_pool: Optional[ChromePool] = None,
+    ):
+        self.output_dir = output_dir
+        self.options = options if options is not None else RecorderOptions("")
+        self.backend = get_backend(self.options.backend)
+        self.scheduler = scheduler if scheduler is not None else BrowserScheduler(backend=self.backend)
+        self.urlfilter = urlfilter
+        self.launch_timeout = launch_timeout
+        self.chrome_pool = chrome_pool
+        # One port for each browser that may run at the same time
+        self._free_ports = list(range(base_port + self.scheduler.limit - 1, base_port - 1, -1))
+
+    def _flow_options(self, flow: Flow, port: int, capture_dir: str) -> RecorderOptions:
+        return dataclasses.replace(
+            self.options,
+            start_url=flow.start_url,
+            cdp_port=port,
+            fail_if_no_connection=True,
+            capture_dir=capture_dir,
+            show_control_window=False,
+            record_timeout=flow.timeout,
+        )
+
+    async def _record_in_new_browser(self, flow: Flow, capture_dir: str, script: RecordingScript) -> None:
+        port = self._free_ports.pop()
+        profile_dir = tempfile.mkdtemp(prefix="cdprecorder-profile-")
+        chrome = ChromeLauncher(
+            binary=self.options.binary,
+            profile=profile_dir,
+            headless=True,
+            args=[f"--remote-debugging-port={port}"],
+        )
+        launched = False
+        try:
+            await self.backend.run_in_thread(chrome.launch)
+            launched = True
+            await self.backend.run_in_thread(wait_for_devtools, f"http://localhost:{port}", self.launch_timeout)
+            await record(self._flow_options(flow, port, capture_dir), self.urlfilter, script)
+        finally:
+            if launched:
+                await self.backend.run_in_thread(chrome.kill)
+            shutil.rmtree(profile_dir, ignore_errors=True)
+            self._free_ports.append(port)
+
+    def _new_capture_dir(self, flow: Flow, run_name: str) -> str:
+        """Creates the empty directory of a new capture log of the flow,
+        before any browser starts."""
+        base_dir = os.path.join(self.output_dir, flow.directory_name, run_name)
+        capture_dir = base_dir
+        suffix = 1
+        while True:
+            try:
+                os.makedirs(capture_dir)
+                return capture_dir
+            except FileExistsError:
+                # Another run started in the same second
+                capture_dir = f"{base_dir}-{suffix}"
+                suffix += 1
+
+    async def record_flow(self, flow: Flow, run_name: Optional[str] = None) -> FlowResult:
+        """Records the flow in `output_dir/<flow name>/<run_name>`. If
+        `run_name` is None, it's the current time."""
+        run_name = run_name if run_name is not None else time.strftime(RUN_NAME_FORMAT)
+        capture_dir = self._new_capture_dir(flow, run_name)
+        await self.scheduler.acquire()
+        start_time = time.monotonic()
+        error = None
+
+        async def script(session: pycdp.twisted.CDPSession) -> None:
+            await run_flow_steps(session, flow.steps, self.backend)
+
+        try:
+            if self.chrome_pool is not None:
+                options = self._flow_options(flow, self.options.cdp_port, capture_dir)
+                await record(options, self.urlfilter, script, chrome_pool=self.chrome_pool)
+            else:
+                await self._record_in_new_browser(flow, capture_dir, script)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            logger.exception("Flow %s failed", flow.name)
+            error = f"{exc.__class__.__name__}: {exc}"
+        finally:
+            self.scheduler.release()
+
+        duration = time.monotonic() - start_time
+        logger.info("Flow %s recorded in %.1fs%s", flow.name, duration, f", with error {error}" if error else "")
+        return FlowResult(flow, capture_dir, duration, error)
+
+    async def run(self, flows: Iterable[Flow]) -> list[FlowResult]:
+        """Records all the flows, and returns their results in the same
+        order. A failed flow doesn't stop the others. The capture logs of the
+        flows are named after the time the run started."""
+        run_name = time.strftime(RUN_NAME_FORMAT)
+        os.makedirs(self.output_dir, exist_ok=True)
+        if self.urlfilter is None:
+            self.urlfilter = await filters.load_url_filter()
+        if self.chrome_pool is not None:
+            await self.chrome_pool.start()
+
+        tasks = [self.backend.spawn(self.record_flow(flow, run_name)) for flow in flows]
+        return [await flow_task for flow_task in tasks]
+
+
+async def _main(reactor_: object, argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(description="Records scripted flows in parallel, in headless Chrome.")
+    parser.add_argument("flows", help="JSON file with the flows")
+    parser.add_argument("-o", "--output", default="captures", help="directory of the capture logs")
+    parser.add_argument("-n", "--max-browsers", type=int, default=None, help="maximum number of browsers at once")
+    parser.add_argument("--base-port", type=int, default=DEFAULT_BASE_PORT, help="first DevTools port")
+    parser.add_argument(
+        "--reuse-browsers",
+        action="store_true",
+        help="keep the browsers running between flows, and record each flow in a new browser context",
+    )
+    args = parser.parse_args(argv)
+
+    enable_logger()
+    configure_root_logger(stream=sys.stdout)
+
+    scheduler = BrowserScheduler(args.max_browsers)
+    chrome_pool = None
+    if args.reuse_browsers:
+        chrome_pool = ChromePool(CHROME_BINARY, scheduler.limit, args.base_port, headless=True)
+    farm = RecordingFarm(args.output, scheduler, base_port=args.base_port, chrome_pool=chrome_pool)
+    logger.info("Recording with up to %d browsers", farm.scheduler.limit)
+    try:
+        results = await farm.run(load_flows(args.flows))
+    finally:
+        if chrome_pool is not None:
+            await chrome_pool.close()
+    for result in results:
+        status = "ok" if result.ok else f"failed: {result.error}"
+        print(f"{result.flow.name}: {status} ({result.duration:.1f}s) -> {result.capture_dir}")
+
+
+if __name__ == "__main__":
+    task.react(lambda reactor_: defer.ensureDeferred(_main(reactor_, sys.argv[1:])))
@@ -1,19 +1,188 @@
 """
 This module contains the URLFilter class, that supports adblock filters.
+
+The filter list is cached on disk, and revalidated with conditional requests
+(ETag / If-Modified-Since). The recorder starts with the cached list, even if
+it is stale, and refreshes it in the background.
+
+Classes:
+    - URLFilter: Adblock rules, by default from easylist.txt.
+    - FilterListCache: The on-disk cache of a filter list.
+
+Functions:
+    - load_url_filter: Returns a URLFilter without waiting for the network,
+    if a cached list is available.
 """
 
+from __future__ import annotations
+
+import json
+import os
+import time
+from typing import Any, Iterable, Optional
+
 import requests
 from adblockparser import AdblockRules
+from twisted.internet import defer, threads
+
+from . import logger
+from .url_matcher import URLMatcher
 
 EASYLIST_URL = "https://easylist.to/easylist/easylist.txt"
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "cdprecorder")
+# After this many seconds, the cached list is revalidated
+DEFAULT_CACHE_MAX_AGE = 24 * 60 * 60
+
+
+def download_rules(url: str = EASYLIST_URL) -> list[str]:
+    res = requests.get(url, timeout=10)
+    res.raise_for_status()
+    return res.text.split("\n")
 
 
 class URLFilter(AdblockRules):
-    """Downloads a URL list, by default, the easylist.txt used by all
-    adblockers."""
+    """Adblock rules. If no rules are given, it downloads a URL list, by
+    default, the easylist.txt used by all adblockers.
+
+    URLs without options are matched by a URLMatcher, which is much faster
+    than AdblockRules, and gives the same result."""
+
+    def __init__(self, raw_rules: Optional[Iterable[str]] = None) -> None:
+        if raw_rules is None:
+            raw_rules = download_rules()
+        super().__init__(list(raw_rules))
+        self.matcher = URLMatcher(self.rules)
+
+    def should_block(self, url: str, options: Optional[dict[str, Any]] = None) -> bool:
+        if options:
+            return bool(super().should_block(url, options))
+        return self.matcher.should_block(url)
+
+    def supported_rule_lines(self) -> list[str]:
+        """Returns the lines of the rules that were kept. The others, like
+        element hiding rules, are dropped by AdblockRules anyway."""
+        return [rule.raw_rule_text for rule in self.rules]
+
+
+class FilterListCache:
+    """Keeps a filter list on disk, with the validators of its last
+    download. Only the supported rules are stored, so they parse faster."""
+
+    def __init__(self, url: str = EASYLIST_URL, directory: str = DEFAULT_CACHE_DIR):
+        self.url = url
+        self.directory = directory
+        name = os.path.basename(url) or "filters.txt"
+        self.rules_path = os.path.join(directory, name)
+        self.meta_path = os.path.join(directory, name + ".json")
+
+    def load_meta(self) -> dict[str, str | float]:
+        try:
+            with open(self.meta_path, encoding="utf8") as file:
+                meta: dict[str, str | float] = json.load(file)
+            return meta
+        except (OSError, ValueError):
+            return {}
+
+    def _save_meta(self, meta: dict[str, str | float]) -> None:
+        tmp_path = self.meta_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as file:
+            json.dump(meta, file)
+        os.replace(tmp_path, self.meta_path)
 
-    def __init__(self) -> None:
-        res = requests.get(EASYLIST_URL, timeout=10)
+    def load_rules(self) -> Optional[list[str]]:
+        try:
+            with open(self.rules_path, encoding="utf8") as file:
+                return file.read().split("\n")
+        except OSError:
+            return None
+
+    def _save_rules(self, lines: list[str]) -> None:
+        tmp_path = self.rules_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf8") as file:
+            file.write("\n".join(lines))
+        os.replace(tmp_path, self.rules_path)
+
+    def age(self) -> Optional[float]:
+        """Seconds since the list was last validated, or None if it isn't
+        cached."""
+        fetched_at = self.load_meta().get("fetched_at")
+        if not isinstance(fetched_at, float) or not os.path.exists(self.rules_path):
+            return None
+        return time.time() - fetched_at
+
+    def refresh(self, timeout: int = 10) -> Optional[URLFilter]:
+        """Revalidates the cached list. Blocking; run it in a thread.
+
+        Returns:
+            A URLFilter with the new rules, or None if the cached list is
+            still valid.
+        """
+        meta = self.load_meta()
+        headers = {}
+        if os.path.exists(self.rules_path):
+            if isinstance(meta.get("etag"), str):
+                headers["If-None-Match"] = str(meta["etag"])
+            if isinstance(meta.get("last_modified"), str):
+                headers["If-Modified-Since"] = str(meta["last_modified"])
+
+        res = requests.get(self.url, headers=headers, timeout=timeout)
         res.raise_for_status()
-        raw_rules = res.text.split("\n")
-        super().__init__(raw_rules)
+
+        os.makedirs(self.directory, exist_ok=True)
+        meta["fetched_at"] = time.time()
+        if res.status_code == 304:
+            self._save_meta(meta)
+            return None
+
+        urlfilter = URLFilter(res.text.split("\n"))
+        self._save_rules(urlfilter.supported_rule_lines())
+        meta.pop("etag", None)
+        meta.pop("last_modified", None)
+        if "ETag" in res.headers:
+            meta["etag"] = res.headers["ETag"]
+        if "Last-Modified" in res.headers:
+            meta["last_modified"] = res.headers["Last-Modified"]
+        self._save_meta(meta)
+
+        return urlfilter
+
+
+async def _refresh_in_background(cache: FilterListCache, urlfilter: URLFilter) -> None:
+    try:
+        new_filter = await threads.deferToThread(cache.refresh)  # type: ignore[no-untyped-call]
+    except (requests.RequestException, OSError) as exc:
+        logger.warning("Could not refresh the filter list %s: %s", cache.url, exc)
+        return
+
+    if new_filter is not None:
+        # Swapped in the reactor thread, so no event sees a half updated filter
+        urlfilter.__dict__.update(new_filter.__dict__)
+        logger.debug("Filter list %s updated", cache.url)
+
+
+async def load_url_filter(cache: Optional[FilterListCache] = None, max_age: float = DEFAULT_CACHE_MAX_AGE) -> URLFilter:
+    """Returns a URLFilter with the cached rules, even if they are stale.
+    Stale rules are refreshed in the background, and the returned filter is
+    updated in place. Only if nothing is cached, the list is downloaded
+    before returning. If that fails too, the filter has no rules."""
+    if cache is None:
+        cache = FilterListCache()
+
+    lines = cache.load_rules()
+    if lines is None:
+        try:
+            downloaded: Optional[URLFilter] = await threads.deferToThread(cache.refresh)  # type: ignore[no-untyped-call]
+        except (requests.RequestException, OSError) as exc:
+            logger.warning("Could not download the filter list %s, no URL will be filtered: %s", cache.url, exc)
+            return URLFilter([])
+        if downloaded is not None:
+            return downloaded
+        lines = cache.load_rules() or []
+
+    urlfilter: URLFilter = await threads.deferToThread(URLFilter, lines)  # type: ignore[no-untyped-call]
+
+    age = cache.age()
+    if age is None or age > max_age:
+        defer.ensureDeferred(_refresh_in_background(cache, urlfilter))
+
+    return urlfilter
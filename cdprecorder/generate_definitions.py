@@ -4,7 +4,7 @@ import ast
 import inspect
 from typing import TYPE_CHECKING
 
-from . import action, datasource, datatarget, util
+from . import action, datasource, datatarget, replay, util
 
 if TYPE_CHECKING:
     import types
@@ -26,11 +26,16 @@ if TYPE_CHECKING:
 
 
 IMPORTS = """from __future__ import annotations
+import copy
 import re
 import requests
+import threading
+import time
 import urllib
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from requests import Session
+from requests.adapters import HTTPAdapter
 from abc import ABC, abstractmethod
 
 
@@ -113,17 +118,19 @@ def remove_annotations_from_ast(ast_obj: ast.AST) -> None:
         if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
             node.returns = None
 
-        if not hasattr(node, "body"):
+        # The body of a lambda is an expression
+        body = getattr(node, "body", None)
+        if not isinstance(body, list):
             continue
 
-        for idx, child in enumerate(node.body):
+        for idx, child in enumerate(body):
             if not isinstance(child, ast.AnnAssign):
                 continue
             if child.value is None:
                 continue
             new_node = ast.Assign([child.target], child.value)
             ast.copy_location(new_node, child)
-            node.body[idx] = new_node
+            body[idx] = new_node
 
 
 def remove_docstrings_from_ast(ast_obj: ast.AST) -> None:
@@ -221,6 +228,14 @@ def generate_action_functions() -> str:
     return get_source_code(action.response_action_from_python_response) + "\n\n"
 
 
+def generate_replay_definitions() -> str:
+    content = ""
+    for obj in get_module_level_classes(replay):
+        content += get_source_code(obj) + "\n\n"
+
+    return content
+
+
 def generate_util_definitions() -> str:
     content = ""
     for obj in get_module_level_classes(util):
@@ -240,6 +255,7 @@ def generate_definitions() -> str:
     content += generate_datasource_definitions()
     content += generate_datatarget_definitions()
     content += generate_action_functions()
+    content += generate_replay_definitions()
 
     content = content.rstrip()
 
@@ -19,14 +19,7 @@ REQUEST_ACTION_CONSTRUCTION_TEMPLATE = """action_{request_index} = RequestAction
     has_response={has_response!r},
 )"""
 
-REQUEST_SENDING_TEMPLATE = """prepared_request_{request_index} = requests.Request(
-    method={method!r},
-    url={url!r},
-    headers={action_var}.headers,
-    data={action_var}.body,
-    cookies={action_var}.cookies_to_dict(),
-).prepare()
-response_{request_index} = Session().send(prepared_request_{request_index}, allow_redirects=False)"""
+REQUEST_SENDING_TEMPLATE = """response_{request_index} = replay.send({action_var})"""
 
 
 def indent_lines(lines: str, spaces: int = 4) -> str:
@@ -83,12 +76,7 @@ def generate_python_request_action(request_index: int, action: RequestAction) ->
 def generate_python_request(request_index: int, action: RequestAction) -> str:
     action_var = f"action_{request_index}"
 
-    content = REQUEST_SENDING_TEMPLATE.format(
-        request_index=request_index,
-        method=action.method,
-        url=action.url,
-        action_var=action_var,
-    )
+    content = REQUEST_SENDING_TEMPLATE.format(request_index=request_index, action_var=action_var)
     if action.has_response:
         content += f"\nactions.append(response_action_from_python_response(response_{request_index}))"
     return content
@@ -107,7 +95,7 @@ def generate_request_bodies(actions: list[HttpAction]) -> str:
 
 
 def generate_python_actions(actions: list[HttpAction]) -> str:
-    lines = "actions = []\n\n"
+    lines = "replay = ReplayEngine()\nactions = []\n\n"
     for index, action in enumerate(actions):
         if isinstance(action, RequestAction):
             action_construction = generate_python_request_action(index, action)
@@ -123,7 +111,7 @@ def generate_python_actions(actions: list[HttpAction]) -> str:
         elif not isinstance(action, ResponseAction):
             lines += "actions.append(None)\n"
 
-    lines = lines.rstrip() + "\n"
+    lines = lines.rstrip() + "\n\nprint(replay.report())\n"
 
     return lines
 
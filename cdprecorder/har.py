@@ -0,0 +1,312 @@
+"""
+This module reads HAR files, as exported by browsers and proxies, into
+actions, so that existing captures can be analysed without Chrome.
+
+A HAR file is a single JSON document, and can be hundreds of megabytes
+large. The entries of `log.entries` are read one at a time from the file, so
+only the entry being converted is kept as JSON. The bodies are kept as they
+are in the file, as text or base64, and are decoded when an action's body is
+read. The bodies longer than `spool_threshold` are moved to temporary files.
+With a BodyStore, the response bodies are decoded right away, and stored once
+per content, compressed.
+
+Usage:
+    python3 -m cdprecorder.har capture.har --output generated.py
+
+Classes:
+    - HarFormatError: Raised when the file isn't valid HAR.
+
+Functions:
+    - iter_har_entries: Reads the entries of a HAR file, one by one.
+    - actions_from_har_entry: Converts a HAR entry into a request and its
+    response.
+    - iter_har_actions: Reads the actions of a HAR file, one by one.
+    - load_har_actions: Reads the actions of a HAR file, numbered.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import re
+import sys
+import urllib.parse
+from typing import IO, TYPE_CHECKING, Any, Iterator, NamedTuple, Optional, cast
+
+from . import configure_root_logger, enable_logger, generate_python, logger
+from .action import BrowserAction, HttpAction, RequestAction, ResponseAction
+from .analyser import analyse_actions
+from .body_spool import BodySpool, LazyBody
+from .body_store import BodyStore
+
+if TYPE_CHECKING:
+    from .type_checking import RequestInfo
+
+# Characters read from the file at a time
+READ_CHUNK_SIZE = 1024 * 1024
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
+class HarFormatError(ValueError):
+    pass
+
+
+class _JSONStreamReader:
+    """Reads a JSON document from a text file, one value at a time. Only the
+    part of the file that wasn't read yet is buffered."""
+
+    def __init__(self, file: IO[str], chunk_size: int = READ_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _read(self, size: int) -> bool:
+        """Appends the next `size` characters to the buffer, and drops the
+        ones already read. Returns False at the end of the file."""
+        if self.eof:
+            return False
+        chunk = self.file.read(size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self) -> str:
+        """Returns the next character that isn't whitespace, without reading
+        it. Returns an empty string at the end of the file."""
+        while True:
+            match = _WHITESPACE.match(self.buffer, self.pos)
+            assert match is not None
+            self.pos = match.end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._read(self.chunk_size):
+                return ""
+
+    def expect(self, chars: str) -> str:
+        """Reads one of the characters in `chars`."""
+        char = self.peek()
+        if not char or char not in chars:
+            raise HarFormatError(f"Expected one of {chars!r}, found {char or 'the end of the file'!r}")
+        self.pos += 1
+        return char
+
+    def value(self) -> Any:
+        """Reads a whole JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError as exc:
+                # The value may go on after the buffer. Doubling the buffer
+                # keeps the number of attempts logarithmic in its size.
+                if not self._read(max(self.chunk_size, len(self.buffer))):
+                    raise HarFormatError(str(exc)) from exc
+                continue
+
+            if end == len(self.buffer) and not isinstance(value, (dict, list, str)) and self._read(self.chunk_size):
+                # A number or a literal may go on in the next chunk
+                continue
+            self.pos = end
+            return value
+
+    def keys(self) -> Iterator[str]:
+        """Yields the keys of the object whose "{" was just read. The value of
+        a key must be read before the next key is yielded."""
+        if self.peek() == "}":
+            self.pos += 1
+            return
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise HarFormatError(f"Expected an object key, found {key!r}")
+            self.expect(":")
+            yield key
+            if self.expect(",}") == "}":
+                return
+
+    def items(self) -> Iterator[Any]:
+        """Yields the values of the array whose "[" was just read."""
+        if self.peek() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(",]") == "]":
+                return
+
+
+def iter_har_entries(file: IO[str], chunk_size: int = READ_CHUNK_SIZE) -> Iterator[dict[str, Any]]:
+    """Yields the entries of a HAR file, in the order of the file. The other
+    members of the log are skipped."""
+    reader = _JSONStreamReader(file, chunk_size)
+    reader.expect("{")
+    for key in reader.keys():
+        if key != "log":
+            reader.value()
+            continue
+
+        reader.expect("{")
+        for log_key in reader.keys():
+            if log_key != "entries":
+                reader.value()
+                continue
+
+            reader.expect("[")
+            for entry in reader.items():
+                if not isinstance(entry, dict):
+                    raise HarFormatError(f"Expected an entry, found {entry!r:.100}")
+                yield entry
+
+    if reader.peek():
+        raise HarFormatError("Unexpected data after the HAR document")
+
+
+class _HarMessage(NamedTuple):
+    """The parts of a HAR request or response that `HttpAction.update_info` reads."""
+
+    headers: dict[str, str]
+    url: Optional[str] = None
+    method: Optional[str] = None
+    status: Optional[int] = None
+
+
+def _join_headers(har_headers: list[dict[str, str]]) -> dict[str, str]:
+    """Joins the repeated headers the way Chrome does, with newlines, except
+    for the cookies of a request, which are joined by semicolons. The names
+    are lowercased, like in the actions."""
+    headers: dict[str, str] = {}
+    for header in har_headers:
+        name, value = header["name"].lower(), header["value"]
+        if name not in headers:
+            headers[name] = value
+        elif name == "cookie":
+            headers[name] += "; " + value
+        else:
+            headers[name] += "\n" + value
+    return headers
+
+
+def _lazy_body(text: str, is_base64: bool, spool_threshold: Optional[int]) -> LazyBody:
+    if spool_threshold is not None and len(text) > spool_threshold:
+        spool = BodySpool()
+        spool.write(text.encode())
+        return LazyBody(spool, is_base64)
+    return LazyBody(text, is_base64)
+
+
+def _request_body(request: dict[str, Any], spool_threshold: Optional[int]) -> Optional[LazyBody]:
+    post_data = request.get("postData")
+    if not post_data:
+        return None
+    text = post_data.get("text")
+    if text is None and post_data.get("params"):
+        text = urllib.parse.urlencode([(param["name"], param.get("value", "")) for param in post_data["params"]])
+    if not text:
+        return None
+    return _lazy_body(text, post_data.get("encoding") == "base64", spool_threshold)
+
+
+def _response_body(response: dict[str, Any], spool_threshold: Optional[int]) -> Optional[LazyBody]:
+    content = response.get("content") or {}
+    text = content.get("text")
+    if text is None:
+        return None
+    return _lazy_body(text, content.get("encoding") == "base64", spool_threshold)
+
+
+def actions_from_har_entry(
+    entry: dict[str, Any], spool_threshold: Optional[int] = None, body_store: Optional[BodyStore] = None
+) -> list[HttpAction]:
+    """Converts a HAR entry into a RequestAction, followed by its
+    ResponseAction if the request got one. A status of 0 means that there was
+    no response. The bodies are decoded when they are read, except the
+    response bodies put in `body_store`."""
+    try:
+        har_request = entry["request"]
+        har_response = entry.get("response") or {}
+        request_message = _HarMessage(
+            _join_headers(har_request.get("headers", [])), url=har_request["url"], method=har_request["method"]
+        )
+        status = har_response.get("status") or 0
+        response_message = _HarMessage(_join_headers(har_response.get("headers", [])), status=status)
+    except (KeyError, TypeError) as exc:
+        raise HarFormatError(f"Invalid HAR entry: {exc!r}") from exc
+
+    has_response = status > 0
+    request = RequestAction(cast("RequestInfo", request_message), has_response=has_response)
+    body = _request_body(har_request, spool_threshold)
+    if body is not None:
+        request.set_body(body)
+    if not has_response:
+        return [request]
+
+    response = ResponseAction(cast("RequestInfo", response_message))
+    body = _response_body(har_response, spool_threshold)
+    if body is not None:
+        response.set_body(body_store.add(body.decode()) if body_store is not None else body)
+    return [request, response]
+
+
+def iter_har_actions(
+    path: str,
+    spool_threshold: Optional[int] = None,
+    chunk_size: int = READ_CHUNK_SIZE,
+    body_store: Optional[BodyStore] = None,
+) -> Iterator[HttpAction]:
+    """Yields the requests and responses of a HAR file, in the order of its
+    entries."""
+    with open(path, encoding="utf-8-sig") as file:
+        for entry in iter_har_entries(file, chunk_size):
+            yield from actions_from_har_entry(entry, spool_threshold, body_store)
+
+
+def load_har_actions(
+    path: str, spool_threshold: Optional[int] = None, body_store: Optional[BodyStore] = None
+) -> list[BrowserAction]:
+    """Returns the actions of a HAR file, numbered in order, ready for
+    `analyse_actions`."""
+    actions: list[BrowserAction] = []
+    for action in iter_har_actions(path, spool_threshold, body_store=body_store):
+        action.ID = len(actions)
+        actions.append(action)
+    return actions
+
+
+def main(argv: list[str]) -> None:
+    parser = argparse.ArgumentParser(description="Generates a python script from the requests of a HAR file.")
+    parser.add_argument("har", help="HAR file")
+    parser.add_argument("-o", "--output", default="generated.py", help="path of the generated script")
+    parser.add_argument(
+        "--spool-threshold",
+        type=int,
+        default=None,
+        help="bodies longer than this many characters are kept in temporary files",
+    )
+    parser.add_argument(
+        "--deduplicate-bodies",
+        action="store_true",
+        help="keep each distinct response body once, compressed",
+    )
+    args = parser.parse_args(argv)
+
+    enable_logger()
+    configure_root_logger(stream=sys.stdout)
+
+    body_store = BodyStore() if args.deduplicate_bodies else None
+    actions = load_har_actions(args.har, args.spool_threshold, body_store)
+    logger.info("Read %d actions from %s", len(actions), args.har)
+    if body_store is not None:
+        body_store.log_stats()
+    analyse_actions(actions)
+    generate_python.write_python_code(cast("list[HttpAction]", actions), args.output)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
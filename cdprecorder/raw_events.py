@@ -0,0 +1,206 @@
+"""
+This module keeps CDP events as the JSON that came from the browser, and
+parses them into pycdp's dataclasses only when they are needed.
+
+pycdp parses every event as soon as it arrives, into nested dataclasses:
+header maps, initiator stack traces, timings. Many of them belong to
+communications that end up ignored. Here, a session hands some events to
+its listeners as RawEvents. The recorder reads only a few fields from the
+JSON to decide what is ignored, and the events are parsed when the actions
+are generated.
+
+Classes:
+    - RawEvent: A CDP event kept as JSON, parsed on first use.
+
+Functions:
+    - event_type: Returns the pycdp class of an event, without parsing it.
+    - event_type_method: Returns the CDP method name of a pycdp event class.
+    - materialize: Returns the parsed event of a raw or parsed event.
+    - install_raw_event_hook: Makes a session hand RawEvents to the
+    listeners that ask for them.
+    - request_url, resource_type, is_post_data_missing, response_mime_type:
+    Read a field of a raw or parsed event, without parsing it.
+"""
+
+from __future__ import annotations
+
+import functools
+from typing import TYPE_CHECKING, Any, Optional, Union
+
+import pycdp
+from pycdp import cdp
+from twisted.internet import defer
+
+from . import logger
+
+if TYPE_CHECKING:
+    import pycdp.twisted
+    from pycdp.cdp.util import T_JSON_DICT
+
+    from .type_checking import CdpEvent
+
+
+_EVENT_METHODS: dict[type, str] = {}
+
+
+def event_type_method(cls: type) -> str:
+    """Returns the CDP method name of an event class, e.g. "Network.loadingFinished"."""
+    if not _EVENT_METHODS:
+        for method, parser in cdp.util._event_parsers.items():  # type: ignore[attr-defined]
+            _EVENT_METHODS[parser] = method
+
+    return _EVENT_METHODS[cls]
+
+
+class RawEvent:
+    """A CDP event, as the JSON sent by the browser.
+
+    The pycdp event is parsed on first use, and kept. The attributes that
+    RawEvent doesn't have are read from the parsed event, so it can be used
+    in place of it.
+    """
+
+    __slots__ = ("method", "params", "_event")
+
+    def __init__(self, method: str, params: T_JSON_DICT):
+        self.method = method
+        self.params = params
+        self._event: Any = None
+
+    @classmethod
+    def from_json(cls, data: T_JSON_DICT) -> RawEvent:
+        return cls(data["method"], data["params"])
+
+    @property
+    def event_type(self) -> type:
+        return cdp.util._event_parsers[self.method]  # type: ignore[attr-defined,no-any-return]
+
+    @property
+    def parsed(self) -> bool:
+        return self._event is not None
+
+    @property
+    def event(self) -> Any:
+        if self._event is None:
+            self._event = self.event_type.from_json(self.params)  # type: ignore[attr-defined]
+        return self._event
+
+    @property
+    def request_id(self) -> cdp.network.RequestId:
+        """The request id of a network event, read without parsing it."""
+        try:
+            return cdp.network.RequestId(self.params["requestId"])
+        except KeyError:
+            raise AttributeError("request_id") from None
+
+    def set_request_post_data(self, data: str) -> None:
+        """Sets the post data of a Network.requestWillBeSent event."""
+        self.params["request"]["postData"] = data
+        if self._event is not None:
+            self._event.request.post_data = data
+
+    def to_json(self) -> T_JSON_DICT:
+        return self.params
+
+    def __getattr__(self, name: str) -> Any:
+        # Private names are looked up by pickle and copy, before the slots are set
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.event, name)
+
+    def __getstate__(self) -> tuple[str, T_JSON_DICT]:
+        # The parsed event is left out, it can be parsed again
+        return self.method, self.params
+
+    def __setstate__(self, state: tuple[str, T_JSON_DICT]) -> None:
+        self.method, self.params = state
+        self._event = None
+
+    def __eq__(self, obj: object) -> bool:
+        if isinstance(obj, RawEvent):
+            return self.method == obj.method and self.params == obj.params
+        return bool(self.event == obj)
+
+    __hash__ = None  # type: ignore[assignment]
+
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.method!r}, request_id={self.params.get('requestId')!r})"
+
+
+def event_type(evt: object) -> type:
+    return evt.event_type if isinstance(evt, RawEvent) else type(evt)
+
+
+def materialize(evt: Union[CdpEvent, RawEvent]) -> Any:
+    return evt.event if isinstance(evt, RawEvent) else evt
+
+
+def request_url(evt: Union[cdp.network.RequestWillBeSent, RawEvent]) -> str:
+    if isinstance(evt, RawEvent):
+        return evt.params["request"]["url"]  # type: ignore[no-any-return]
+    return evt.request.url
+
+
+def resource_type(evt: Union[cdp.network.RequestWillBeSent, RawEvent]) -> Optional[cdp.network.ResourceType]:
+    if isinstance(evt, RawEvent):
+        type_ = evt.params.get("type")
+        return cdp.network.ResourceType(type_) if type_ is not None else None
+    return evt.type_
+
+
+def is_post_data_missing(evt: Union[cdp.network.RequestWillBeSent, RawEvent]) -> bool:
+    """Chrome leaves large request bodies out of Network.requestWillBeSent."""
+    if isinstance(evt, RawEvent):
+        request = evt.params["request"]
+        return bool(request.get("hasPostData")) and request.get("postData") is None
+    return bool(evt.request.has_post_data) and evt.request.post_data is None
+
+
+def response_mime_type(evt: Union[cdp.network.ResponseReceived, RawEvent]) -> str:
+    if isinstance(evt, RawEvent):
+        return evt.params["response"]["mimeType"]  # type: ignore[no-any-return]
+    return evt.response.mime_type
+
+
+def _is_raw_listener(listener: object, cls: type) -> bool:
+    return cls in getattr(listener, "raw_event_types", ())
+
+
+def _handle_event(session: pycdp.twisted.CDPBase, handle_event: Any, data: T_JSON_DICT) -> None:
+    cls = cdp.util._event_parsers.get(data.get("method"))  # type: ignore[attr-defined]
+    listeners = session._listeners.get(cls)  # type: ignore[attr-defined] # pylint: disable=protected-access
+    if not listeners or not any(_is_raw_listener(listener, cls) for listener in listeners):
+        handle_event(data)
+        return
+
+    raw_event = RawEvent.from_json(data)
+    closed = set()
+    for listener in listeners:
+        try:
+            listener.put(raw_event if _is_raw_listener(listener, cls) else raw_event.event)
+        except pycdp.exceptions.CDPEventListenerClosed:
+            closed.add(listener)
+        except defer.QueueOverflow:
+            logger.error("Event listener of %s is full, dropping the event", data["method"])
+    listeners -= closed
+
+
+def install_raw_event_hook(session: pycdp.twisted.CDPBase) -> bool:
+    """Makes the session pass RawEvents to the listeners that have the
+    event's class in their `raw_event_types`. The other listeners still get
+    parsed events.
+
+    Returns False if the session doesn't dispatch the events through
+    `_handle_event`, like pycdp's sessions do. Then, the listeners get only
+    parsed events.
+    """
+    handle_event = getattr(session, "_handle_event", None)
+    if handle_event is None:
+        return False
+    if isinstance(handle_event, functools.partial) and handle_event.func is _handle_event:
+        return True
+
+    session._handle_event = functools.partial(  # type: ignore[attr-defined] # pylint: disable=protected-access
+        _handle_event, session, handle_event
+    )
+    return True
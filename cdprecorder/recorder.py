@@ -2,20 +2,30 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import dataclasses
+import functools
 import json
 import os
 import platform
 import random
+import shutil
 import string
+import tempfile
 import time
 import urllib
 from dataclasses import dataclass
 from typing import (
     TYPE_CHECKING,
+    Any,
     AsyncIterable,
     AsyncIterator,
+    Awaitable,
+    Callable,
     Coroutine,
+    Generator,
     Generic,
+    Iterable,
+    Iterator,
     Optional,
     TypeVar,
     Union,
@@ -28,18 +38,53 @@ import twisted.internet.reactor
 from cheap_repr import cheap_repr
 from pycdp import cdp
 from pycdp.browser import ChromeLauncher
-from pycdp.twisted import CDPConnection as _PyCDPConnection
-from twisted.internet import defer, threads
-from twisted.internet.error import ConnectionRefusedError
 from twisted.internet.interfaces import IReactorCore, IReactorTime
-from twisted.web.client import Agent
 
 from . import filters, logger, tkinter_ui
 from .action import InputAction
+from .backends import CDPConnection, EventLoopBackend, Task, TwistedBackend, get_backend
+from .body_fetcher import BodyFetchPool
+from .body_policy import (
+    DEFAULT_BODY_CAPTURE_POLICY,
+    BodyCaptureMode,
+    BodyCapturePolicy,
+    BodyCaptureRule,
+    apply_capture_rule,
+)
+from .body_spool import Body, BodySpool, body_from_cdp
+from .body_store import BodyStore
+from .browser_blocking import ResourceTypeBlocker, block_filtered_urls
+from .capture_log import CaptureLogReader, CaptureLogWriter, RecordLocation
+from .chrome_pool import (
+    DEFAULT_LAUNCH_TIMEOUT,
+    close_isolated_target,
+    open_isolated_target,
+    wait_for_devtools,
+)
+from .event_buffer import (
+    AdaptiveEventQueue,
+    listen_adaptive,
+    log_buffer_stats,
+    write_buffer_stats,
+)
+from .raw_events import (
+    RawEvent,
+    event_type,
+    is_post_data_missing,
+    materialize,
+    request_url,
+    resource_type,
+    response_mime_type,
+)
+from .tabs import DEFAULT_PROBE_TIMEOUT, obtain_active_tab
+from .targets import NETWORK_EVENTS, TargetAttacher, unwrap_target_event
 
 if TYPE_CHECKING:
     import builtins
 
+    from pycdp.cdp.util import T_JSON_DICT
+
+    from .chrome_pool import ChromePool
     from .type_checking import CdpEvent
 
 
@@ -54,6 +99,12 @@ reactor = cast(Reactor, twisted.internet.reactor)
 LOGO_PATH = "./logo.png"
 RECORDER_WIDGET_PATH = "./recorder_widget.js"
 EVENT_LISTENER_PATH = "./event_listener.js"
+SEND_HOOKS_PATH = "./send_hooks.js"
+# Written next to the capture log, to size the event buffers of future recordings
+BUFFER_STATS_FILE = "buffer_stats.json"
+# The counters of event_listener.js, written next to the capture log
+PAGE_STATS_FILE = "page_stats.json"
+PAGE_STATS_TIMEOUT = 2
 
 
 class AwaitableIsNotCoroutine(Exception):
@@ -69,8 +120,12 @@ def extract_origin(url: str) -> str:
     return f"{parsed_url.scheme}://{parsed_url.netloc}"
 
 
+# The same few origins are compared with every recorded URL
+_extract_origin_cached = functools.lru_cache(maxsize=64)(extract_origin)
+
+
 def url_belongs_to_origin(url: str, origin: str) -> bool:
-    return extract_origin(url) == extract_origin(origin)
+    return extract_origin(url) == _extract_origin_cached(origin)
 
 
 def is_url_ignored(url: str, origin: Optional[str] = None) -> bool:
@@ -79,43 +134,81 @@ def is_url_ignored(url: str, origin: Optional[str] = None) -> bool:
         return True
     parsed = urllib.parse.urlparse(url)
     path = parsed.path
-    if path.endswith(".js") or path.endswith(".svg") or path.endswith(".css"):
+    if path.endswith((".js", ".svg", ".css")):
         return True
 
-    if origin and not url_belongs_to_origin(url, origin):
+    # The URL is parsed only once, instead of again by url_belongs_to_origin
+    if origin and f"{parsed.scheme}://{parsed.netloc}" != _extract_origin_cached(origin):
         return True
 
     return False
 
 
+async def execute_pipelined(
+    session: pycdp.twisted.CDPBase,
+    commands: Iterable[Generator[T_JSON_DICT, T_JSON_DICT, Any]],
+    backend: Optional[EventLoopBackend] = None,
+) -> list[Any]:
+    """Sends the commands one after another, without waiting for the reply
+    of each, and returns their results in order. It takes one round-trip
+    instead of one per command.
+
+    The browser runs the commands of a session in the order they were sent,
+    so a command can still rely on the ones before it. If commands fail, the
+    first error is raised once all the replies arrived.
+    """
+    backend = backend if backend is not None else get_backend()
+    # Each task sends its command when it starts, and the tasks start in order
+    tasks = [backend.spawn(session.execute(command)) for command in commands]
+
+    results: list[Any] = []
+    error: Optional[Exception] = None
+    for command_task in tasks:
+        try:
+            results.append(await command_task)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            error = error or exc
+            results.append(None)
+    if error is not None:
+        raise error
+    return results
+
+
 async def insert_js_leech_script(
     target_session: pycdp.twisted.CDPSession,
     expression: str,
+    backend: Optional[EventLoopBackend] = None,
 ) -> tuple[str, cdp.runtime.ExecutionContextId]:
+    backend = backend if backend is not None else get_backend()
     runtime_init_timeout = 5
     context_id = None
     context_name = randomstr(32)
 
-    await target_session.execute(cdp.page.runtime.enable())
-
     receiver = None
     evt_to_listen = cdp.runtime.ExecutionContextCreated
     try:
         # Don't call target_session.listen because we need the receiver object to close it at the end
-        receiver = pycdp.twisted.CDPEventListener(defer.DeferredQueue(1024))
+        receiver = backend.create_event_listener(1024)
         target_session._listeners[evt_to_listen].add(receiver)
         listener = aiter(receiver)
 
-        await target_session.execute(
-            cdp.page.add_script_to_evaluate_on_new_document(expression, run_immediately=True, world_name=context_name)
+        await execute_pipelined(
+            target_session,
+            [
+                cdp.runtime.enable(),
+                cdp.page.add_script_to_evaluate_on_new_document(
+                    expression, run_immediately=True, world_name=context_name
+                ),
+            ],
+            backend,
         )
 
-        timed_listener = AsyncIterableWithTimeout(listener, runtime_init_timeout)
+        timed_listener = AsyncIterableWithTimeout(listener, runtime_init_timeout, backend=backend)
         async for evt in timed_listener:
             if evt.context.name == context_name:
                 context_id = evt.context.id_
                 break
-    except defer.TimeoutError as exc:
+    except backend.timeout_error as exc:
         raise Exception from exc
     finally:
         if receiver is not None:
@@ -129,6 +222,7 @@ async def insert_js_leech_script(
 
 async def insert_js_action_listener(
     target_session: pycdp.twisted.CDPSession,
+    backend: Optional[EventLoopBackend] = None,
 ) -> tuple[str, cdp.runtime.ExecutionContextId]:
     from importlib import resources
 
@@ -136,7 +230,20 @@ async def insert_js_action_listener(
     with listener_file.open("r") as file:
         expression = file.read()
 
-    return await insert_js_leech_script(target_session, expression)
+    return await insert_js_leech_script(target_session, expression, backend)
+
+
+async def insert_js_send_hooks(target_session: pycdp.twisted.CDPSession) -> None:
+    """Makes the page tell event_listener.js to send its batched events
+    before it sends a request. Unlike the listener, this runs in the page's
+    own world, to wrap its fetch, XMLHttpRequest and sendBeacon."""
+    from importlib import resources
+
+    hooks_file = resources.files(__package__) / SEND_HOOKS_PATH
+    with hooks_file.open("r") as file:
+        expression = file.read()
+
+    await target_session.execute(cdp.page.add_script_to_evaluate_on_new_document(expression, run_immediately=True))
 
 
 class HttpCommunication:
@@ -147,18 +254,26 @@ class HttpCommunication:
         request_id: cdp.network.RequestId,
         ignored: bool = False,
         events: Optional[list[CdpEvent]] = None,
-        response_bodies: Optional[list[Optional[bytes]]] = None,
+        response_bodies: Optional[list[Optional[Body]]] = None,
+        target_id: Optional[cdp.target.TargetID] = None,
     ):
         self.request_id = request_id
         self.ignored = ignored
         self.events = events if events is not None else []
-        self.response_bodies: list[Optional[bytes]] = []
+        self.response_bodies: list[Optional[Body]] = []
         if response_bodies:
             self.response_bodies = response_bodies
+        # The target that made the request, when several targets are recorded
+        self.target_id = target_id
 
     def add_event(self, event: CdpEvent) -> None:
         self.events.append(event)
 
+    def typed_events(self) -> list[Any]:
+        """Returns the events parsed into pycdp's classes. The events that
+        were kept as RawEvents are parsed now."""
+        return [materialize(event) for event in self.events]
+
     def __str__(self) -> str:
         name = self.__class__.__name__
         text = f"{name}(reuquest_id={self.request_id}, ignored={self.ignored})"
@@ -175,6 +290,8 @@ class HttpCommunication:
         response_bodies = f"response_bodies={self.response_bodies!r}"
 
         components = [request_id, ignored, events, response_bodies]
+        if self.target_id is not None:
+            components.append(f"target_id={self.target_id!r}")
 
         return f"{self.__class__.__name__}({', '.join(components)})"
 
@@ -192,6 +309,10 @@ class HttpCommunication:
 
 T = TypeVar("T")
 
+# Drives the page of a recording, e.g. a scripted flow
+RecordingScript = Callable[[pycdp.twisted.CDPSession], Awaitable[None]]
+CommunicationCallback = Callable[[Union["HttpCommunication", InputAction]], None]
+
 
 class AsyncIteratorWithTimeout(Generic[T]):
     def __init__(
@@ -199,9 +320,11 @@ class AsyncIteratorWithTimeout(Generic[T]):
         iterator: AsyncIterator[T],
         timeout: float,
         start_time: Optional[float] = None,
+        backend: Optional[EventLoopBackend] = None,
     ):
         self.iterator = iterator
         self.timeout = timeout
+        self.backend = backend if backend is not None else get_backend()
         if start_time is None:
             self.start_time = time.time()
         else:
@@ -216,9 +339,7 @@ class AsyncIteratorWithTimeout(Generic[T]):
         coro = self.iterator.__anext__()
         if not isinstance(coro, Coroutine):
             raise AwaitableIsNotCoroutine
-        d: defer.Deferred[T] = defer.Deferred.fromCoroutine(coro)
-        d.addTimeout(remained, reactor)
-        return await d
+        return await self.backend.with_timeout(coro, remained)
 
     def __aiter__(self) -> AsyncIteratorWithTimeout:
         return self
@@ -230,47 +351,53 @@ class AsyncIterableWithTimeout(Generic[T]):
         iterable: AsyncIterable[T],
         timeout: float,
         start_time: Optional[float] = None,
+        backend: Optional[EventLoopBackend] = None,
     ):
         self.iterable = iterable
         self.timeout = timeout
+        self.backend = backend if backend is not None else get_backend()
         if start_time is None:
             self.start_time = time.time()
         else:
             self.start_time = start_time
 
     def __aiter__(self) -> AsyncIterator[T]:
-        return AsyncIteratorWithTimeout(self.iterable.__aiter__(), self.timeout, self.start_time)
+        return AsyncIteratorWithTimeout(self.iterable.__aiter__(), self.timeout, self.start_time, self.backend)
 
 
 class CancelableAsyncIterator(Generic[T]):
-    def __init__(self, iterator: AsyncIterator[T], stop_event: defer.Deferred):
+    def __init__(self, iterator: AsyncIterator[T], stop_event: Any, backend: Optional[EventLoopBackend] = None):
         self.iterator = iterator
+        self.backend = backend if backend is not None else get_backend()
         self._stop_event = stop_event
-        self._next_task: Optional[defer.Deferred[T]] = None
+        self._next_task: Optional[Task[T]] = None
 
-        def on_cancel(res):
+        def on_cancel() -> None:
             if self._next_task is not None:
                 self._next_task.cancel()
                 self._next_task = None
 
-        self._stop_event.addCallback(on_cancel)
+        self.backend.add_done_callback(self._stop_event, on_cancel)
 
     def cancel(self):
-        return self._stop_event.callback(None)
+        return self.backend.set_result(self._stop_event, None)
 
     async def __anext__(self) -> T:
-        if self._stop_event.called:
+        if self.backend.is_done(self._stop_event):
             raise StopAsyncIteration
 
         if self._next_task is None:
             coro = self.iterator.__anext__()
             if not isinstance(coro, Coroutine):
                 raise AwaitableIsNotCoroutine
-            self._next_task = defer.Deferred.fromCoroutine(coro)
+            self._next_task = self.backend.spawn(coro)
 
         try:
             res = await self._next_task
-        except defer.CancelledError:
+        except self.backend.cancelled_error:
+            if not self.backend.is_done(self._stop_event):
+                # The consumer was cancelled, not the iterator
+                raise
             raise StopAsyncIteration
         finally:
             self._next_task = None
@@ -282,15 +409,18 @@ class CancelableAsyncIterator(Generic[T]):
 
 
 class CancelableAsyncIterable(Generic[T]):
-    def __init__(self, iterable: AsyncIterable[T]):
+    def __init__(self, iterable: AsyncIterable[T], backend: Optional[EventLoopBackend] = None):
         self.iterable = iterable
-        self._stop_event = defer.Deferred()
+        self.backend = backend if backend is not None else get_backend()
+        self._stop_event = self.backend.create_future()
 
-    def cancel(self):
-        return self._stop_event.callback(None)
+    def cancel(self) -> None:
+        # Both the control window and a stop signal may stop the recording
+        if not self.backend.is_done(self._stop_event):
+            self.backend.set_result(self._stop_event, None)
 
     def __aiter__(self) -> AsyncIterator[T]:
-        return CancelableAsyncIterator(self.iterable.__aiter__(), self._stop_event)
+        return CancelableAsyncIterator(self.iterable.__aiter__(), self._stop_event, self.backend)
 
 
 class Recorder:
@@ -300,6 +430,15 @@ class Recorder:
         urlfilter: filters.URLFilter,
         collect_all: bool,
         start_origin: Optional[str],
+        capture_log: Optional[CaptureLogWriter] = None,
+        body_fetch_pool: Optional[BodyFetchPool] = None,
+        body_spool_threshold: Optional[int] = None,
+        body_capture_policy: Optional[BodyCapturePolicy] = None,
+        ignored_resource_types: Iterable[cdp.network.ResourceType] = (),
+        runtime_ctx: Optional[RuntimeContext] = None,
+        memory_budget: Optional[int] = None,
+        spill_dir: Optional[str] = None,
+        body_store: Optional[BodyStore] = None,
     ):
         self.target_session = target_session
         self.urlfilter = urlfilter
@@ -307,9 +446,318 @@ class Recorder:
         self.collect_all = collect_all
         self.communications: list[Union[HttpCommunication, InputAction]] = []
         self.request_map: dict[pycdp.cdp.network.RequestId, HttpCommunication] = {}
-        self.runtime_ctx = get_runtime_context()
+        # Parallel recordings can't share the global runtime context, so they pass their own
+        self.runtime_ctx = runtime_ctx if runtime_ctx is not None else get_runtime_context()
         self.on_stop_cbs = []
 
+        # When a capture log is used, the communications in `self.communications` hold no events or bodies.
+        # These are written to the log, and only their locations are kept in `self.capture_index`.
+        self.capture_log = capture_log
+        self.capture_index: dict[pycdp.cdp.network.RequestId, list[RecordLocation]] = {}
+        self._body_count: dict[pycdp.cdp.network.RequestId, int] = {}
+        self._event_count: dict[pycdp.cdp.network.RequestId, int] = {}
+
+        # If None, the bodies are fetched inline, while the events wait
+        self.body_fetch_pool = body_fetch_pool
+        # Bodies longer than this are decoded to temporary files. If None, all are kept in memory.
+        self.body_spool_threshold = body_spool_threshold
+        # Keeps the bodies held in memory once per content, compressed. If None, each body is kept as it is.
+        self.body_store = body_store
+
+        # Decides which bodies are skipped, truncated or hashed. If None, all are kept whole.
+        self.body_capture_policy = body_capture_policy
+        self._request_urls: dict[pycdp.cdp.network.RequestId, str] = {}
+        self._mime_types: dict[pycdp.cdp.network.RequestId, str] = {}
+        self.skipped_bodies = 0
+
+        # Requests of these types are failed by the browser, so they have no response
+        self.ignored_resource_types = frozenset(ignored_resource_types)
+
+        # The sessions of the requests that didn't come from `target_session`
+        self._request_sessions: dict[pycdp.cdp.network.RequestId, pycdp.twisted.CDPSession] = {}
+
+        # Called with each communication as soon as it is complete, e.g. to analyse it while recording
+        self.on_communication_finished_cbs: list[CommunicationCallback] = []
+        # Requests whose loading ended, but that may still wait for body fetches
+        self._loading_ended: set[pycdp.cdp.network.RequestId] = set()
+        self._pending_fetches: dict[pycdp.cdp.network.RequestId, int] = {}
+        # Communications not yet passed to the callbacks, in recording order
+        self._unfinished: dict[pycdp.cdp.network.RequestId, None] = {}
+        self._capture_reader: Optional[CaptureLogReader] = None
+
+        # Without a capture log, the finished communications are spilled to a temporary log in `spill_dir`,
+        # when the ones in memory take more than `memory_budget` bytes. If None, nothing is spilled.
+        self.memory_budget = memory_budget
+        self.spill_dir = spill_dir
+        self._spill_log: Optional[CaptureLogWriter] = None
+        # Spilled communications; their locations are in `self.capture_index`
+        self._spilled: set[pycdp.cdp.network.RequestId] = set()
+        # Finished or ignored communications that can be spilled, oldest first
+        self._spillable: dict[pycdp.cdp.network.RequestId, None] = {}
+        self._positions: dict[pycdp.cdp.network.RequestId, int] = {}
+        self._memory_sizes: dict[pycdp.cdp.network.RequestId, int] = {}
+        # Estimated from the size of the events as JSON, and of the bodies kept in memory, only with a budget
+        self.memory_usage = 0
+        self.peak_memory_usage = 0
+        self.spilled_communications = 0
+
+    def _add_location(self, request_id: cdp.network.RequestId, location: RecordLocation) -> None:
+        self.capture_index.setdefault(request_id, []).append(location)
+
+    def _get_log(self, request_id: cdp.network.RequestId) -> Optional[CaptureLogWriter]:
+        """Returns the log that holds the communication, or None if it's kept
+        in memory."""
+        if request_id in self._spilled:
+            return self._spill_log
+        return self.capture_log
+
+    def _add_memory_usage(self, request_id: cdp.network.RequestId, size: int) -> None:
+        self._memory_sizes[request_id] = self._memory_sizes.get(request_id, 0) + size
+        self.memory_usage += size
+        self.peak_memory_usage = max(self.peak_memory_usage, self.memory_usage)
+
+    def add_event(self, request_id: cdp.network.RequestId, evt: CdpEvent) -> int:
+        """Stores the event, and returns its index in the communication."""
+        log = self._get_log(request_id)
+        if log is None:
+            comm = self.request_map[request_id]
+            comm.add_event(evt)
+            # Serializing every event is costly, so the sizes are only estimated for a budget
+            if self.memory_budget is not None:
+                self._add_memory_usage(request_id, len(json.dumps(evt.to_json())))
+            return len(comm.events) - 1
+
+        index = self._event_count.get(request_id, 0)
+        self._event_count[request_id] = index + 1
+        target_id = self.request_map[request_id].target_id
+        self._add_location(request_id, log.append_event(request_id, evt, target_id))
+        return index
+
+    def reserve_response_body(self, request_id: cdp.network.RequestId) -> int:
+        """Reserves the place of a body that is still being fetched. The
+        bodies keep the order of their LoadingFinished events, no matter the
+        order in which the fetches finish."""
+        if self._get_log(request_id) is None:
+            comm = self.request_map[request_id]
+            comm.response_bodies.append(None)
+            return len(comm.response_bodies) - 1
+
+        slot = self._body_count.get(request_id, 0)
+        self._body_count[request_id] = slot + 1
+        return slot
+
+    def set_response_body(self, request_id: cdp.network.RequestId, slot: int, body: Optional[Body]) -> None:
+        log = self._get_log(request_id)
+        if log is None:
+            if self.body_store is not None and isinstance(body, (bytes, BodySpool)):
+                stored = self.body_store.add(body)
+                if isinstance(body, BodySpool):
+                    body.close()
+                # The stored bodies are shared by the communications, so they aren't counted for one
+                body = stored
+            self.request_map[request_id].response_bodies[slot] = body
+            # The spooled bodies are in temporary files
+            if self.memory_budget is not None and isinstance(body, bytes):
+                self._add_memory_usage(request_id, len(body))
+            return
+
+        self._add_location(request_id, log.append_body(request_id, slot, body))
+        if isinstance(body, BodySpool):
+            body.close()
+
+    def add_response_body(self, request_id: cdp.network.RequestId, body: Optional[Body]) -> None:
+        self.set_response_body(request_id, self.reserve_response_body(request_id), body)
+
+    def select_body_capture_rule(
+        self, request_id: cdp.network.RequestId, evt: cdp.network.LoadingFinished
+    ) -> Optional[BodyCaptureRule]:
+        if self.body_capture_policy is None:
+            return None
+
+        return self.body_capture_policy.select(
+            self._mime_types.get(request_id), evt.encoded_data_length, self._request_urls.get(request_id)
+        )
+
+    def set_request_post_data(
+        self,
+        request_id: cdp.network.RequestId,
+        event_index: int,
+        evt: Union[cdp.network.RequestWillBeSent, RawEvent],
+        data: str,
+    ) -> None:
+        log = self._get_log(request_id)
+        if log is None:
+            if isinstance(evt, RawEvent):
+                evt.set_request_post_data(data)
+            else:
+                evt.request.post_data = data
+            if self.memory_budget is not None:
+                self._add_memory_usage(request_id, len(data))
+            return
+
+        self._add_location(request_id, log.append_post_data(request_id, event_index, data))
+
+    def set_ignored(self, request_id: cdp.network.RequestId) -> None:
+        self.request_map[request_id].ignored = True
+        # Ignored communications are never passed to the callbacks, and their bodies aren't fetched
+        self._unfinished.pop(request_id, None)
+        self._request_sessions.pop(request_id, None)
+        log = self._get_log(request_id)
+        if log is not None:
+            log.append_ignored(request_id)
+        else:
+            # Ignored communications get no more events that matter
+            self._mark_spillable(request_id)
+
+    def _mark_spillable(self, request_id: cdp.network.RequestId) -> None:
+        if self.memory_budget is None or self.capture_log is not None or request_id in self._spilled:
+            return
+        self._spillable[request_id] = None
+        self._enforce_memory_budget()
+
+    def _enforce_memory_budget(self) -> None:
+        assert self.memory_budget is not None
+        while self.memory_usage > self.memory_budget and self._spillable:
+            request_id = next(iter(self._spillable))
+            del self._spillable[request_id]
+            self._spill_communication(request_id)
+
+    def _spill_communication(self, request_id: cdp.network.RequestId) -> None:
+        """Writes the communication to the spill log, and keeps only a
+        placeholder in memory. The events that still come for it are
+        written to the log."""
+        if self._spill_log is None:
+            if self.spill_dir is not None:
+                os.makedirs(self.spill_dir, exist_ok=True)
+            self._spill_log = CaptureLogWriter(tempfile.mkdtemp(prefix="cdprecorder-spill-", dir=self.spill_dir))
+            logger.info(
+                "Memory budget of %d bytes reached, spilling to %s", self.memory_budget, self._spill_log.directory
+            )
+
+        comm = self.request_map[request_id]
+        for location in self._spill_log.append_communication(comm):
+            self._add_location(request_id, location)
+        for body in comm.response_bodies:
+            if isinstance(body, BodySpool):
+                body.close()
+        self._event_count[request_id] = len(comm.events)
+        self._body_count[request_id] = len(comm.response_bodies)
+
+        # A new placeholder, because the callbacks may still hold the communication
+        placeholder = HttpCommunication(request_id, comm.ignored, target_id=comm.target_id)
+        self.request_map[request_id] = placeholder
+        self.communications[self._positions.pop(request_id)] = placeholder
+        self._spilled.add(request_id)
+        self.spilled_communications += 1
+        self.memory_usage -= self._memory_sizes.pop(request_id, 0)
+
+    def log_memory_usage(self) -> None:
+        if self.memory_budget is None:
+            return
+        spilled_bytes = self._spill_log.bytes_written if self._spill_log is not None else 0
+        logger.info(
+            "Recorder memory: %d bytes (peak %d), %d communications spilled (%d bytes)",
+            self.memory_usage,
+            self.peak_memory_usage,
+            self.spilled_communications,
+            spilled_bytes,
+        )
+
+    def add_input_actions(self, actions: list[InputAction]) -> None:
+        if self.capture_log is not None:
+            for action in actions:
+                self.capture_log.append_input_action(action)
+        self.communications.extend(actions)
+        for action in actions:
+            for callback in self.on_communication_finished_cbs:
+                callback(action)
+
+    def add_on_communication_finished_callback(self, callback: CommunicationCallback) -> None:
+        self.on_communication_finished_cbs.append(callback)
+
+    def _start_fetch(self, request_id: cdp.network.RequestId) -> None:
+        self._pending_fetches[request_id] = self._pending_fetches.get(request_id, 0) + 1
+
+    def _end_fetch(self, request_id: cdp.network.RequestId) -> None:
+        self._pending_fetches[request_id] -= 1
+        self._check_finished(request_id)
+
+    def _end_loading(self, request_id: cdp.network.RequestId) -> None:
+        self._loading_ended.add(request_id)
+        self._check_finished(request_id)
+
+    def _check_finished(self, request_id: cdp.network.RequestId) -> None:
+        """A communication is finished when its loading ended, and its bodies
+        were fetched."""
+        if request_id in self._loading_ended and not self._pending_fetches.get(request_id):
+            self._loading_ended.discard(request_id)
+            self._forget_request(request_id)
+            self._finish_communication(request_id)
+            self._mark_spillable(request_id)
+            if request_id not in self._spillable:
+                # Not spilled later, so its position isn't needed anymore
+                self._positions.pop(request_id, None)
+
+    def _forget_request(self, request_id: cdp.network.RequestId) -> None:
+        """Drops what was kept to fetch the bodies of a communication, once
+        its body capture rule was chosen and its fetches ended."""
+        self._request_urls.pop(request_id, None)
+        self._mime_types.pop(request_id, None)
+        self._request_sessions.pop(request_id, None)
+        self._pending_fetches.pop(request_id, None)
+
+    def _finish_communication(self, request_id: cdp.network.RequestId) -> None:
+        if request_id not in self._unfinished:
+            return
+        del self._unfinished[request_id]
+        comm = self.request_map[request_id]
+        if not self.on_communication_finished_cbs or comm.ignored:
+            return
+
+        if self.capture_log is not None:
+            if self._capture_reader is None:
+                self._capture_reader = CaptureLogReader(self.capture_log.directory)
+            comm = self._capture_reader.load_communication(request_id, self.capture_index.get(request_id, []))
+            comm.target_id = self.request_map[request_id].target_id
+
+        for callback in self.on_communication_finished_cbs:
+            callback(comm)
+
+    def finish_remaining_communications(self) -> None:
+        """Passes the communications that never finished to the callbacks, in
+        recording order. Called when the recording stops."""
+        for request_id in list(self._unfinished):
+            self._finish_communication(request_id)
+        if self._capture_reader is not None:
+            self._capture_reader.close()
+            self._capture_reader = None
+
+    def get_communications(self) -> Iterable[Union[HttpCommunication, InputAction]]:
+        """Returns the recorded communications, in order. If a capture log is
+        used, or some communications were spilled, they are read back from
+        the log lazily."""
+        if self.capture_log is not None:
+            reader = CaptureLogReader(self.capture_log.directory)
+            return reader.iter_communications(self.communications, self.capture_index)
+        if self._spill_log is not None:
+            return self._iter_spilled_communications()
+
+        return self.communications
+
+    def _iter_spilled_communications(self) -> Iterator[Union[HttpCommunication, InputAction]]:
+        assert self._spill_log is not None
+        self._spill_log.close()
+        reader = CaptureLogReader(self._spill_log.directory)
+        try:
+            for entry in self.communications:
+                if isinstance(entry, HttpCommunication) and entry.request_id in self._spilled:
+                    yield reader.load_communication(entry.request_id, self.capture_index[entry.request_id])
+                else:
+                    yield entry
+        finally:
+            reader.close()
+            shutil.rmtree(self._spill_log.directory, ignore_errors=True)
+
     async def on_http_data(
         self,
         evt: Union[
@@ -318,61 +766,135 @@ class Recorder:
             cdp.network.ResponseReceived,
             cdp.network.ResponseReceivedExtraInfo,
         ],
+        target_id: Optional[cdp.target.TargetID] = None,
+        session: Optional[pycdp.twisted.CDPSession] = None,
     ) -> None:
         if evt.request_id not in self.request_map:
-            comm = HttpCommunication(evt.request_id)
+            comm = HttpCommunication(evt.request_id, target_id=target_id)
+            self._positions[evt.request_id] = len(self.communications)
             self.communications.append(comm)
             self.request_map[evt.request_id] = comm
+            self._unfinished[evt.request_id] = None
+            if session is not None and session is not self.target_session:
+                self._request_sessions[evt.request_id] = session
+
+    def get_request_session(self, request_id: cdp.network.RequestId) -> pycdp.twisted.CDPSession:
+        """Returns the session of the target that made the request. Its
+        bodies can be fetched only through that session."""
+        return self._request_sessions.get(request_id, self.target_session)
 
     async def on_binding_called(self, evt: cdp.runtime.BindingCalled) -> None:
         await self.runtime_ctx.on_binding_called(evt)
-        self.communications += self.runtime_ctx.pop_actions()
+        self.add_input_actions(self.runtime_ctx.pop_actions())
 
     async def on_execution_context_created(self, evt: cdp.runtime.ExecutionContextCreated) -> None:
         await self.runtime_ctx.on_execution_context_created(evt)
 
-    async def on_request_will_be_sent(self, evt: cdp.network.RequestWillBeSent) -> None:
-        cdp_req = evt.request
+    async def take_pending_input_actions(self, backend: EventLoopBackend) -> None:
+        """Adds the input actions still batched in the page, once the events
+        aren't listened to anymore."""
+        try:
+            await backend.with_timeout(self.runtime_ctx.take_pending_events(), PAGE_STATS_TIMEOUT)
+        except Exception as exc:  # pylint: disable=broad-exception-caught
+            # The page may be gone already
+            logger.debug("Could not read the events batched in the page: %s", exc)
+        self.add_input_actions(self.runtime_ctx.pop_actions())
+
+    async def on_request_will_be_sent(self, evt: Union[cdp.network.RequestWillBeSent, RawEvent]) -> None:
+        # Only the fields needed to ignore the request are read, so a RawEvent isn't parsed here
+        url = request_url(evt)
         request_id = evt.request_id
 
-        self.request_map[request_id].add_event(evt)
+        event_index = self.add_event(request_id, evt)
 
         if not self.collect_all and (
-            is_url_ignored(cdp_req.url, self.start_origin) or self.urlfilter.should_block(evt.request.url)
+            resource_type(evt) in self.ignored_resource_types
+            or is_url_ignored(url, self.start_origin)
+            or self.urlfilter.should_block(url)
         ):
-            self.request_map[request_id].ignored = True
+            self.set_ignored(request_id)
+            return
+
+        if self.body_capture_policy is not None:
+            self._request_urls[request_id] = url
+
+        if self.body_fetch_pool is not None and is_post_data_missing(evt):
+
+            def on_post_data(data: Optional[str]) -> None:
+                if data is not None:
+                    self.set_request_post_data(request_id, event_index, evt, data)
+                self._end_fetch(request_id)
+
+            self._start_fetch(request_id)
+            await self.body_fetch_pool.submit_request_post_data(
+                request_id, on_post_data, self._request_sessions.get(request_id)
+            )
 
     async def on_request_will_be_sent_extra_info(self, evt: cdp.network.RequestWillBeSentExtraInfo) -> None:
         if not self.request_map[evt.request_id].ignored:
-            self.request_map[evt.request_id].add_event(evt)
+            self.add_event(evt.request_id, evt)
 
-    async def on_response_received(self, evt: cdp.network.ResponseReceived) -> None:
+    async def on_response_received(self, evt: Union[cdp.network.ResponseReceived, RawEvent]) -> None:
         if not self.request_map[evt.request_id].ignored:
-            self.request_map[evt.request_id].add_event(evt)
+            self.add_event(evt.request_id, evt)
+            if self.body_capture_policy is not None:
+                self._mime_types[evt.request_id] = response_mime_type(evt)
 
     async def on_response_received_extra_info(self, evt: cdp.network.ResponseReceivedExtraInfo) -> None:
         if not self.request_map[evt.request_id].ignored:
-            self.request_map[evt.request_id].add_event(evt)
+            self.add_event(evt.request_id, evt)
 
     async def on_loading_finished(self, evt: cdp.network.LoadingFinished) -> None:
         request_id = evt.request_id
         if request_id not in self.request_map or self.request_map[request_id].ignored:
             return
 
-        body = None
+        rule = self.select_body_capture_rule(request_id, evt)
+        if rule is not None and rule.mode == BodyCaptureMode.SKIP:
+            self.skipped_bodies += 1
+            self.add_event(request_id, evt)
+            self.add_response_body(request_id, None)
+            self._end_loading(request_id)
+            return
+
+        if self.body_fetch_pool is not None:
+            self.add_event(request_id, evt)
+            slot = self.reserve_response_body(request_id)
+
+            def on_body(body: Optional[Body]) -> None:
+                self.set_response_body(request_id, slot, apply_capture_rule(body, rule))
+                self._end_fetch(request_id)
+
+            self._start_fetch(request_id)
+            await self.body_fetch_pool.submit_response_body(request_id, on_body, self._request_sessions.get(request_id))
+            self._end_loading(request_id)
+            return
+
+        body: Optional[Body] = None
         try:
-            cdp_body_result = await self.target_session.execute(cdp.network.get_response_body(request_id))
+            session = self.get_request_session(request_id)
+            cdp_body_result = await session.execute(cdp.network.get_response_body(request_id))
             resulted_body, is_base_64 = cdp_body_result
-            if is_base_64:
-                body = base64.b64decode(resulted_body)
-            else:
-                body = resulted_body.encode()
+            body = body_from_cdp(resulted_body, is_base_64, self.body_spool_threshold)
 
         except pycdp.exceptions.CDPBrowserError:
             print("  --cdp-browser-error")
 
-        self.request_map[request_id].add_event(evt)
-        self.request_map[request_id].response_bodies.append(body)
+        self.add_event(request_id, evt)
+        self.add_response_body(request_id, apply_capture_rule(body, rule))
+        self._end_loading(request_id)
+
+    async def on_loading_failed(self, evt: cdp.network.LoadingFailed) -> None:
+        # The event isn't recorded, it only tells that the communication won't get more events
+        if evt.request_id in self.request_map:
+            self._end_loading(evt.request_id)
+
+    async def drain(self) -> None:
+        """Waits for the bodies that are still being fetched."""
+        if self.body_fetch_pool is not None:
+            await self.body_fetch_pool.join()
+        if self.skipped_bodies:
+            logger.debug("Skipped %d bodies by the capture policy", self.skipped_bodies)
 
     async def on_start(self):
         print("on start")
@@ -389,10 +911,23 @@ async def collect_communications(
     target_session: pycdp.twisted.CDPSession,
     listener: AsyncIterator[object],
     urlfilter: filters.URLFilter,
-    timeout: int = 120,
+    timeout: float = 120,
     collect_all: bool = False,
     start_origin: Optional[str] = None,
-) -> list[Union[HttpCommunication, InputAction]]:
+    capture_log: Optional[CaptureLogWriter] = None,
+    body_fetch_pool: Optional[BodyFetchPool] = None,
+    body_spool_threshold: Optional[int] = None,
+    body_capture_policy: Optional[BodyCapturePolicy] = None,
+    ignored_resource_types: Iterable[cdp.network.ResourceType] = (),
+    runtime_context: Optional[RuntimeContext] = None,
+    show_control_window: bool = True,
+    stop_signal: Optional[Awaitable[None]] = None,
+    on_communication_finished: Optional[CommunicationCallback] = None,
+    memory_budget: Optional[int] = None,
+    spill_dir: Optional[str] = None,
+    backend: Optional[EventLoopBackend] = None,
+    body_store: Optional[BodyStore] = None,
+) -> Iterable[Union[HttpCommunication, InputAction]]:
     """Takes a cdp session, listens for events, and generates a list of
     communications.
 
@@ -403,54 +938,113 @@ async def collect_communications(
         target_session: The CDP session.
         urlfilter: Tells which URLs to ignore.
         timeout: When to stop listening.
+        capture_log: If given, the events and bodies are written to it as
+            they arrive, instead of being kept in memory.
+        body_fetch_pool: If given, the bodies are fetched in the background.
+            Otherwise, each body is fetched before the next event is read.
+        body_spool_threshold: Bodies longer than this are decoded in chunks to
+            temporary files, instead of being kept in memory. Applies only to
+            the inline fetches; the pool has its own threshold.
+        body_capture_policy: Decides which bodies are skipped, truncated or
+            replaced with their hash. If None, all the bodies are kept.
+        ignored_resource_types: The requests of these types are ignored,
+            e.g. because the browser was told to fail them.
+        runtime_context: The runtime context of the page. If None, the
+            global one is used.
+        show_control_window: Whether to show the Tk window that stops the
+            recording. Headless recordings don't need it.
+        stop_signal: If given, the recording stops when it fires. A Deferred,
+            or an asyncio Future, depending on the backend.
+        on_communication_finished: If given, it's called with each
+            communication as soon as it is complete, and with each input
+            action. The communications that never finish are passed when
+            the recording stops. Ignored communications are left out.
+        memory_budget: Without a capture log, the finished communications
+            are spilled to disk when the ones in memory take more than this
+            many bytes. If None, everything is kept in memory.
+        spill_dir: Where the spilled communications are written. If None,
+            the system's temporary directory is used.
+        backend: The event loop that runs the recording. If None, Twisted's
+            reactor. The control window and the body fetch pool need Twisted.
+        body_store: If given, the bodies kept in memory are stored in it,
+            once per content and compressed, and the communications hold
+            StoredBody handles.
 
     Returns:
-        A list of communications.
+        The communications, in recording order. Without a capture log, this
+        is a list. With a capture log, the communications are read lazily.
     """
-    recorder = Recorder(target_session, urlfilter, collect_all, start_origin)
-    runtime_context = get_runtime_context()
+    backend = backend if backend is not None else get_backend()
+    if show_control_window and not isinstance(backend, TwistedBackend):
+        raise ValueError("The control window runs only on the twisted backend")
 
-    ui = tkinter_ui.TkRecordControl(reactor, recorder.on_start, recorder.on_stop)
+    recorder = Recorder(
+        target_session,
+        urlfilter,
+        collect_all,
+        start_origin,
+        capture_log=capture_log,
+        body_fetch_pool=body_fetch_pool,
+        body_spool_threshold=body_spool_threshold,
+        body_capture_policy=body_capture_policy,
+        ignored_resource_types=ignored_resource_types,
+        runtime_ctx=runtime_context,
+        memory_budget=memory_budget,
+        spill_dir=spill_dir,
+        body_store=body_store,
+    )
 
-    timed_listener = AsyncIterableWithTimeout(listener, timeout)
-    timed_cancelable_listener = CancelableAsyncIterable(timed_listener)
+    if show_control_window:
+        ui = tkinter_ui.TkRecordControl(reactor, recorder.on_start, recorder.on_stop)
 
-    recorder.add_on_stop_callback(lambda: timed_cancelable_listener.cancel())
+    timed_listener = AsyncIterableWithTimeout(listener, timeout, backend=backend)
+    timed_cancelable_listener = CancelableAsyncIterable(timed_listener, backend)
 
-    async for evt in timed_cancelable_listener:
+    recorder.add_on_stop_callback(lambda: timed_cancelable_listener.cancel())
+    if on_communication_finished is not None:
+        recorder.add_on_communication_finished_callback(on_communication_finished)
+    if stop_signal is not None:
+        backend.add_done_callback(stop_signal, timed_cancelable_listener.cancel)
+
+    async for item in timed_cancelable_listener:
+        # Events from a TargetAttacher carry the target that sent them
+        target_id, session, evt = unwrap_target_event(item)
+        # The network events may be RawEvents, which are dispatched without being parsed
+        evt_type = event_type(evt)
         # logger.debug("Event: %s", cheap_repr(evt))
-        if isinstance(evt, cdp.runtime.BindingCalled):
-            await recorder.on_binding_called(evt)
-
-        if isinstance(
-            evt,
-            (
-                cdp.network.RequestWillBeSent,
-                cdp.network.RequestWillBeSentExtraInfo,
-                cdp.network.ResponseReceived,
-                cdp.network.ResponseReceivedExtraInfo,
-            ),
+        if evt_type is cdp.runtime.BindingCalled:
+            await recorder.on_binding_called(materialize(evt))
+
+        if evt_type in (
+            cdp.network.RequestWillBeSent,
+            cdp.network.RequestWillBeSentExtraInfo,
+            cdp.network.ResponseReceived,
+            cdp.network.ResponseReceivedExtraInfo,
         ):
-            await recorder.on_http_data(evt)
-        if isinstance(evt, cdp.runtime.ExecutionContextCreated):
-            await recorder.on_execution_context_created(evt)
-        elif isinstance(evt, cdp.network.RequestWillBeSent):
+            await recorder.on_http_data(evt, target_id, session)
+        if evt_type is cdp.runtime.ExecutionContextCreated:
+            await recorder.on_execution_context_created(materialize(evt))
+        elif evt_type is cdp.network.RequestWillBeSent:
             await recorder.on_request_will_be_sent(evt)
-        elif isinstance(evt, cdp.network.RequestWillBeSentExtraInfo):
+        elif evt_type is cdp.network.RequestWillBeSentExtraInfo:
             await recorder.on_request_will_be_sent_extra_info(evt)
-        elif isinstance(evt, cdp.network.ResponseReceived):
+        elif evt_type is cdp.network.ResponseReceived:
             await recorder.on_response_received(evt)
-        elif isinstance(evt, cdp.network.ResponseReceivedExtraInfo):
+        elif evt_type is cdp.network.ResponseReceivedExtraInfo:
             await recorder.on_response_received_extra_info(evt)
-        elif isinstance(evt, cdp.network.LoadingFinished):
+        elif evt_type is cdp.network.LoadingFinished:
             await recorder.on_loading_finished(evt)
+        elif evt_type is cdp.network.LoadingFailed:
+            await recorder.on_loading_failed(evt)
 
-    return recorder.communications
-
+    await recorder.take_pending_input_actions(backend)
+    await recorder.drain()
+    recorder.finish_remaining_communications()
+    recorder.log_memory_usage()
+    if body_store is not None:
+        body_store.log_stats()
 
-class CDPConnection(_PyCDPConnection):
-    # Remove `retry_on` wrapper from function
-    connect = _PyCDPConnection.connect.__wrapped__  # type: ignore[attr-defined] # pylint: disable=no-member
+    return recorder.get_communications()
 
 
 def find_chrome_binary_path() -> str:
@@ -477,34 +1071,87 @@ class RecorderOptions:
     cdp_host: str = "localhost"
     cdp_port: int = 9222
     fail_if_no_connection: bool = False
+    # Directory of the on-disk capture log. If None, the capture is kept in memory.
+    capture_dir: Optional[str] = None
+    # Maximum number of body fetches in flight. If 0, the bodies are fetched inline.
+    body_fetch_concurrency: int = 8
+    # Maximum number of body fetches running or waiting, before event processing waits
+    body_fetch_max_pending: int = 256
+    # Fetch the bodies through a second CDP session, so they don't queue behind other commands
+    body_fetch_dedicated_session: bool = False
+    # Bodies longer than this many characters are decoded to temporary files. If None, all are kept in memory.
+    body_spool_threshold: Optional[int] = 1024 * 1024
+    # Also record the iframes, workers and popups of the page, each on its own CDP session
+    record_related_targets: bool = True
+    # Which bodies to skip, truncate or hash. If None, all are kept whole.
+    body_capture_policy: Optional[BodyCapturePolicy] = DEFAULT_BODY_CAPTURE_POLICY
+    # Make Chrome block the ad domains of the URL filter, so they produce fewer events
+    block_filtered_urls_in_browser: bool = True
+    # Make Chrome fail the requests of these types, e.g. Media and Font. They are never recorded.
+    blocked_resource_types: tuple[cdp.network.ResourceType, ...] = ()
+    # Show the Tk window that stops the recording. Headless recordings run without it.
+    show_control_window: bool = True
+    # Seconds after which the recording stops
+    record_timeout: float = 20
+    # Seconds to keep recording after a script ends, so the requests of its last step finish
+    script_settle_time: float = 2.0
+    # Initial size of the event buffers. A full buffer grows, up to `event_buffer_max_size` events.
+    event_buffer_size: int = 4096
+    event_buffer_max_size: int = 64 * 4096
+    # When a buffer can't grow, spill the events to disk. Otherwise, they are dropped.
+    event_buffer_spill: bool = True
+    # Keep the network events as JSON, and parse them only when the actions are generated
+    lazy_event_decoding: bool = True
+    # Bytes of finished communications kept in memory, before they are spilled to disk. If None, there's no limit.
+    # Not used with a capture log, which keeps everything on disk.
+    memory_budget: Optional[int] = None
+    # Directory of the spilled communications. If None, the system's temporary directory is used.
+    spill_dir: Optional[str] = None
+    # Keep the bodies once per content, compressed, and decompress them when the actions read them.
+    # Not used with a capture log.
+    deduplicate_bodies: bool = False
+    # Directory of the deduplicated bodies. If None, they are kept in memory.
+    body_store_dir: Optional[str] = None
+    # Seconds to wait for each open tab, when looking for the one the user is on
+    tab_probe_timeout: float = DEFAULT_PROBE_TIMEOUT
+    # Seconds to wait for a launched Chrome to accept DevTools connections
+    launch_timeout: float = DEFAULT_LAUNCH_TIMEOUT
+    # The event loop of the recording: "twisted" or "asyncio". On asyncio, the control window, the related
+    # targets, the body fetch pool, the event buffers and the tab probing are not available.
+    backend: str = "twisted"
 
     @property
     def cdp_url(self) -> str:
         return f"http://{self.cdp_host}:{self.cdp_port}"
 
 
-async def obtain_active_tab(
-    targets: list[cdp.target.TargetInfo], conn: CDPConnection
-) -> Optional[cdp.target.TargetInfo]:
-    if not targets:
-        return None
-
-    visible_targets = []
-    for target in targets:
-        session = await conn.connect_session(target.target_id)
-        await session.execute(cdp.runtime.enable())
-        ret, _ = await session.execute(cdp.runtime.evaluate("document.hidden"))
-        if not ret.type_ == "boolean" or ret.value is not True:
-            visible_targets.append(target)
-        ret, _ = await session.execute(cdp.runtime.evaluate("browser.tabs"))
-
-    if len(visible_targets) == 1:
-        return visible_targets[0]
+async def connect_to_chrome(options: RecorderOptions, backend: Optional[EventLoopBackend] = None) -> CDPConnection:
+    """Connects to the browser at `options.cdp_url`. If none listens there,
+    Chrome is launched, unless `options.fail_if_no_connection`."""
+    backend = backend if backend is not None else get_backend()
+    try:
+        return cast(CDPConnection, await backend.connect(options.cdp_url))
+    except backend.connection_refused_error:
+        if options.fail_if_no_connection:
+            raise
+        port = options.cdp_port
+        chrome = ChromeLauncher(
+            binary=options.binary,
+            args=[f"--remote-debugging-port={port}", "--incognito"],
+        )
+        await backend.run_in_thread(chrome.launch)
+        # The browser takes a while to listen, after the launch returns
+        await backend.run_in_thread(wait_for_devtools, options.cdp_url, options.launch_timeout)
 
-    return None
+    return cast(CDPConnection, await backend.connect(options.cdp_url))
 
 
-async def obtain_cdp_target_id(conn: CDPConnection) -> cdp.target.TargetID:
+async def obtain_cdp_target_id(
+    conn: CDPConnection, probe_timeout: float = DEFAULT_PROBE_TIMEOUT, probe_tabs: bool = True
+) -> cdp.target.TargetID:
+    """Returns the tab to record: the only tab, or the one the user is on.
+    If there's no such tab, or if `probe_tabs` is False and there are
+    several, a new tab is opened."""
     targets = await conn.execute(cdp.target.get_targets())
     page_targets = []
     for target in targets:
@@ -514,8 +1161,8 @@ async def obtain_cdp_target_id(conn: CDPConnection) -> cdp.target.TargetID:
     desired_target = None
     if len(page_targets) == 1:
         desired_target = page_targets[0]
-    elif len(page_targets) > 0:
-        desired_target = await obtain_active_tab(page_targets, conn)
+    elif len(page_targets) > 0 and probe_tabs:
+        desired_target = await obtain_active_tab(page_targets, conn, probe_timeout)
 
     if desired_target:
         return desired_target.target_id
@@ -548,24 +1195,26 @@ class WidgetState:
         await self.target_session.execute(cdp.runtime.evaluate("startTimerIfElemLoaded()", context_id=self.context_id))
         self.start_time = time.time()
 
-    async def _send_state_elapsed(self, start_time: float) -> None:
+    def _state_elapsed_command(self, start_time: float) -> Generator[T_JSON_DICT, T_JSON_DICT, Any]:
         elapsed = time.time() - start_time
         if self.stop_time is not None:
             elapsed = self.stop_time - start_time
-        await self.target_session.execute(
-            cdp.runtime.evaluate(f"setTimerElapsed({elapsed})", context_id=self.context_id)
-        )
+        return cdp.runtime.evaluate(f"setTimerElapsed({elapsed})", context_id=self.context_id)
 
-    async def _send_state_pos(self, top: str, right: str, bottom: str, left: str) -> None:
+    def _state_pos_command(
+        self, top: str, right: str, bottom: str, left: str
+    ) -> Generator[T_JSON_DICT, T_JSON_DICT, Any]:
         # Lucky that strings are represented the same in Python and JavaScript
         expression = f"setWidgetPos({top!r}, {right!r}, {bottom!r}, {left!r})"
-        await self.target_session.execute(cdp.runtime.evaluate(expression, context_id=self.context_id))
+        return cdp.runtime.evaluate(expression, context_id=self.context_id)
 
     async def send_state(self) -> None:
+        commands = []
         if self.start_time is not None:
-            await self._send_state_elapsed(self.start_time)
+            commands.append(self._state_elapsed_command(self.start_time))
         if self.top is not None and self.right is not None and self.bottom is not None and self.left is not None:
-            await self._send_state_pos(self.top, self.right, self.bottom, self.left)
+            commands.append(self._state_pos_command(self.top, self.right, self.bottom, self.left))
+        await execute_pipelined(self.target_session, commands)
 
 
 # This function isn't used for now, because it doesn't work properly
@@ -595,9 +1244,11 @@ async def bind_func_to_context_id(
 
 async def init_runtime_scripts(
     target_session: pycdp.twisted.CDPSession,
+    backend: Optional[EventLoopBackend] = None,
 ) -> RuntimeContext:
-    listener_context_name, listener_context_id = await insert_js_action_listener(target_session)
+    listener_context_name, listener_context_id = await insert_js_action_listener(target_session, backend)
     await bind_func_to_context_id(target_session, RuntimeContext.EVENT_SEND_BINDING, listener_context_id)
+    await insert_js_send_hooks(target_session)
 
     runtime = RuntimeContext(
         target_session,
@@ -627,13 +1278,21 @@ class RuntimeContext:
         self.stop_time: Optional[float] = None
 
         self.actions: list[InputAction] = []
+        # The counters of event_listener.js in the pages that were left, added up
+        self.left_page_stats: dict[str, float] = {}
 
     async def on_event_send(self, payload: str) -> None:
+        """Reads the events sent by event_listener.js. It sends a batch of
+        events as a list."""
         data = json.loads(payload)
+        events = data if isinstance(data, list) else [data]
 
-        if data["event"] == "input":
-            action = InputAction(data["value"], data["selector"], data["timestamp"])
-            self.actions.append(action)
+        for event in events:
+            if event["event"] == "input":
+                action = InputAction(event["value"], event["selector"], event["timestamp"])
+                self.actions.append(action)
+            elif event["event"] == "stats":
+                add_page_stats(self.left_page_stats, event["stats"])
 
     async def on_binding_called(self, evt: cdp.runtime.BindingCalled) -> None:
         if evt.name == self.EVENT_SEND_BINDING:
@@ -644,11 +1303,42 @@ class RuntimeContext:
             self.listener_context_id = evt.context.id_
             await bind_func_to_context_id(self.target_session, self.EVENT_SEND_BINDING, self.listener_context_id)
 
+    async def take_pending_events(self) -> None:
+        """Reads the events that event_listener.js batched, but didn't send
+        yet. Called when the recording stops, as the calls of the binding
+        aren't read anymore then."""
+        result, exception = await self.target_session.execute(
+            cdp.runtime.evaluate("takeRecordedEvents()", context_id=self.listener_context_id, return_by_value=True)
+        )
+        if exception is None and result.value is not None:
+            await self.on_event_send(result.value)
+
     def pop_actions(self) -> list[InputAction]:
         actions = self.actions
         self.actions = []
         return actions
 
+    async def get_page_stats(self) -> Optional[dict[str, float]]:
+        """Returns the counters of event_listener.js: the events it handled,
+        the time it took, and its selector cache. Those of the current page
+        are added to those of the pages that were left."""
+        result, exception = await self.target_session.execute(
+            cdp.runtime.evaluate("recorderStats", context_id=self.listener_context_id, return_by_value=True)
+        )
+        stats = dict(self.left_page_stats)
+        if exception is None and result.value:
+            add_page_stats(stats, result.value)
+        return stats or None
+
+
+def add_page_stats(total: dict[str, float], stats: dict[str, float]) -> None:
+    """Adds the counters of event_listener.js in a page to `total`."""
+    for key, value in stats.items():
+        if key == "maxHandlerTime":
+            total[key] = max(total.get(key, 0), value)
+        else:
+            total[key] = total.get(key, 0) + value
+
 
 RUNTIME_CONTEXT: Optional[RuntimeContext] = None
 
@@ -688,69 +1378,283 @@ async def insert_widget_extension(
     return await insert_js_leech_script(target_session, expression)
 
 
+async def _report_page_stats(
+    runtime: RuntimeContext, backend: EventLoopBackend, capture_log: Optional[CaptureLogWriter]
+) -> None:
+    """Logs how much work event_listener.js did in all the recorded pages,
+    and writes it next to the capture log."""
+    try:
+        stats = await backend.with_timeout(runtime.get_page_stats(), PAGE_STATS_TIMEOUT)
+    except Exception as exc:  # pylint: disable=broad-exception-caught
+        # The page may be gone already, only the pages that were left are counted
+        logger.debug("Could not read the counters of the page: %s", exc)
+        stats = runtime.left_page_stats
+    if not stats:
+        return
+
+    lookups = stats["selectorCacheHits"] + stats["selectorCacheMisses"]
+    logger.info(
+        "Page listener: %d events, %.1f ms in handlers (max %.1f ms), %.1f ms sending %d batches, "
+        "selector cache hit rate %.0f%%, %d invalidations in %.1f ms",
+        stats["events"],
+        stats["handlerTime"],
+        stats["maxHandlerTime"],
+        stats["sendTime"],
+        stats["batches"],
+        100 * stats["selectorCacheHits"] / lookups if lookups else 0,
+        stats["selectorInvalidations"],
+        stats["observerTime"],
+    )
+    if capture_log is not None:
+        with open(os.path.join(capture_log.directory, PAGE_STATS_FILE), "w", encoding="utf8") as file:
+            json.dump(stats, file, indent=2)
+
+
+async def _run_script(
+    script: RecordingScript,
+    target_session: pycdp.twisted.CDPSession,
+    settle_time: float,
+    stop_signal: Any,
+    backend: EventLoopBackend,
+) -> None:
+    try:
+        await script(target_session)
+        await backend.sleep(settle_time)
+    finally:
+        backend.set_result(stop_signal, None)
+
+
+# The options of the features that need Twisted, and their values when turned off
+_TWISTED_ONLY_OPTIONS = {
+    "show_control_window": False,
+    "record_related_targets": False,
+    "body_fetch_concurrency": 0,
+}
+
+
+def _restrict_to_backend(options: RecorderOptions, backend: EventLoopBackend) -> RecorderOptions:
+    """Turns off the features that the backend can't run."""
+    if isinstance(backend, TwistedBackend):
+        return options
+
+    changes: dict[str, Any] = {
+        name: value for name, value in _TWISTED_ONLY_OPTIONS.items() if getattr(options, name) != value
+    }
+    if changes:
+        logger.warning("Turned off %s, which the %s backend can't run", ", ".join(changes), backend.name)
+    return dataclasses.replace(options, **changes)
+
+
 async def record(
     options: RecorderOptions,
-) -> list[Union[HttpCommunication, InputAction]]:
-    urlfilter = filters.URLFilter()
+    urlfilter: Optional[filters.URLFilter] = None,
+    script: Optional[RecordingScript] = None,
+    on_communication_finished: Optional[CommunicationCallback] = None,
+    chrome_pool: Optional[ChromePool] = None,
+) -> Iterable[Union[HttpCommunication, InputAction]]:
+    """Records a page, until the timeout or until the user stops it.
 
+    Args:
+        options: The recorder options.
+        urlfilter: Tells which URLs to ignore. If None, the cached filter
+            list is loaded.
+        script: If given, it drives the page instead of a user. The
+            recording stops a little after the script ends. Errors of the
+            script are raised after the recording is closed.
+        on_communication_finished: Called with each communication as soon
+            as it is complete. See collect_communications.
+        chrome_pool: If given, the page is opened in a new browser context,
+            in a browser of the pool, instead of the browser at
+            `options.cdp_url`. Only with the twisted backend.
+    """
+    backend = get_backend(options.backend)
+    options = _restrict_to_backend(options, backend)
+    twisted_backend = isinstance(backend, TwistedBackend)
+    if chrome_pool is not None and not twisted_backend:
+        raise ValueError("The browser pool runs only on the twisted backend")
+
+    if urlfilter is None:
+        urlfilter = await filters.load_url_filter()
+
+    if chrome_pool is None:
+        conn = await connect_to_chrome(options, backend)
+        target_id = await obtain_cdp_target_id(conn, options.tab_probe_timeout, probe_tabs=twisted_backend)
+        return await _record_target(options, urlfilter, conn, target_id, script, on_communication_finished, backend)
+
+    browser = await chrome_pool.acquire()
+    healthy = False
     try:
-        conn = CDPConnection(options.cdp_url, Agent(reactor), reactor)  # type: ignore[no-untyped-call]
-        await conn.connect()
-    except ConnectionRefusedError:
-        if options.fail_if_no_connection:
-            raise ConnectionRefusedError
-        port = options.cdp_port
-        chrome = ChromeLauncher(
-            binary=options.binary,
-            args=[f"--remote-debugging-port={port}", "--incognito"],
+        conn = cast(CDPConnection, await backend.connect(browser.cdp_url))
+        context_id, target_id = await open_isolated_target(conn)
+        communications = await _record_target(
+            options, urlfilter, conn, target_id, script, on_communication_finished, backend, context_id
         )
-        await threads.deferToThread(chrome.launch)  # type: ignore[no-untyped-call]
-        await conn.connect()
-
-    target_id = await obtain_cdp_target_id(conn)
-    target_session = await conn.connect_session(target_id)
-    await target_session.execute(cdp.page.enable())
-    await target_session.execute(cdp.page.bring_to_front())
-
-    # Clean remaining data from possible previous run
-    await target_session.execute(cdp.runtime.disable())
-    await target_session.execute(cdp.runtime.enable())
-
-    await target_session.execute(cdp.network.enable())
-
-    # Start the listener before navigating to the page
-    listener = target_session.listen(
-        cdp.runtime.BindingCalled,
-        cdp.runtime.ExecutionContextCreated,
-        cdp.network.RequestWillBeSent,
-        cdp.network.RequestWillBeSentExtraInfo,
-        cdp.network.ResponseReceived,
-        cdp.network.ResponseReceivedExtraInfo,
-        cdp.network.LoadingFinished,
-        buffer_size=4096,
-    )
+        healthy = True
+    finally:
+        await chrome_pool.release(browser, healthy)
+
+    return communications
+
+
+async def _record_target(
+    options: RecorderOptions,
+    urlfilter: filters.URLFilter,
+    conn: CDPConnection,
+    target_id: cdp.target.TargetID,
+    script: Optional[RecordingScript],
+    on_communication_finished: Optional[CommunicationCallback],
+    backend: EventLoopBackend,
+    browser_context_id: Optional[cdp.browser.BrowserContextID] = None,
+) -> Iterable[Union[HttpCommunication, InputAction]]:
+    # Created first, so a directory that already holds a capture log is rejected before the browser is touched
+    capture_log = None
+    if options.capture_dir is not None:
+        capture_log = CaptureLogWriter(options.capture_dir)
 
-    if options.start_url:
-        start_url = options.start_url
-        await target_session.execute(cdp.page.navigate(start_url))
-    else:
-        info = await target_session.execute(cdp.target.get_target_info())
-        # The path of this can be set with the History API
-        # But the origin can't be changed
-        start_url = info.url
+    try:
+        target_session = await conn.connect_session(target_id)
+        await execute_pipelined(
+            target_session,
+            [
+                cdp.page.enable(),
+                cdp.page.bring_to_front(),
+                # Clean remaining data from possible previous run
+                cdp.runtime.disable(),
+                cdp.runtime.enable(),
+                cdp.network.enable(),
+            ],
+            backend,
+        )
 
-    runtime = await init_runtime_scripts(target_session)
+        resource_type_blocker = None
+        if not options.collect_all:
+            if options.block_filtered_urls_in_browser:
+                await block_filtered_urls(target_session, urlfilter)
+            resource_type_blocker = ResourceTypeBlocker(target_session, options.blocked_resource_types, backend)
+            await resource_type_blocker.start()
+
+        # Start the listener before navigating to the page
+        event_types = (cdp.runtime.BindingCalled, cdp.runtime.ExecutionContextCreated, *NETWORK_EVENTS)
+        raw_event_types = NETWORK_EVENTS if options.lazy_event_decoding else ()
+        target_attacher = None
+        listener: AsyncIterable[object]
+        event_buffers: list[AdaptiveEventQueue[Any]]
+        if options.record_related_targets:
+            target_attacher = TargetAttacher(
+                conn,
+                target_session,
+                target_id,
+                event_types,
+                options.event_buffer_size,
+                options.event_buffer_max_size,
+                options.event_buffer_spill,
+                raw_event_types,
+            )
+            await target_attacher.start()
+            listener = target_attacher
+            event_buffers = target_attacher.buffers
+        elif isinstance(backend, TwistedBackend):
+            listener = listen_adaptive(
+                target_session,
+                event_types,
+                "page",
+                options.event_buffer_size,
+                options.event_buffer_max_size,
+                options.event_buffer_spill,
+                raw_event_types,
+            )
+            event_buffers = [listener]
+        else:
+            # The adaptive buffers are built on Deferreds
+            listener = target_session.listen(*event_types, buffer_size=options.event_buffer_max_size)
+            event_buffers = []
 
-    start_origin = None
-    if options.keep_only_same_origin_urls:
-        start_origin = extract_origin(start_url)
+        if options.start_url:
+            start_url = options.start_url
+            await target_session.execute(cdp.page.navigate(start_url))
+        else:
+            info = await target_session.execute(cdp.target.get_target_info())
+            # The path of this can be set with the History API
+            # But the origin can't be changed
+            start_url = info.url
+
+        runtime = await init_runtime_scripts(target_session, backend)
+
+        start_origin = None
+        if options.keep_only_same_origin_urls:
+            start_origin = extract_origin(start_url)
+
+        body_fetch_pool = None
+        if options.body_fetch_concurrency > 0:
+            fetch_session = target_session
+            if options.body_fetch_dedicated_session:
+                fetch_session = await conn.connect_session(target_id)
+                await fetch_session.execute(cdp.network.enable())
+            body_fetch_pool = BodyFetchPool(
+                fetch_session,
+                options.body_fetch_concurrency,
+                options.body_fetch_max_pending,
+                options.body_spool_threshold,
+            )
+
+        script_task = None
+        stop_signal = None
+        if script is not None:
+            stop_signal = backend.create_future()
+            script_task = backend.spawn(
+                _run_script(script, target_session, options.script_settle_time, stop_signal, backend)
+            )
+    except BaseException:
+        if capture_log is not None:
+            capture_log.close()
+        raise
 
     try:
         communications = await collect_communications(
-            target_session, listener, urlfilter, 20, options.collect_all, start_origin
+            target_session,
+            listener,
+            urlfilter,
+            timeout=options.record_timeout,
+            collect_all=options.collect_all,
+            start_origin=start_origin,
+            capture_log=capture_log,
+            body_fetch_pool=body_fetch_pool,
+            body_spool_threshold=options.body_spool_threshold,
+            body_capture_policy=options.body_capture_policy,
+            ignored_resource_types=options.blocked_resource_types,
+            runtime_context=runtime,
+            show_control_window=options.show_control_window,
+            stop_signal=stop_signal,
+            on_communication_finished=on_communication_finished,
+            memory_budget=options.memory_budget,
+            spill_dir=options.spill_dir,
+            backend=backend,
+            body_store=BodyStore(options.body_store_dir) if options.deduplicate_bodies else None,
         )
     finally:
+        if script_task is not None and not backend.is_done(script_task):
+            logger.warning("The recording timed out before the script ended")
+            script_task.cancel()
+        if resource_type_blocker is not None:
+            await resource_type_blocker.stop()
+        if target_attacher is not None:
+            event_buffers = target_attacher.buffers
+            target_attacher.stop()
         target_session.close_listeners()
+        await _report_page_stats(runtime, backend, capture_log)
+        if browser_context_id is not None:
+            await close_isolated_target(conn, browser_context_id)
         await conn.close()
+        log_buffer_stats(event_buffers)
+        if capture_log is not None:
+            write_buffer_stats(os.path.join(capture_log.directory, BUFFER_STATS_FILE), event_buffers)
+            capture_log.close()
+
+    if script_task is not None:
+        try:
+            # Raises the errors of the script
+            await script_task
+        except backend.cancelled_error:
+            pass
 
     return communications
@@ -0,0 +1,360 @@
+"""
+This module replays the requests of actions, over pooled connections.
+
+Each host gets its own requests.Session, with a connection pool, so the
+requests to a host reuse the same kept-alive connections instead of a TCP
+and TLS handshake each. The sessions share one cookie jar, so the cookies
+set by a response are sent with the next requests, like in the browser. The
+cookies of an action are sent over the ones of the jar.
+
+A request is prepared once per method, url, headers and body, and copied for
+the next sends. Only the cookies are prepared at each send.
+
+The targets of a request read the earlier actions at the indexes of their
+sources, so they tell which requests must be sent before it. `run` sends the
+requests that don't depend on each other at the same time, in threads, and
+compares its critical path with the time the requests would take one after
+another.
+
+The classes of this module are copied into the generated scripts, so they
+only use requests and the standard library.
+
+Classes:
+    - RequestTiming: The time a replayed request took.
+    - ReplayRun: The actions and the timings of a concurrent replay.
+    - ReplayEngine: Sends the requests of RequestActions, with a pooled
+    session per host, one by one or following their dependencies.
+"""
+
+from __future__ import annotations
+
+import copy
+import threading
+import time
+import urllib.parse
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Iterable, Optional, Sequence
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .action import RequestAction, ResponseAction, response_action_from_python_response
+
+if TYPE_CHECKING:
+    from .action import HttpAction
+
+
+class RequestTiming:
+    def __init__(self, method: str, url: str, status: int, elapsed: float):
+        self.method = method
+        self.url = url
+        self.status = status
+        # Seconds from sending the request to receiving the whole response
+        self.elapsed = elapsed
+
+    def __repr__(self) -> str:
+        return f"{self.method} {self.url} - {self.status} ({self.elapsed * 1000:.1f} ms)"
+
+
+class ReplayRun:
+    """The result of `ReplayEngine.run`.
+
+    Attributes:
+        actions: The replayed requests and their responses, at the indexes of
+            the recorded actions. The other indexes are None.
+        timings: The timing of each request, by index.
+        dependencies: The requests each request waited for, by index.
+        wall_time: Seconds from the first request sent to the last response.
+    """
+
+    def __init__(
+        self,
+        actions: list[Optional[HttpAction]],
+        timings: dict[int, RequestTiming],
+        dependencies: dict[int, set[int]],
+        wall_time: float,
+    ):
+        self.actions = actions
+        self.timings = timings
+        self.dependencies = dependencies
+        self.wall_time = wall_time
+
+    @property
+    def sequential_time(self) -> float:
+        """Seconds the requests would take, sent one after another."""
+        return sum(timing.elapsed for timing in self.timings.values())
+
+    def critical_path(self) -> list[int]:
+        """Returns the indexes of the longest chain of requests that waited for
+        each other, in order. No schedule can take less than this chain."""
+        finish: dict[int, float] = {}
+        previous: dict[int, Optional[int]] = {}
+        # A request only depends on earlier ones
+        for index in sorted(self.timings):
+            before = max(self.dependencies.get(index, ()), key=lambda dep: finish[dep], default=None)
+            previous[index] = before
+            finish[index] = self.timings[index].elapsed + (finish[before] if before is not None else 0.0)
+
+        path: list[int] = []
+        last = max(finish, key=lambda index: finish[index], default=None)
+        while last is not None:
+            path.append(last)
+            last = previous[last]
+        return path[::-1]
+
+    @property
+    def critical_path_time(self) -> float:
+        return sum(self.timings[index].elapsed for index in self.critical_path())
+
+    def summary(self) -> str:
+        return (
+            f"{len(self.timings)} requests in {self.wall_time * 1000:.1f} ms, "
+            f"critical path {self.critical_path_time * 1000:.1f} ms ({len(self.critical_path())} requests), "
+            f"sequential {self.sequential_time * 1000:.1f} ms"
+        )
+
+
+class ReplayEngine:
+    """Sends the requests of RequestActions, without following redirects.
+
+    Args:
+        pool_connections: Number of connection pools kept by the session of
+            a host, one per scheme and port.
+        pool_maxsize: Number of connections kept open in a pool.
+        max_retries: Retries of a request whose connection failed.
+        timeout: Seconds to wait for the server, or None to wait forever.
+        max_templates: Number of prepared requests kept for the next sends.
+    """
+
+    def __init__(
+        self,
+        pool_connections: int = 10,
+        pool_maxsize: int = 10,
+        max_retries: int = 0,
+        timeout: Optional[float] = None,
+        max_templates: int = 1024,
+    ):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_templates = max_templates
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.sessions: dict[tuple[str, str], requests.Session] = {}
+        self.timings: list[RequestTiming] = []
+        self._templates: dict[tuple[Any, ...], requests.PreparedRequest] = {}
+        # The requests are sent from several threads by `run`
+        self._lock = threading.Lock()
+
+    def get_session(self, url: str) -> requests.Session:
+        """Returns the session of the host of `url`."""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize,
+                    max_retries=self.max_retries,
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                session.cookies = self.cookies
+                self.sessions[key] = session
+        return session
+
+    def prepare(self, action: RequestAction) -> requests.PreparedRequest:
+        """Returns the prepared request of an action, with its cookies and the
+        cookies of the jar."""
+        headers = action.headers or {}
+        key = (action.method, action.url, tuple(headers.items()), action.body)
+        with self._lock:
+            template = self._templates.get(key)
+        if template is None:
+            request = requests.Request(method=action.method, url=action.url, headers=headers, data=action.body)
+            template = request.prepare()
+            with self._lock:
+                if len(self._templates) >= self.max_templates:
+                    # Drops the oldest template
+                    del self._templates[next(iter(self._templates))]
+                self._templates[key] = template
+
+        prepared = template.copy()
+        # The jar is read under its lock, since responses may be adding cookies
+        prepared.prepare_cookies(self.cookies)
+        action_cookies = action.cookies_to_dict()
+        if action_cookies:
+            pairs = prepared.headers.get("Cookie", "").split("; ")
+            pairs = [pair for pair in pairs if pair and pair.split("=", 1)[0] not in action_cookies]
+            pairs += [f"{name}={value}" for name, value in action_cookies.items()]
+            prepared.headers["Cookie"] = "; ".join(pairs)
+        return prepared
+
+    def _send(self, action: RequestAction) -> tuple[requests.Response, RequestTiming]:
+        prepared = self.prepare(action)
+        session = self.get_session(prepared.url or "")
+        start = time.perf_counter()
+        response = session.send(prepared, allow_redirects=False, timeout=self.timeout)
+        elapsed = time.perf_counter() - start
+        timing = RequestTiming(prepared.method or "", prepared.url or "", response.status_code, elapsed)
+        self.timings.append(timing)
+        return response, timing
+
+    def send(self, action: RequestAction) -> requests.Response:
+        """Sends the request of an action, and records how long it took."""
+        return self._send(action)[0]
+
+    @staticmethod
+    def source_indexes(source: Any) -> set[int]:
+        """Returns the indexes of the actions that a target or a source reads.
+        The sources are walked by their attributes, so that the copies of the
+        classes in the generated scripts are walked too."""
+        indexes: set[int] = set()
+        stack = [source]
+        while stack:
+            obj = stack.pop()
+            index = getattr(obj, "index", None)
+            if isinstance(index, int):
+                indexes.add(index)
+            for name in ("source", "upper_source"):
+                child = getattr(obj, name, None)
+                if child is not None:
+                    stack.append(child)
+            stack.extend(getattr(obj, "targets", None) or ())
+            for pair in getattr(obj, "qlist", None) or ():
+                stack.extend(item for item in pair if not isinstance(item, str))
+        return indexes
+
+    def dependencies(
+        self, actions: Sequence[Any], barriers: Iterable[int] = (), wait_for_cookies: bool = True
+    ) -> dict[int, set[int]]:
+        """Returns, for the index of each request, the indexes of the requests
+        that must be answered before it's sent.
+
+        Args:
+            actions: The recorded actions, each request followed by its
+                response.
+            barriers: Indexes of requests sent after all the earlier ones are
+                answered, and before all the later ones.
+            wait_for_cookies: The requests whose recorded response set cookies
+                are answered before the later requests are sent, since the
+                cookies are sent from the shared jar and not from targets.
+        """
+        barriers = set(barriers)
+        # The request whose replay gives the action at each index
+        producers: dict[int, int] = {}
+        requests_since_barrier: list[int] = []
+        cookie_requests: list[int] = []
+        last_barrier: Optional[int] = None
+        dependencies: dict[int, set[int]] = {}
+        last_request: Optional[int] = None
+        for index, action in enumerate(actions):
+            if isinstance(action, ResponseAction):
+                if last_request is not None:
+                    producers[index] = last_request
+                continue
+            if not isinstance(action, RequestAction):
+                continue
+
+            producers[index] = index
+            last_request = index
+            deps: set[int] = set()
+            for target in getattr(action, "targets", None) or ():
+                deps.update(producers[source] for source in self.source_indexes(target) if source in producers)
+            deps.discard(index)
+            deps.update(cookie_requests)
+            if last_barrier is not None:
+                deps.add(last_barrier)
+            if index in barriers:
+                deps.update(requests_since_barrier)
+                last_barrier = index
+                requests_since_barrier = []
+                cookie_requests = []
+            else:
+                requests_since_barrier.append(index)
+            dependencies[index] = deps
+
+            response = actions[index + 1] if index + 1 < len(actions) else None
+            if wait_for_cookies and isinstance(response, ResponseAction):
+                if "set-cookie" in (response.headers or {}) or response.cookies:
+                    cookie_requests.append(index)
+
+        return dependencies
+
+    def _replay_step(self, actions: Sequence[Any], replayed: list[Optional[HttpAction]], index: int) -> RequestTiming:
+        """Sends the request at `index`, with its targets applied, after the
+        requests it depends on were replayed."""
+        action = copy.copy(actions[index])
+        # The targets change the copy, not the recorded action
+        action.headers = dict(action.headers or {})
+        action.cookies = list(action.cookies or [])
+        for target in getattr(action, "targets", None) or ():
+            target.apply(action, replayed)
+        replayed[index] = action
+
+        response, timing = self._send(action)
+        if index + 1 < len(actions) and isinstance(actions[index + 1], ResponseAction):
+            replayed[index + 1] = response_action_from_python_response(response)
+        return timing
+
+    def run(
+        self,
+        actions: Sequence[Any],
+        workers: int = 8,
+        barriers: Iterable[int] = (),
+        wait_for_cookies: bool = True,
+    ) -> ReplayRun:
+        """Replays the requests of the recorded actions, with their targets
+        applied. A request is sent as soon as the requests it depends on are
+        answered, up to `workers` at a time. See `dependencies` for
+        `barriers` and `wait_for_cookies`."""
+        dependencies = self.dependencies(actions, barriers, wait_for_cookies)
+        replayed: list[Optional[HttpAction]] = [None] * len(actions)
+        timings: dict[int, RequestTiming] = {}
+
+        waiting = {index: set(deps) for index, deps in dependencies.items()}
+        dependents: dict[int, list[int]] = {index: [] for index in dependencies}
+        for index, deps in dependencies.items():
+            for dep in deps:
+                dependents[dep].append(index)
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running: dict[Future[RequestTiming], int] = {}
+            for index, deps in dependencies.items():
+                if not deps:
+                    running[pool.submit(self._replay_step, actions, replayed, index)] = index
+
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda future: running[future]):
+                    index = running.pop(future)
+                    timings[index] = future.result()
+                    for dependent in dependents[index]:
+                        waiting[dependent].discard(index)
+                        if not waiting[dependent]:
+                            running[pool.submit(self._replay_step, actions, replayed, dependent)] = dependent
+
+        return ReplayRun(replayed, timings, dependencies, time.perf_counter() - start)
+
+    def summary(self) -> str:
+        total = sum(timing.elapsed for timing in self.timings)
+        return f"{len(self.timings)} requests in {total * 1000:.1f} ms, to {len(self.sessions)} hosts"
+
+    def report(self) -> str:
+        """Returns the timings of the requests sent, one per line, and their
+        summary."""
+        return "\n".join([repr(timing) for timing in self.timings] + [self.summary()])
+
+    def close(self) -> None:
+        """Closes the connections. They're opened again by the next sends."""
+        for session in self.sessions.values():
+            session.close()
+
+    def __enter__(self) -> ReplayEngine:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
@@ -0,0 +1,25 @@
+// Runs in the page's own world, where its fetch and XMLHttpRequest are.
+// event_listener.js runs in an isolated world, and batches the typed values.
+// Before the page sends a request, which may carry what was just typed, it's
+// told to send its batch, so the input actions come before the request.
+(() => {
+    const notifyRecorder = () => {
+        // Dispatched synchronously to the listeners of every world
+        document.dispatchEvent(new Event('cdprecorder-flush'));
+    }
+
+    const wrapSender = (owner, name) => {
+        const send = owner && owner[name];
+        if (typeof send != 'function') {
+            return;
+        }
+        owner[name] = function (...args) {
+            notifyRecorder();
+            return send.apply(this, args);
+        };
+    }
+
+    wrapSender(window, 'fetch');
+    wrapSender(window.XMLHttpRequest && XMLHttpRequest.prototype, 'send');
+    wrapSender(window.navigator, 'sendBeacon');
+})();
@@ -0,0 +1,189 @@
+"""
+This module finds the tab that the user is looking at, among the tabs of a
+browser. Each tab is probed on its own CDP session, concurrently, with a
+timeout, and the sessions are detached afterwards.
+
+The visibility of the tabs is cached on disk. The next run probes first the
+tabs that were visible last time, and if only one of them is still
+visible, the other tabs are not probed at all.
+
+Classes:
+    - TabVisibilityCache: The on-disk cache of the tabs' visibility.
+
+Functions:
+    - probe_tab_hidden: Reads `document.hidden` in a tab.
+    - obtain_active_tab: Returns the only visible tab, if there is one.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from typing import TYPE_CHECKING, Iterable, Optional, cast
+
+import pycdp
+import twisted.internet.reactor
+from pycdp import cdp
+from twisted.internet import defer
+from twisted.internet.interfaces import IReactorTime
+
+from . import logger
+from .filters import DEFAULT_CACHE_DIR
+
+if TYPE_CHECKING:
+    import pycdp.twisted
+
+
+# Seconds to wait for a tab to answer. Discarded and frozen tabs may never answer.
+DEFAULT_PROBE_TIMEOUT = 2.0
+# Tabs probed at once
+DEFAULT_PROBE_CONCURRENCY = 16
+
+
+class TabVisibilityCache:
+    """Keeps `document.hidden` of the tabs from the last run, by target id.
+    A tab whose URL changed since is treated as unknown."""
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR):
+        self.path = os.path.join(directory, "tabs.json")
+
+    def load(self) -> dict[str, dict[str, object]]:
+        try:
+            with open(self.path, encoding="utf8") as file:
+                tabs: dict[str, dict[str, object]] = json.load(file)
+            return tabs
+        except (OSError, ValueError):
+            return {}
+
+    def visible_tabs(self, targets: Iterable[cdp.target.TargetInfo]) -> list[cdp.target.TargetInfo]:
+        """Returns the targets that were visible in the last run, at the same URL."""
+        tabs = self.load()
+        visible = []
+        for target in targets:
+            tab = tabs.get(str(target.target_id))
+            if tab is not None and tab.get("url") == target.url and tab.get("hidden") is False:
+                visible.append(target)
+        return visible
+
+    def save(self, targets: Iterable[cdp.target.TargetInfo], hidden: dict[cdp.target.TargetID, bool]) -> None:
+        """Stores the visibility of the probed targets. The tabs that are no
+        longer open are dropped."""
+        tabs = self.load()
+        tabs = {
+            str(target.target_id): (
+                {"url": target.url, "hidden": hidden[target.target_id]}
+                if target.target_id in hidden
+                else tabs[str(target.target_id)]
+            )
+            for target in targets
+            if target.target_id in hidden or str(target.target_id) in tabs
+        }
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w", encoding="utf8") as file:
+                json.dump(tabs, file)
+            os.replace(tmp_path, self.path)
+        except OSError as exc:
+            logger.debug("Could not cache the visibility of the tabs: %s", exc)
+
+
+async def _detach(conn: pycdp.twisted.CDPConnection, session: pycdp.twisted.CDPSession) -> None:
+    try:
+        await conn.execute(cdp.target.detach_from_target(session_id=session.session_id))
+    except pycdp.exceptions.CDPError:
+        pass
+    conn.remove_session(session.session_id)
+
+
+async def probe_tab_hidden(
+    conn: pycdp.twisted.CDPConnection,
+    target: cdp.target.TargetInfo,
+    timeout: float = DEFAULT_PROBE_TIMEOUT,
+    clock: Optional[IReactorTime] = None,
+) -> Optional[bool]:
+    """Returns `document.hidden` of a tab, or None if the tab didn't answer
+    in time, or couldn't be read."""
+    clock = clock if clock is not None else cast(IReactorTime, twisted.internet.reactor)
+    session: Optional[pycdp.twisted.CDPSession] = None
+
+    async def probe() -> Optional[bool]:
+        nonlocal session
+        session = await conn.connect_session(target.target_id)
+        ret, _ = await session.execute(cdp.runtime.evaluate("document.hidden"))
+        return ret.value if ret.type_ == "boolean" else None
+
+    probing = defer.ensureDeferred(probe())
+    probing.addTimeout(timeout, clock)
+    try:
+        return await probing
+    except defer.TimeoutError:
+        logger.debug("Tab %s didn't answer in %.1f seconds: %s", target.target_id, timeout, target.url)
+        return None
+    except pycdp.exceptions.CDPError:
+        logger.debug("Could not probe tab %s: %s", target.target_id, target.url)
+        return None
+    finally:
+        if session is not None:
+            detaching = defer.ensureDeferred(_detach(conn, session))
+            detaching.addTimeout(timeout, clock)
+            try:
+                await detaching
+            except defer.TimeoutError:
+                logger.debug("Could not detach from tab %s", target.target_id)
+
+
+async def _probe_tabs(
+    conn: pycdp.twisted.CDPConnection,
+    targets: list[cdp.target.TargetInfo],
+    timeout: float,
+    concurrency: int,
+    clock: Optional[IReactorTime],
+) -> dict[cdp.target.TargetID, Optional[bool]]:
+    semaphore = defer.DeferredSemaphore(concurrency)
+    results = await defer.gatherResults(
+        [
+            semaphore.run(lambda target: defer.ensureDeferred(probe_tab_hidden(conn, target, timeout, clock)), target)
+            for target in targets
+        ]
+    )
+    return {target.target_id: hidden for target, hidden in zip(targets, results)}
+
+
+async def obtain_active_tab(
+    targets: list[cdp.target.TargetInfo],
+    conn: pycdp.twisted.CDPConnection,
+    timeout: float = DEFAULT_PROBE_TIMEOUT,
+    cache: Optional[TabVisibilityCache] = None,
+    concurrency: int = DEFAULT_PROBE_CONCURRENCY,
+    clock: Optional[IReactorTime] = None,
+) -> Optional[cdp.target.TargetInfo]:
+    """Returns the only visible tab, or None if there are several, or none.
+
+    The tabs that were visible in the last run are probed first. If exactly
+    one of them is still visible, it's returned without probing the others.
+    The tabs that don't answer in time are treated as hidden.
+    """
+    if not targets:
+        return None
+    if cache is None:
+        cache = TabVisibilityCache()
+
+    hidden: dict[cdp.target.TargetID, Optional[bool]] = {}
+    last_visible = cache.visible_tabs(targets)
+    if last_visible:
+        hidden.update(await _probe_tabs(conn, last_visible, timeout, concurrency, clock))
+        still_visible = [target for target in last_visible if hidden[target.target_id] is False]
+        if len(still_visible) == 1:
+            cache.save(targets, {target_id: value for target_id, value in hidden.items() if value is not None})
+            return still_visible[0]
+
+    remaining = [target for target in targets if target.target_id not in hidden]
+    hidden.update(await _probe_tabs(conn, remaining, timeout, concurrency, clock))
+    cache.save(targets, {target_id: value for target_id, value in hidden.items() if value is not None})
+
+    visible = [target for target in targets if hidden[target.target_id] is False]
+    if len(visible) == 1:
+        return visible[0]
+
+    return None
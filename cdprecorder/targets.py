@@ -0,0 +1,206 @@
+"""
+This module records the targets related to the recorded page, not only the
+page itself: out-of-process iframes, dedicated, shared and service workers,
+and the popups that the page opens. Chrome sends the network events of
+each of them on its own CDP session.
+
+Classes:
+    - TargetEvent: An event, with the target and the session it came from.
+    - TargetAttacher: Attaches to the related targets, and merges the
+    events of all their sessions into a single stream.
+"""
+
+from __future__ import annotations
+
+from typing import Any, AsyncIterator, NamedTuple, Optional
+
+import pycdp
+import pycdp.twisted
+from pycdp import cdp
+from twisted.internet import defer
+
+from . import logger
+from .event_buffer import DEFAULT_CAPACITY, AdaptiveEventQueue, listen_adaptive
+
+# The events recorded from the related targets. The runtime events come only from the page.
+NETWORK_EVENTS: tuple[type, ...] = (
+    cdp.network.RequestWillBeSent,
+    cdp.network.RequestWillBeSentExtraInfo,
+    cdp.network.ResponseReceived,
+    cdp.network.ResponseReceivedExtraInfo,
+    cdp.network.LoadingFinished,
+    cdp.network.LoadingFailed,
+)
+_TARGET_EVENTS: tuple[type, ...] = (cdp.target.AttachedToTarget, cdp.target.DetachedFromTarget)
+
+RECORDED_TARGET_TYPES = frozenset({"page", "iframe", "worker", "shared_worker", "service_worker"})
+
+
+class TargetEvent(NamedTuple):
+    target_id: cdp.target.TargetID
+    session: pycdp.twisted.CDPSession
+    event: Any
+
+
+class TargetAttacher:
+    """Auto-attaches to the targets related to a page, recursively, and
+    merges their events into one stream, in the order they arrive.
+
+    All the sessions share the browser's websocket, so the arrival order is
+    the order in which Chrome dispatched the events. The new targets are
+    paused until their Network domain is enabled, so their first requests
+    are not missed.
+    """
+
+    def __init__(
+        self,
+        conn: pycdp.twisted.CDPConnection,
+        root_session: pycdp.twisted.CDPSession,
+        root_target_id: cdp.target.TargetID,
+        root_event_types: tuple[type, ...],
+        buffer_size: int = DEFAULT_CAPACITY,
+        max_buffer_size: Optional[int] = None,
+        spill: bool = True,
+        raw_event_types: tuple[type, ...] = (),
+    ):
+        self.conn = conn
+        self.root_session = root_session
+        self.root_target_id = root_target_id
+        self.root_event_types = root_event_types
+        self.buffer_size = buffer_size
+        self.max_buffer_size = max_buffer_size
+        self.spill = spill
+        # These events are received unparsed, as RawEvents
+        self.raw_event_types = raw_event_types
+
+        # The events of all the sessions wait here for the recorder. It never drops events.
+        # When it spills, the sessions in the events stay in memory.
+        self.queue: AdaptiveEventQueue[TargetEvent] = AdaptiveEventQueue(
+            "merged", buffer_size, max_buffer_size, keep_in_memory=(pycdp.twisted.CDPBase,)
+        )
+        # The buffer of each session, including the detached ones, for their counters
+        self.session_buffers: list[AdaptiveEventQueue[Any]] = []
+        # Attached sessions, by session id
+        self.sessions: dict[str, pycdp.twisted.CDPSession] = {}
+        self.target_ids: set[cdp.target.TargetID] = {root_target_id}
+        self._pumps: list[defer.Deferred[None]] = []
+
+    def __aiter__(self) -> AsyncIterator[TargetEvent]:
+        return self
+
+    async def __anext__(self) -> TargetEvent:
+        return await self.queue.__anext__()
+
+    @property
+    def buffers(self) -> list[AdaptiveEventQueue[Any]]:
+        return [self.queue, *self.session_buffers]
+
+    def _listen(
+        self, session: pycdp.twisted.CDPSession, event_types: tuple[type, ...], name: str
+    ) -> AdaptiveEventQueue[Any]:
+        listener = listen_adaptive(
+            session, event_types, name, self.buffer_size, self.max_buffer_size, self.spill, self.raw_event_types
+        )
+        self.session_buffers.append(listener)
+        return listener
+
+    async def start(self) -> None:
+        """Starts listening on the page's session, and attaches to the
+        targets that already exist. Must be called before navigating."""
+        listener = self._listen(self.root_session, (*self.root_event_types, *_TARGET_EVENTS), "page")
+        self._pump(self.root_target_id, self.root_session, listener)
+        await self._auto_attach(self.root_session)
+
+        # Popups are not related to the page, so they must be discovered
+        popups = self.conn.listen(cdp.target.TargetCreated, buffer_size=self.buffer_size)
+        self._pumps.append(defer.ensureDeferred(self._attach_popups(popups)))
+        await self.conn.execute(cdp.target.set_discover_targets(True))
+
+    async def _auto_attach(self, session: pycdp.twisted.CDPSession) -> None:
+        await session.execute(
+            cdp.target.set_auto_attach(auto_attach=True, wait_for_debugger_on_start=True, flatten=True)
+        )
+
+    def _pump(
+        self, target_id: cdp.target.TargetID, session: pycdp.twisted.CDPSession, listener: AsyncIterator[Any]
+    ) -> None:
+        async def pump() -> None:
+            try:
+                async for evt in listener:
+                    if isinstance(evt, cdp.target.AttachedToTarget):
+                        await self._on_attached(evt)
+                    elif isinstance(evt, cdp.target.DetachedFromTarget):
+                        self._on_detached(evt)
+                    else:
+                        self.queue.put(TargetEvent(target_id, session, evt))
+            except defer.CancelledError:
+                pass
+
+        self._pumps.append(defer.ensureDeferred(pump()))
+
+    async def _setup_session(self, session: pycdp.twisted.CDPSession, target_info: cdp.target.TargetInfo) -> None:
+        target_id = target_info.target_id
+        try:
+            if target_info.type_ in RECORDED_TARGET_TYPES:
+                listener = self._listen(session, (*NETWORK_EVENTS, *_TARGET_EVENTS), f"{target_info.type_}:{target_id}")
+                self._pump(target_id, session, listener)
+                await session.execute(cdp.network.enable())
+                await self._auto_attach(session)
+                logger.debug("Recording %s target %s: %s", target_info.type_, target_id, target_info.url)
+        except pycdp.exceptions.CDPBrowserError:
+            logger.debug("Could not record %s target %s", target_info.type_, target_id)
+        finally:
+            try:
+                await session.execute(cdp.runtime.run_if_waiting_for_debugger())
+            except pycdp.exceptions.CDPBrowserError:
+                pass
+
+    async def _on_attached(self, evt: cdp.target.AttachedToTarget) -> None:
+        self.target_ids.add(evt.target_info.target_id)
+        session = self.conn.add_session(evt.session_id, evt.target_info.target_id)
+        self.sessions[evt.session_id] = session
+        await self._setup_session(session, evt.target_info)
+
+    def _on_detached(self, evt: cdp.target.DetachedFromTarget) -> None:
+        session = self.sessions.pop(evt.session_id, None)
+        if session is not None:
+            session.close_listeners()
+            self.conn.remove_session(evt.session_id)
+
+    async def _attach_popups(self, listener: AsyncIterator[Any]) -> None:
+        try:
+            async for evt in listener:
+                await self._attach_popup(evt.target_info)
+        except defer.CancelledError:
+            pass
+
+    async def _attach_popup(self, info: cdp.target.TargetInfo) -> None:
+        if info.type_ != "page" or info.opener_id not in self.target_ids or info.target_id in self.target_ids:
+            return
+
+        self.target_ids.add(info.target_id)
+        try:
+            session = await self.conn.connect_session(info.target_id)
+        except pycdp.exceptions.CDPBrowserError:
+            logger.debug("Could not attach to popup %s", info.target_id)
+            return
+        self.sessions[session.session_id] = session
+        await self._setup_session(session, info)
+
+    def stop(self) -> None:
+        for pump in self._pumps:
+            pump.cancel()
+        self._pumps = []
+        for session in self.sessions.values():
+            session.close_listeners()
+        self.sessions = {}
+
+
+def unwrap_target_event(
+    evt: Any,
+) -> tuple[Optional[cdp.target.TargetID], Optional[pycdp.twisted.CDPSession], Any]:
+    """Returns the target, session and CDP event of an event from a
+    TargetAttacher. Plain events have no target or session."""
+    if isinstance(evt, TargetEvent):
+        return evt.target_id, evt.session, evt.event
+    return None, None, evt
@@ -0,0 +1,309 @@
+"""
+This module contains a compiled matcher for adblock rules without options.
+
+adblockparser joins all the rules into one huge regex, and Python's re module
+tries every alternative at every position of the URL. Here, the rules are
+split by shape, and each shape gets a faster structure:
+    - `||example.com^` and `||example.com/path` rules: a hash index keyed by
+    the domain, looked up with the domain suffixes of the URL's host.
+    - Plain substrings, like `/banner/ads/`: an Aho-Corasick automaton, that
+    finds all of them in one pass over the URL.
+    - Rules with wildcards: the same automaton finds their longest literal,
+    and only the rules whose literal was found are matched as regexes.
+    - Everything else, like `/regex/` rules: one combined regex, like
+    adblockparser does.
+
+Classes:
+    - AhoCorasick: Finds which of many substrings occur in a text.
+    - RuleSet: The compiled form of the blocking or the exception rules.
+    - URLMatcher: Decides if a URL is blocked, with memoized decisions.
+"""
+
+from __future__ import annotations
+
+import re
+from typing import Iterable, Iterator, Optional
+
+from adblockparser import AdblockRule
+
+# adblockparser compiles the rules case-insensitively
+_FLAGS = re.IGNORECASE
+# The characters that a `^` separator doesn't match
+_NON_SEPARATOR_RUN_RE = re.compile(r"[\w\d_\-.%]*", _FLAGS)
+_DOMAIN_RE = re.compile(r"[a-z0-9][a-z0-9.-]*", _FLAGS)
+_AUTHORITY_RUN_RE = re.compile(r"[^/?#]*")
+_SCHEME_RE = re.compile(r"[^:/?#]+:")
+_WILDCARD_RE = re.compile(r"[*^]")
+_REGEX_SPECIAL_RE = re.compile(r"[\\.^$*+?{}\[\]|()]")
+# The value of the plain substring rules in the automaton
+_LITERAL = -1
+
+DEFAULT_CACHE_SIZE = 64 * 1024
+
+
+class AhoCorasick:
+    """An Aho-Corasick automaton. Each pattern has a value, and a search
+    yields the values of the patterns that occur in the text."""
+
+    def __init__(self, patterns: Iterable[tuple[str, int]]):
+        self._goto: list[dict[str, int]] = [{}]
+        self._fail: list[int] = [0]
+        self._outputs: list[tuple[int, ...]] = [()]
+        self.size = 0
+
+        for pattern, value in patterns:
+            self._add(pattern, value)
+        self._link()
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _add(self, pattern: str, value: int) -> None:
+        state = 0
+        for char in pattern:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._outputs.append(())
+            state = next_state
+        self._outputs[state] += (value,)
+        self.size += 1
+
+    def _link(self) -> None:
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                # The patterns that end here include the ones that are suffixes of this state's path
+                self._outputs[next_state] += self._outputs[self._fail[next_state]]
+
+    def iter_values(self, text: str) -> Iterator[int]:
+        goto = self._goto
+        fail = self._fail
+        outputs = self._outputs
+        state = 0
+        for char in text:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            yield from outputs[state]
+
+
+def _rest_to_regex(rest: str) -> Optional[str]:
+    """Converts what follows the domain of a `||domain` rule to a regex, like
+    AdblockRule.rule_to_regex, which would take `/path/` for a regex."""
+    if "|" in rest[:-1]:
+        return None
+
+    regex = re.sub(r"([.$+?{}()\[\]\\])", r"\\\1", rest)
+    regex = regex.replace("^", r"(?:[^\w\d_\-.%]|$)")
+    regex = regex.replace("*", ".*")
+    if regex.endswith("|"):
+        regex = regex[:-1] + "$"
+    return regex
+
+
+def _host_positions(url: str) -> list[int]:
+    """Returns the positions where the domain of a `||domain` rule may start,
+    following adblockparser's regex:
+        ^(?:[^:/?#]+:)?(?://(?:[^/?#]*\\.)?)?domain
+    """
+    positions = [0]
+    start = 0
+    scheme = _SCHEME_RE.match(url)
+    if scheme is not None:
+        start = scheme.end()
+        positions.append(start)
+
+    for prefix_end in {0, start}:
+        if url.startswith("//", prefix_end):
+            authority_start = prefix_end + 2
+            authority_end = _AUTHORITY_RUN_RE.match(url, authority_start).end()  # type: ignore[union-attr]
+            positions.append(authority_start)
+            positions.extend(i + 1 for i in range(authority_start, authority_end) if url[i] == ".")
+
+    return positions
+
+
+def _required_literal(text: str) -> Optional[str]:
+    """Returns the longest literal that a URL must contain to match the
+    rule, or None if it can't be found easily."""
+    if text.startswith("||"):
+        text = text[2:]
+    elif text.startswith("|"):
+        text = text[1:]
+    if text.endswith("|"):
+        text = text[:-1]
+    if "|" in text:
+        return None
+
+    longest = max(_WILDCARD_RE.split(text), key=len)
+    return longest.lower() or None
+
+
+class RuleSet:
+    """The rules of one kind (blocking or exception), grouped by shape."""
+
+    def __init__(self, rules: Iterable[AdblockRule]):
+        # Domains of `||domain^` rules
+        self.domains: set[str] = set()
+        # Domains of `||domain<rest>` rules, with the regexes of the rest
+        self.domain_rules: dict[str, list[re.Pattern[str]]] = {}
+        # Regexes of the other rules. Each one is checked only if its required literal is in the URL.
+        self._regexes: list[str] = []
+        self._compiled: dict[int, re.Pattern[str]] = {}
+        literals: list[tuple[str, int]] = []
+        leftover: list[str] = []
+
+        for rule in rules:
+            text = rule.rule_text.strip()
+            if text.startswith("/") and text.endswith("/"):
+                # adblockparser takes `/word/` for a regex, but many are plain words
+                regex = rule.regex
+                if not _REGEX_SPECIAL_RE.search(regex):
+                    literals.append((regex.lower(), _LITERAL))
+                elif not _REGEX_SPECIAL_RE.search(regex.replace(".", "")) and regex.replace(".", ""):
+                    literals.append((max(regex.split("."), key=len).lower(), len(self._regexes)))
+                    self._regexes.append(regex)
+                else:
+                    leftover.append(regex)
+                continue
+            if text.startswith("||") and self._add_domain_rule(text[2:]):
+                continue
+
+            stripped = text.strip("*")
+            if stripped and not any(char in stripped for char in "*^|"):
+                literals.append((stripped.lower(), _LITERAL))
+                continue
+
+            literal = _required_literal(text)
+            if literal is None:
+                leftover.append(rule.regex)
+            else:
+                literals.append((literal, len(self._regexes)))
+                self._regexes.append(rule.regex)
+
+        self.literals = AhoCorasick(literals)
+        self.leftover: Optional[re.Pattern[str]] = None
+        if leftover:
+            self.leftover = re.compile("|".join(leftover), _FLAGS)
+        self.leftover_count = len(leftover)
+
+    def _add_domain_rule(self, text: str) -> bool:
+        match = _DOMAIN_RE.match(text)
+        if match is None:
+            return False
+
+        domain = match.group().lower()
+        rest = text[match.end() :]
+        if rest == "^":
+            self.domains.add(domain)
+            return True
+
+        # The domain must end at a separator, so it is the whole run of non-separators
+        if not rest or rest[0] not in "^/:?":
+            return False
+        regex = _rest_to_regex(rest)
+        if regex is None:
+            return False
+        self.domain_rules.setdefault(domain, []).append(re.compile(regex, _FLAGS))
+        return True
+
+    def _regex(self, index: int) -> re.Pattern[str]:
+        # Most of these regexes are never needed, so they are compiled on first use
+        pattern = self._compiled.get(index)
+        if pattern is None:
+            pattern = re.compile(self._regexes[index], _FLAGS)
+            self._compiled[index] = pattern
+        return pattern
+
+    def matches_host(self, url: str, positions: list[int]) -> bool:
+        """Checks only the `||domain^` rules. The result depends only on the
+        part of the URL up to the end of the host."""
+        for position in positions:
+            run = _NON_SEPARATOR_RUN_RE.match(url, position).group().lower()  # type: ignore[union-attr]
+            if run in self.domains:
+                return True
+        return False
+
+    def matches_rest(self, url: str, positions: list[int], lowercase_url: str) -> bool:
+        """Checks all the rules except the `||domain^` ones."""
+        if self.domain_rules:
+            for position in positions:
+                run = _NON_SEPARATOR_RUN_RE.match(url, position).group().lower()  # type: ignore[union-attr]
+                for pattern in self.domain_rules.get(run, ()):
+                    if pattern.match(url, position + len(run)):
+                        return True
+
+        candidates = set()
+        for value in self.literals.iter_values(lowercase_url):
+            if value == _LITERAL:
+                return True
+            candidates.add(value)
+
+        if any(self._regex(index).search(url) for index in candidates):
+            return True
+
+        return self.leftover is not None and self.leftover.search(url) is not None
+
+
+class URLMatcher:
+    """Decides if a URL is blocked by rules without options, with the same
+    result as AdblockRules.should_block(url).
+
+    Decisions are memoized per URL. The `||domain^` part of a decision is
+    also memoized per host, because most requests of a page go to a few
+    hosts.
+    """
+
+    def __init__(self, rules: Iterable[AdblockRule], cache_size: int = DEFAULT_CACHE_SIZE):
+        basic_rules = [rule for rule in rules if not rule.options and rule.regex]
+        self.blacklist = RuleSet(rule for rule in basic_rules if not rule.is_exception)
+        self.whitelist = RuleSet(rule for rule in basic_rules if rule.is_exception)
+        self.cache_size = cache_size
+        self._url_cache: dict[str, bool] = {}
+        self._host_cache: dict[str, tuple[bool, bool]] = {}
+
+        self.hits = 0
+        self.misses = 0
+
+    def _host_decision(self, url: str, positions: list[int]) -> tuple[bool, bool]:
+        # Everything up to the first separator after the last position decides the host rules
+        last = positions[-1]
+        host_key = url[: _NON_SEPARATOR_RUN_RE.match(url, last).end() + 1]  # type: ignore[union-attr]
+        decision = self._host_cache.get(host_key)
+        if decision is None:
+            decision = (self.whitelist.matches_host(url, positions), self.blacklist.matches_host(url, positions))
+            if len(self._host_cache) >= self.cache_size:
+                self._host_cache.clear()
+            self._host_cache[host_key] = decision
+        return decision
+
+    def _decide(self, url: str) -> bool:
+        positions = _host_positions(url)
+        lowercase_url = url.lower()
+        host_allowed, host_blocked = self._host_decision(url, positions)
+
+        if host_allowed or self.whitelist.matches_rest(url, positions, lowercase_url):
+            return False
+        return host_blocked or self.blacklist.matches_rest(url, positions, lowercase_url)
+
+    def should_block(self, url: str) -> bool:
+        decision = self._url_cache.get(url)
+        if decision is not None:
+            self.hits += 1
+            return decision
+
+        self.misses += 1
+        decision = self._decide(url)
+        if len(self._url_cache) >= self.cache_size:
+            self._url_cache.clear()
+        self._url_cache[url] = decision
+        return decision
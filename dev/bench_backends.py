@@ -0,0 +1,139 @@
+"""
+Compares the per-event overhead of the recorder's event loop backends,
+Twisted and asyncio.
+
+Usage, from the project's root directory:
+    python3 dev/bench_backends.py [events.json] [repeat]
+
+The network events of a recorded events file are put into a pycdp event
+listener, one per loop iteration, like a CDP connection does. On each
+backend, two things are measured:
+    - dispatch: reading the events through the recorder's timeout and
+    cancel wrappers, without processing them.
+    - collect: collect_communications over the events. The bodies are
+    fetched from a fake session, which answers at once.
+
+The asyncio backend needs aiohttp. It runs first, because Twisted's reactor
+can't be started again.
+"""
+
+import json
+import sys
+import time
+
+from pycdp import cdp
+
+from cdprecorder.backends import get_backend
+from cdprecorder.recorder import (
+    AsyncIterableWithTimeout,
+    CancelableAsyncIterable,
+    RuntimeContext,
+    collect_communications,
+)
+
+
+class FakeSession:
+    async def execute(self, method_generator):
+        method = next(method_generator)
+        if method["method"] == "Network.getResponseBody":
+            return "", False
+        return None
+
+
+class NoFilter:
+    def should_block(self, *args, **kwargs):
+        return False
+
+
+class Counted:
+    """Stops after `count` events, so the listener doesn't have to be closed."""
+
+    def __init__(self, listener, count):
+        self.listener = listener
+        self.left = count
+        self.iterator = None
+
+    def __aiter__(self):
+        self.iterator = aiter(self.listener)
+        return self
+
+    async def __anext__(self):
+        if self.left == 0:
+            raise StopAsyncIteration
+        self.left -= 1
+        return await self.iterator.__anext__()
+
+
+def load_events(path):
+    with open(path, encoding="utf8") as file:
+        events = json.load(file)
+    return [cdp.util.parse_json_event(event) for event in events if event["method"].startswith("Network.")]
+
+
+async def produce(backend, listener, events):
+    for event in events:
+        listener.put(event)
+        await backend.sleep(0)
+
+
+def listen(backend, events):
+    listener = backend.create_event_listener(len(events))
+    backend.spawn(produce(backend, listener, events))
+    return Counted(listener, len(events))
+
+
+async def dispatch(backend, events):
+    start = time.perf_counter()
+    timed = AsyncIterableWithTimeout(listen(backend, events), 3600, backend=backend)
+    async for _ in CancelableAsyncIterable(timed, backend):
+        pass
+    return time.perf_counter() - start
+
+
+async def collect(backend, events):
+    session = FakeSession()
+    runtime = RuntimeContext(session, "", cdp.runtime.ExecutionContextId(0))
+    start = time.perf_counter()
+    await collect_communications(
+        session,
+        listen(backend, events),
+        NoFilter(),
+        timeout=3600,
+        collect_all=True,
+        runtime_context=runtime,
+        show_control_window=False,
+        backend=backend,
+    )
+    return time.perf_counter() - start
+
+
+def report(label, elapsed, events):
+    print(f"{label:<32} {elapsed * 1000:10.2f} ms {elapsed / events * 1e6:10.2f} us/event")
+
+
+def bench(name, events, repeat):
+    backend = get_backend(name)
+
+    async def main():
+        results = {"dispatch": 0.0, "collect": 0.0}
+        for _ in range(repeat):
+            results["dispatch"] += await dispatch(backend, events)
+            results["collect"] += await collect(backend, events)
+        return results
+
+    for label, elapsed in backend.run(main).items():
+        report(f"{name} {label}", elapsed, len(events) * repeat)
+
+
+def main():
+    events_path = sys.argv[1] if len(sys.argv) > 1 else "tests/events_youtube.json"
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    events = load_events(events_path)
+    print(f"{len(events)} network events, {repeat} times")
+    bench("asyncio", events, repeat)
+    bench("twisted", events, repeat)
+
+
+if __name__ == "__main__":
+    main()
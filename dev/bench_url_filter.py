@@ -0,0 +1,81 @@
+"""
+Compares URLFilter.should_block with adblockparser's AdblockRules.should_block.
+
+Usage, from the project's root directory:
+    python3 dev/bench_url_filter.py [filter_list.txt] [events.json]
+
+The filter list defaults to the cached EasyList, which is downloaded if it
+isn't cached. The URLs are taken from the requests of a recorded events file.
+"""
+
+import json
+import sys
+import time
+
+from adblockparser import AdblockRules
+
+from cdprecorder.filters import FilterListCache, URLFilter, download_rules
+
+
+def load_rules(path=None):
+    if path is not None:
+        with open(path, encoding="utf8") as file:
+            return file.read().split("\n")
+
+    lines = FilterListCache().load_rules()
+    if lines is None:
+        lines = download_rules()
+    return lines
+
+
+def load_urls(path):
+    with open(path, encoding="utf8") as file:
+        events = json.load(file)
+
+    urls = [event["params"]["request"]["url"] for event in events if event["method"] == "Network.requestWillBeSent"]
+    # The recorder ignores data URLs before filtering
+    return [url for url in urls if not url.startswith("data:")]
+
+
+def timed(label, func, urls, repeat=1):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = [func(url) for url in urls]
+    elapsed = time.perf_counter() - start
+    calls = len(urls) * repeat
+    print(f"{label:<32} {elapsed * 1000:10.2f} ms {elapsed / calls * 1e6:10.2f} us/url")
+    return results
+
+
+def main():
+    rules_path = sys.argv[1] if len(sys.argv) > 1 else None
+    events_path = sys.argv[2] if len(sys.argv) > 2 else "tests/events_youtube.json"
+
+    lines = load_rules(rules_path)
+    urls = load_urls(events_path)
+    print(f"{len(lines)} rules, {len(urls)} URLs ({len(set(urls))} unique)")
+
+    start = time.perf_counter()
+    reference = AdblockRules(lines)
+    print(f"{'AdblockRules build':<32} {(time.perf_counter() - start) * 1000:10.2f} ms")
+    start = time.perf_counter()
+    urlfilter = URLFilter(lines)
+    print(f"{'URLFilter build':<32} {(time.perf_counter() - start) * 1000:10.2f} ms")
+    matcher = urlfilter.matcher
+    print(
+        f"Blocking rules: {len(matcher.blacklist.domains)} domains, {len(matcher.blacklist.literals)} literals, "
+        f"{matcher.blacklist.leftover_count} regexes"
+    )
+
+    expected = timed("AdblockRules.should_block", reference.should_block, urls)
+    results = timed("URLFilter.should_block (cold)", urlfilter.should_block, urls)
+    timed("URLFilter.should_block (warm)", urlfilter.should_block, urls, repeat=10)
+
+    mismatches = [url for url, a, b in zip(urls, expected, results) if a != b]
+    print(f"{len(mismatches)} mismatches")
+    for url in mismatches[:10]:
+        print("  ", url)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,14 @@
 from __future__ import annotations
+import copy
 import re
 import requests
+import threading
+import time
 import urllib
 
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from requests import Session
+from requests.adapters import HTTPAdapter
 from abc import ABC, abstractmethod
 
 
@@ -170,5 +175,226 @@ def response_action_from_python_response(resp):
     cookies = Cookie.list_from_cookiejar(resp.cookies)
     return ResponseAction(url=resp.url, headers=headers, cookies=cookies, body=resp.raw, status=resp.status_code)
 
+class RequestTiming:
 
+    def __init__(self, method, url, status, elapsed):
+        self.method = method
+        self.url = url
+        self.status = status
+        self.elapsed = elapsed
+
+    def __repr__(self):
+        return f'{self.method} {self.url} - {self.status} ({self.elapsed * 1000:.1f} ms)'
+
+class ReplayRun:
+
+    def __init__(self, actions, timings, dependencies, wall_time):
+        self.actions = actions
+        self.timings = timings
+        self.dependencies = dependencies
+        self.wall_time = wall_time
+
+    @property
+    def sequential_time(self):
+        return sum((timing.elapsed for timing in self.timings.values()))
+
+    def critical_path(self):
+        finish = {}
+        previous = {}
+        for index in sorted(self.timings):
+            before = max(self.dependencies.get(index, ()), key=lambda dep: finish[dep], default=None)
+            previous[index] = before
+            finish[index] = self.timings[index].elapsed + (finish[before] if before is not None else 0.0)
+        path = []
+        last = max(finish, key=lambda index: finish[index], default=None)
+        while last is not None:
+            path.append(last)
+            last = previous[last]
+        return path[::-1]
+
+    @property
+    def critical_path_time(self):
+        return sum((self.timings[index].elapsed for index in self.critical_path()))
+
+    def summary(self):
+        return f'{len(self.timings)} requests in {self.wall_time * 1000:.1f} ms, critical path {self.critical_path_time * 1000:.1f} ms ({len(self.critical_path())} requests), sequential {self.sequential_time * 1000:.1f} ms'
+
+class ReplayEngine:
+
+    def __init__(self, pool_connections=10, pool_maxsize=10, max_retries=0, timeout=None, max_templates=1024):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_templates = max_templates
+        self.cookies = requests.cookies.RequestsCookieJar()
+        self.sessions = {}
+        self.timings = []
+        self._templates = {}
+        self._lock = threading.Lock()
+
+    def get_session(self, url):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        with self._lock:
+            session = self.sessions.get(key)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize, max_retries=self.max_retries)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.cookies = self.cookies
+                self.sessions[key] = session
+        return session
+
+    def prepare(self, action):
+        headers = action.headers or {}
+        key = (action.method, action.url, tuple(headers.items()), action.body)
+        with self._lock:
+            template = self._templates.get(key)
+        if template is None:
+            request = requests.Request(method=action.method, url=action.url, headers=headers, data=action.body)
+            template = request.prepare()
+            with self._lock:
+                if len(self._templates) >= self.max_templates:
+                    del self._templates[next(iter(self._templates))]
+                self._templates[key] = template
+        prepared = template.copy()
+        prepared.prepare_cookies(self.cookies)
+        action_cookies = action.cookies_to_dict()
+        if action_cookies:
+            pairs = prepared.headers.get('Cookie', '').split('; ')
+            pairs = [pair for pair in pairs if pair and pair.split('=', 1)[0] not in action_cookies]
+            pairs += [f'{name}={value}' for name, value in action_cookies.items()]
+            prepared.headers['Cookie'] = '; '.join(pairs)
+        return prepared
+
+    def _send(self, action):
+        prepared = self.prepare(action)
+        session = self.get_session(prepared.url or '')
+        start = time.perf_counter()
+        response = session.send(prepared, allow_redirects=False, timeout=self.timeout)
+        elapsed = time.perf_counter() - start
+        timing = RequestTiming(prepared.method or '', prepared.url or '', response.status_code, elapsed)
+        self.timings.append(timing)
+        return (response, timing)
+
+    def send(self, action):
+        return self._send(action)[0]
+
+    @staticmethod
+    def source_indexes(source):
+        indexes = set()
+        stack = [source]
+        while stack:
+            obj = stack.pop()
+            index = getattr(obj, 'index', None)
+            if isinstance(index, int):
+                indexes.add(index)
+            for name in ('source', 'upper_source'):
+                child = getattr(obj, name, None)
+                if child is not None:
+                    stack.append(child)
+            stack.extend(getattr(obj, 'targets', None) or ())
+            for pair in getattr(obj, 'qlist', None) or ():
+                stack.extend((item for item in pair if not isinstance(item, str)))
+        return indexes
+
+    def dependencies(self, actions, barriers=(), wait_for_cookies=True):
+        barriers = set(barriers)
+        producers = {}
+        requests_since_barrier = []
+        cookie_requests = []
+        last_barrier = None
+        dependencies = {}
+        last_request = None
+        for index, action in enumerate(actions):
+            if isinstance(action, ResponseAction):
+                if last_request is not None:
+                    producers[index] = last_request
+                continue
+            if not isinstance(action, RequestAction):
+                continue
+            producers[index] = index
+            last_request = index
+            deps = set()
+            for target in getattr(action, 'targets', None) or ():
+                deps.update((producers[source] for source in self.source_indexes(target) if source in producers))
+            deps.discard(index)
+            deps.update(cookie_requests)
+            if last_barrier is not None:
+                deps.add(last_barrier)
+            if index in barriers:
+                deps.update(requests_since_barrier)
+                last_barrier = index
+                requests_since_barrier = []
+                cookie_requests = []
+            else:
+                requests_since_barrier.append(index)
+            dependencies[index] = deps
+            response = actions[index + 1] if index + 1 < len(actions) else None
+            if wait_for_cookies and isinstance(response, ResponseAction):
+                if 'set-cookie' in (response.headers or {}) or response.cookies:
+                    cookie_requests.append(index)
+        return dependencies
+
+    def _replay_step(self, actions, replayed, index):
+        action = copy.copy(actions[index])
+        action.headers = dict(action.headers or {})
+        action.cookies = list(action.cookies or [])
+        for target in getattr(action, 'targets', None) or ():
+            target.apply(action, replayed)
+        replayed[index] = action
+        response, timing = self._send(action)
+        if index + 1 < len(actions) and isinstance(actions[index + 1], ResponseAction):
+            replayed[index + 1] = response_action_from_python_response(response)
+        return timing
+
+    def run(self, actions, workers=8, barriers=(), wait_for_cookies=True):
+        dependencies = self.dependencies(actions, barriers, wait_for_cookies)
+        replayed = [None] * len(actions)
+        timings = {}
+        waiting = {index: set(deps) for index, deps in dependencies.items()}
+        dependents = {index: [] for index in dependencies}
+        for index, deps in dependencies.items():
+            for dep in deps:
+                dependents[dep].append(index)
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            running = {}
+            for index, deps in dependencies.items():
+                if not deps:
+                    running[pool.submit(self._replay_step, actions, replayed, index)] = index
+            while running:
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in sorted(done, key=lambda future: running[future]):
+                    index = running.pop(future)
+                    timings[index] = future.result()
+                    for dependent in dependents[index]:
+                        waiting[dependent].discard(index)
+                        if not waiting[dependent]:
+                            running[pool.submit(self._replay_step, actions, replayed, dependent)] = dependent
+        return ReplayRun(replayed, timings, dependencies, time.perf_counter() - start)
+
+    def summary(self):
+        total = sum((timing.elapsed for timing in self.timings))
+        return f'{len(self.timings)} requests in {total * 1000:.1f} ms, to {len(self.sessions)} hosts'
+
+    def report(self):
+        return '\n'.join([repr(timing) for timing in self.timings] + [self.summary()])
+
+    def close(self):
+        for session in self.sessions.values():
+            session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+replay = ReplayEngine()
 actions = []
+
+print(replay.report())
@@ -0,0 +1,81 @@
+import json
+import pytest
+
+from unittest.mock import patch
+
+from .mocks import EventMock, UrlfilterMock
+from cdprecorder.action import InputAction, RequestAction, ResponseAction
+from cdprecorder.action_parser import iter_communication_actions
+from cdprecorder.recorder import HttpCommunication, collect_communications, set_runtime_context
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@pytest.mark.asyncio
+@patch("cdprecorder.recorder.RuntimeContext")
+async def test_iter_communication_actions_is_lazy(RuntimeContext, events_file):
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    event_mock = EventMock(events)
+    set_runtime_context(RuntimeContext())
+    communications = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10)
+    set_runtime_context(None)
+
+    read = []
+
+    def read_communications():
+        for comm in communications:
+            read.append(comm)
+            yield comm
+
+    actions = iter_communication_actions(read_communications(), release=True)
+    first = next(actions)
+    assert isinstance(first, RequestAction)
+    # Only the communications of the first actions were read
+    assert len(read) < len(communications)
+
+    rest = list(actions)
+    assert len(read) == len(communications)
+    assert all(isinstance(action, (RequestAction, ResponseAction, InputAction)) for action in [first] + rest)
+    # The parsed communications were emptied
+    assert all(not comm.events and not comm.response_bodies for comm in communications if isinstance(comm, HttpCommunication))
+
+
+def test_iter_communication_actions_keeps_input_actions():
+    ignored = HttpCommunication("1.1", ignored=True)
+    action = InputAction("alice", "#user", 1.0)
+
+    assert list(iter_communication_actions([ignored, action])) == [action]
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@pytest.mark.asyncio
+@patch("cdprecorder.recorder.RuntimeContext")
+async def test_iter_communication_actions_in_processes(RuntimeContext, events_file):
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    event_mock = EventMock(events)
+    set_runtime_context(RuntimeContext())
+    communications = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10, collect_all=True)
+    set_runtime_context(None)
+
+    expected = list(iter_communication_actions(communications))
+    actions = list(iter_communication_actions(communications, processes=2, chunk_size=3))
+
+    assert actions == expected
+    assert [action.body for action in actions if isinstance(action, ResponseAction)] == [
+        action.body for action in expected if isinstance(action, ResponseAction)
+    ]
+
+
+def test_iter_communication_actions_in_processes_keeps_order():
+    communications = []
+    for idx in range(10):
+        communications.append(InputAction(str(idx), "#field", float(idx)))
+        communications.append(HttpCommunication(f"{idx}.1", ignored=True))
+
+    actions = list(iter_communication_actions(communications, processes=2, chunk_size=3))
+
+    assert actions == communications[::2]
+    assert all(action is comm for action, comm in zip(actions, communications[::2]))
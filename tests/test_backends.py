@@ -0,0 +1,86 @@
+import asyncio
+import json
+import pytest
+
+from unittest.mock import patch
+
+from .mocks import EventMock, UrlfilterMock
+from cdprecorder.backends import get_backend
+from cdprecorder.recorder import (
+    AsyncIterableWithTimeout,
+    CancelableAsyncIterable,
+    collect_communications,
+    set_runtime_context,
+)
+
+
+class EndlessIterator:
+    """Yields numbers, then waits forever for the next one."""
+    def __init__(self, count):
+        self.count = count
+        self.yielded = 0
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.yielded == self.count:
+            await asyncio.get_running_loop().create_future()
+        self.yielded += 1
+        return self.yielded
+
+
+@pytest.mark.asyncio
+async def test_cancelable_iterable_on_asyncio():
+    backend = get_backend("asyncio")
+    iterable = CancelableAsyncIterable(EndlessIterator(3), backend)
+
+    received = []
+    async for number in iterable:
+        received.append(number)
+        if number == 3:
+            # Stops the iterator while it waits for the next number
+            asyncio.get_running_loop().call_later(0.01, iterable.cancel)
+
+    assert received == [1, 2, 3]
+
+
+@pytest.mark.asyncio
+async def test_iterable_with_timeout_on_asyncio():
+    backend = get_backend("asyncio")
+    iterable = AsyncIterableWithTimeout(EndlessIterator(2), 0.05, backend=backend)
+
+    received = []
+    with pytest.raises(backend.timeout_error):
+        async for number in iterable:
+            received.append(number)
+
+    assert received == [1, 2]
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_collect_communications_on_asyncio(RuntimeContext, events_file):
+    """The asyncio backend records the same communications as the Twisted one."""
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    set_runtime_context(RuntimeContext())
+    event_mock = EventMock(list(events))
+    expected = await collect_communications(
+        event_mock, event_mock, UrlfilterMock(), timeout=10, show_control_window=False
+    )
+
+    event_mock = EventMock(list(events))
+    communications = await collect_communications(
+        event_mock, event_mock, UrlfilterMock(), timeout=10, show_control_window=False, backend=get_backend("asyncio")
+    )
+    set_runtime_context(None)
+
+    assert communications == expected
+
+
+def test_unknown_backend():
+    with pytest.raises(ValueError):
+        get_backend("gevent")
@@ -0,0 +1,79 @@
+import json
+import pytest
+
+from pycdp import cdp
+from twisted.internet import defer
+from unittest.mock import patch
+
+from .mocks import UrlfilterMock, EventMock
+from cdprecorder.body_fetcher import BodyFetchPool
+from cdprecorder.recorder import collect_communications, set_runtime_context
+
+
+class DelayedSessionMock:
+    """CDP session whose commands finish only when the test fires them."""
+    def __init__(self):
+        self.in_flight = []
+
+    async def execute(self, method_generator):
+        method = next(method_generator)
+        deferred = defer.Deferred()
+        self.in_flight.append((method["params"]["requestId"], deferred))
+        return await deferred
+
+    def finish_last(self):
+        request_id, deferred = self.in_flight.pop()
+        deferred.callback((f"body {request_id}", False))
+
+
+def test_pool_limits_concurrency_and_pending():
+    session = DelayedSessionMock()
+    pool = BodyFetchPool(session, concurrency=2, max_pending=3)
+    bodies = {}
+    submitted = []
+
+    async def submit_all():
+        for request_id in map(cdp.network.RequestId, ["1", "2", "3", "4", "5"]):
+            await pool.submit_response_body(request_id, lambda body, key=request_id: bodies.__setitem__(key, body))
+            submitted.append(request_id)
+
+    defer.ensureDeferred(submit_all())
+    assert [request_id for request_id, _ in session.in_flight] == ["1", "2"]
+    # The 4th submission waits until one of the first 3 finishes
+    assert submitted == ["1", "2", "3"]
+
+    session.finish_last()
+    assert [request_id for request_id, _ in session.in_flight] == ["1", "3"]
+    assert submitted == ["1", "2", "3", "4"]
+
+    while session.in_flight:
+        session.finish_last()
+
+    joined = defer.ensureDeferred(pool.join())
+    assert joined.called
+    assert bodies == {key: f"body {key}".encode() for key in ["1", "2", "3", "4", "5"]}
+    assert pool.peak_pending == 3
+    assert pool.fetched == 5
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_collect_communications_with_pool(RuntimeContext, events_file):
+    """Fetching the bodies through the pool must give the same communications
+    as fetching them inline."""
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    set_runtime_context(RuntimeContext())
+    event_mock = EventMock(list(events))
+    expected = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10)
+
+    event_mock = EventMock(list(events))
+    pool = BodyFetchPool(event_mock, concurrency=2, max_pending=4)
+    communications = await collect_communications(
+        event_mock, event_mock, UrlfilterMock(), timeout=10, body_fetch_pool=pool
+    )
+    set_runtime_context(None)
+
+    assert communications == expected
@@ -0,0 +1,50 @@
+import hashlib
+
+from cdprecorder.body_policy import (
+    DEFAULT_BODY_CAPTURE_POLICY,
+    BodyCaptureMode,
+    BodyCapturePolicy,
+    BodyCaptureRule,
+    apply_capture_rule,
+)
+from cdprecorder.body_spool import BodyDigest, decode_to_spool, read_body
+
+
+def test_first_matching_rule_is_selected():
+    policy = BodyCapturePolicy(
+        (
+            BodyCaptureRule(BodyCaptureMode.SKIP, mime_types=("image/*",)),
+            BodyCaptureRule(BodyCaptureMode.HASH, min_size=1000, url_pattern=r"\.json$"),
+            BodyCaptureRule(BodyCaptureMode.TRUNCATE, min_size=1000),
+        )
+    )
+
+    assert policy.select("image/png", 10, "https://a.com/logo.png").mode == BodyCaptureMode.SKIP
+    assert policy.select("application/json", 5000, "https://a.com/data.json").mode == BodyCaptureMode.HASH
+    assert policy.select("application/json", 5000, "https://a.com/data").mode == BodyCaptureMode.TRUNCATE
+    assert policy.select("application/json", 10, "https://a.com/data.json") is None
+    assert policy.select(None, 10, None) is None
+
+
+def test_default_policy_skips_binary_bodies():
+    for mime_type in ["image/webp", "font/woff2", "video/mp4", "application/x-protobuf"]:
+        assert DEFAULT_BODY_CAPTURE_POLICY.select(mime_type, 100, "https://a.com/").mode == BodyCaptureMode.SKIP
+
+    for mime_type in ["text/html", "application/json", "application/javascript"]:
+        assert DEFAULT_BODY_CAPTURE_POLICY.select(mime_type, 100, "https://a.com/") is None
+
+
+def test_apply_capture_rule():
+    body = b"0123456789"
+    truncate = BodyCaptureRule(BodyCaptureMode.TRUNCATE, max_bytes=4)
+    hash_only = BodyCaptureRule(BodyCaptureMode.HASH)
+
+    assert apply_capture_rule(body, None) == body
+    assert apply_capture_rule(None, truncate) is None
+    assert apply_capture_rule(body, truncate) == b"0123"
+    assert apply_capture_rule(decode_to_spool("0123456789", False, chunk_size=4), truncate) == b"0123"
+
+    digest = BodyDigest("sha256", hashlib.sha256(body).hexdigest(), len(body))
+    assert apply_capture_rule(body, hash_only) == digest
+    assert apply_capture_rule(decode_to_spool("0123456789", False, chunk_size=4), hash_only) == digest
+    assert read_body(digest) is None
@@ -0,0 +1,60 @@
+import base64
+import gc
+import os
+import pytest
+
+from cdprecorder.body_spool import BodySpool, body_from_cdp, decode_to_spool, read_body
+from cdprecorder.capture_log import CaptureLogReader, CaptureLogWriter
+
+
+def test_decode_to_spool_in_chunks():
+    data = bytes(range(256)) * 10
+    spool = decode_to_spool(base64.b64encode(data).decode(), True, chunk_size=64)
+
+    assert spool.size == len(data)
+    assert spool.read() == data
+    assert b"".join(spool.iter_chunks(100)) == data
+    assert spool == data
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc to count the open files")
+def test_spools_keep_no_file_open():
+    open_files = len(os.listdir("/proc/self/fd"))
+    spools = [decode_to_spool("x" * 100, False, chunk_size=10) for _ in range(50)]
+
+    assert len(os.listdir("/proc/self/fd")) == open_files
+    assert all(spool.read() == b"x" * 100 for spool in spools)
+
+
+def test_spool_file_is_removed():
+    spool = decode_to_spool("closed", False)
+    path = spool.path
+    assert os.path.exists(path)
+    spool.close()
+    assert not os.path.exists(path)
+
+    spool = decode_to_spool("collected", False)
+    path = spool.path
+    del spool
+    gc.collect()
+    assert not os.path.exists(path)
+
+
+def test_body_from_cdp_threshold():
+    assert body_from_cdp("short", False, spool_threshold=10) == b"short"
+    assert not isinstance(body_from_cdp("short", False, spool_threshold=10), BodySpool)
+
+    body = body_from_cdp("a longer body", False, spool_threshold=10)
+    assert isinstance(body, BodySpool)
+    assert read_body(body) == b"a longer body"
+    assert read_body(None) is None
+
+
+def test_spooled_body_in_capture_log(tmp_path):
+    writer = CaptureLogWriter(str(tmp_path))
+    spool = decode_to_spool("x" * 1000, False, chunk_size=128)
+    location = writer.append_body("1.1", 0, spool)
+    writer.close()
+
+    comm = CaptureLogReader(str(tmp_path)).load_communication("1.1", [location])
+    assert comm.response_bodies == [b"x" * 1000]
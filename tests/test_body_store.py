@@ -0,0 +1,101 @@
+import json
+import pytest
+
+from unittest.mock import patch
+
+from .mocks import EventMock, UrlfilterMock
+from cdprecorder.action import ResponseAction
+from cdprecorder.backends import get_backend
+from cdprecorder.body_spool import BodySpool, StoredBody, decode_to_spool, read_body
+from cdprecorder.body_store import BodyStore
+from cdprecorder.recorder import collect_communications, set_runtime_context
+
+
+@pytest.mark.parametrize("directory", [False, True])
+def test_body_store_deduplicates(tmp_path, directory):
+    store = BodyStore(str(tmp_path / "bodies") if directory else None)
+    page = b"<html>" + b"a" * 1000 + b"</html>"
+
+    first = store.add(page)
+    second = store.add(decode_to_spool(page.decode(), False, chunk_size=64))
+    other = store.add(b"other")
+
+    assert first == second == page
+    assert first.digest == second.digest != other.digest
+    assert len(store) == 2
+    assert first.digest in store
+    assert store.get(first.digest) == page
+    assert other.read() == b"other"
+    if directory:
+        assert sorted(path.name for path in (tmp_path / "bodies").iterdir()) == sorted([first.digest, other.digest])
+
+    stats = store.stats
+    assert (stats.added, stats.unique) == (3, 2)
+    assert stats.added_bytes == 2 * len(page) + 5
+    # The page compresses, the short body is stored as it is
+    assert stats.stored_bytes < len(page)
+    assert stats.dedup_ratio > 1.5
+    assert stats.compression_ratio > 10
+
+
+def test_body_store_cache_size():
+    store = BodyStore(cache_size=10)
+    small, large = store.add(b"12345678"), store.add(b"x" * 100)
+
+    assert small.read() == b"12345678"
+    assert large.read() == b"x" * 100
+    # Larger than the whole cache, not kept
+    assert list(store._cache) == [small.digest]
+
+    other = store.add(b"87654321")
+    assert other.read() == b"87654321"
+    assert list(store._cache) == [other.digest]
+    assert store._cache_bytes == 8
+
+
+def test_stored_body_in_action():
+    store = BodyStore()
+    action = ResponseAction()
+    action.set_body(store.add(b"body"))
+
+    assert isinstance(vars(action)["body"], StoredBody)
+    assert action.body == b"body"
+    assert read_body(vars(action)["body"]) == b"body"
+    # The copy shares the stored body, without reading it
+    copy = ResponseAction()
+    copy.shallow_copy_from_action(action)
+    assert vars(copy)["body"] is vars(action)["body"]
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_collect_communications_with_body_store(RuntimeContext, events_file):
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    set_runtime_context(RuntimeContext())
+    event_mock = EventMock(list(events))
+    expected = await collect_communications(
+        event_mock, event_mock, UrlfilterMock(), timeout=10, show_control_window=False, backend=get_backend("asyncio")
+    )
+
+    store = BodyStore()
+    event_mock = EventMock(list(events))
+    communications = await collect_communications(
+        event_mock,
+        event_mock,
+        UrlfilterMock(),
+        timeout=10,
+        show_control_window=False,
+        backend=get_backend("asyncio"),
+        body_store=store,
+    )
+    set_runtime_context(None)
+
+    bodies = [body for comm in communications for body in comm.response_bodies if body is not None]
+    assert bodies and all(isinstance(body, StoredBody) for body in bodies)
+    assert not any(isinstance(body, BodySpool) for body in bodies)
+    assert [comm.response_bodies for comm in communications] == [comm.response_bodies for comm in expected]
+    assert store.stats.added == len(bodies)
+    assert len(store) <= len(bodies)
@@ -0,0 +1,117 @@
+import asyncio
+import pytest
+
+from adblockparser import AdblockRules
+from collections import defaultdict
+from pycdp import cdp
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from cdprecorder.backends import get_backend
+from cdprecorder.browser_blocking import ResourceTypeBlocker, blocked_domains, domain_url_patterns
+
+
+def test_blocked_domains_keeps_only_plain_domain_rules():
+    rules = AdblockRules(
+        [
+            "||ads.example.com^",
+            "||tracker.net^",
+            "||tracker.net^",
+            "||thirdparty.com^$third-party",
+            "||cdn.example.org/ads/",
+            "/banner/*",
+            "||allowed.com^",
+            "@@||static.allowed.com/lib.js",
+        ]
+    )
+
+    assert blocked_domains(rules) == ["ads.example.com", "tracker.net"]
+
+
+def test_domain_url_patterns():
+    assert domain_url_patterns(["tracker.net"]) == ["*://tracker.net/*", "*://*.tracker.net/*"]
+
+
+class FetchSessionMock:
+    def __init__(self):
+        self._listeners = defaultdict(set)
+        self.methods = []
+
+    async def execute(self, method_generator):
+        method = next(method_generator)
+        self.methods.append((method["method"], method.get("params", {})))
+
+
+class FailingFetchSessionMock(FetchSessionMock):
+    """Fails the first request it's asked to fail, with an unexpected error."""
+    async def execute(self, method_generator):
+        await super().execute(method_generator)
+        failed = [method for method, _ in self.methods if method == "Fetch.failRequest"]
+        if self.methods[-1][0] == "Fetch.failRequest" and len(failed) == 1:
+            raise RuntimeError("unexpected")
+
+
+class ListenerMock:
+    def __init__(self):
+        self.queue = asyncio.Queue()
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.queue.get()
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.mark.asyncio
+async def test_resource_type_blocker():
+    session = FetchSessionMock()
+    listener = ListenerMock()
+    backend = get_backend("asyncio")
+    blocker = ResourceTypeBlocker(session, [cdp.network.ResourceType.IMAGE], backend)
+
+    with patch.object(backend, "create_event_listener", return_value=listener):
+        await blocker.start()
+    assert listener in session._listeners[cdp.fetch.RequestPaused]
+
+    listener.queue.put_nowait(SimpleNamespace(request_id=cdp.fetch.RequestId("1.1")))
+
+    async def wait_blocked():
+        while blocker.blocked == 0:
+            await asyncio.sleep(0)
+
+    await asyncio.wait_for(wait_blocked(), 5)
+    await blocker.stop()
+
+    assert [method for method, _ in session.methods] == ["Fetch.enable", "Fetch.failRequest", "Fetch.disable"]
+    assert session.methods[1][1]["requestId"] == "1.1"
+    assert listener.closed
+
+
+@pytest.mark.asyncio
+async def test_resource_type_blocker_survives_errors():
+    session = FailingFetchSessionMock()
+    listener = ListenerMock()
+    backend = get_backend("asyncio")
+    blocker = ResourceTypeBlocker(session, [cdp.network.ResourceType.IMAGE], backend)
+
+    with patch.object(backend, "create_event_listener", return_value=listener):
+        await blocker.start()
+    listener.queue.put_nowait(SimpleNamespace(request_id=cdp.fetch.RequestId("1.1")))
+    listener.queue.put_nowait(SimpleNamespace(request_id=cdp.fetch.RequestId("1.2")))
+
+    async def wait_blocked():
+        while blocker.blocked == 0:
+            await asyncio.sleep(0)
+
+    # The error of the first request didn't stop the blocker
+    await asyncio.wait_for(wait_blocked(), 5)
+    await blocker.stop()
+
+    assert [params["requestId"] for method, params in session.methods if method == "Fetch.failRequest"] == [
+        "1.1",
+        "1.2",
+    ]
@@ -0,0 +1,147 @@
+import json
+import pytest
+
+from unittest.mock import patch
+
+from .mocks import UrlfilterMock, EventMock
+from cdprecorder.action import InputAction
+from cdprecorder.body_policy import DEFAULT_BODY_CAPTURE_POLICY
+from cdprecorder.capture_log import CaptureLogReader, CaptureLogWriter, list_segments
+from cdprecorder.recorder import Recorder, collect_communications, set_runtime_context
+
+
+def test_body_records_roundtrip(tmp_path):
+    writer = CaptureLogWriter(str(tmp_path), segment_size=64)
+    locations = [
+        writer.append_body("1.1", 1, b"second body, long enough to start a new segment"),
+        writer.append_body("1.1", 0, None),
+    ]
+    writer.append_input_action(InputAction("text", "#input", 12.5))
+    writer.close()
+
+    assert len(list_segments(str(tmp_path))) > 1
+
+    reader = CaptureLogReader(str(tmp_path))
+    comm = reader.load_communication("1.1", locations)
+    assert comm.response_bodies == [None, b"second body, long enough to start a new segment"]
+
+    recovered = list(CaptureLogReader(str(tmp_path)).recover_communications())
+    assert len(recovered) == 2
+    assert isinstance(recovered[1], InputAction)
+    assert recovered[1].selector == "#input"
+
+
+def test_writer_refuses_existing_log(tmp_path):
+    CaptureLogWriter(str(tmp_path)).close()
+    with pytest.raises(FileExistsError):
+        CaptureLogWriter(str(tmp_path))
+
+
+async def collect_from_file(events_file, capture_log=None):
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    event_mock = EventMock(events)
+    communications = await collect_communications(
+        event_mock, event_mock, UrlfilterMock(), timeout=10, capture_log=capture_log
+    )
+    return list(communications)
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_collect_communications_with_capture_log(RuntimeContext, events_file, tmp_path):
+    """The communications read back from the capture log must be the same as
+    the ones kept in memory. Ignored communications are not read back."""
+    set_runtime_context(RuntimeContext())
+    expected = await collect_from_file(events_file)
+
+    writer = CaptureLogWriter(str(tmp_path))
+    communications = await collect_from_file(events_file, writer)
+    writer.close()
+    set_runtime_context(None)
+
+    assert len(communications) == len(expected)
+    for comm, expected_comm in zip(communications, expected):
+        assert comm.request_id == expected_comm.request_id
+        assert comm.ignored == expected_comm.ignored
+        if not comm.ignored:
+            assert comm == expected_comm
+
+    # Without the recorder's index, everything is rebuilt by scanning the log
+    recovered = list(CaptureLogReader(str(tmp_path)).recover_communications())
+    assert recovered == expected
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_collect_communications_with_memory_budget(RuntimeContext, events_file, tmp_path):
+    """Over the budget, the finished communications are spilled, and read
+    back in order. The spill log is removed after it's read."""
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    set_runtime_context(RuntimeContext())
+    expected = await collect_from_file(events_file)
+
+    spill_dir = tmp_path / "spill"
+    event_mock = EventMock(events)
+    communications = await collect_communications(
+        event_mock, event_mock, UrlfilterMock(), timeout=10, memory_budget=20000, spill_dir=str(spill_dir)
+    )
+    set_runtime_context(None)
+
+    assert not isinstance(communications, list)
+    assert list(communications) == expected
+    assert spill_dir.exists()
+    assert list(spill_dir.iterdir()) == []
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_recorder_forgets_finished_requests(RuntimeContext, events_file, tmp_path):
+    """The per-request bookkeeping doesn't grow with the recording."""
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    recorders = []
+
+    def make_recorder(*args, **kwargs):
+        recorders.append(Recorder(*args, **kwargs))
+        return recorders[-1]
+
+    set_runtime_context(RuntimeContext())
+    event_mock = EventMock(events)
+    with patch("cdprecorder.recorder.Recorder", side_effect=make_recorder):
+        communications = await collect_communications(
+            event_mock,
+            event_mock,
+            UrlfilterMock(),
+            timeout=10,
+            body_capture_policy=DEFAULT_BODY_CAPTURE_POLICY,
+            memory_budget=20000,
+            spill_dir=str(tmp_path),
+            on_communication_finished=lambda comm: None,
+        )
+    set_runtime_context(None)
+    list(communications)
+
+    ended = {
+        evt["params"]["requestId"]
+        for evt in events
+        if evt["method"] in ("Network.loadingFinished", "Network.loadingFailed")
+    }
+    recorder = recorders[0]
+    assert recorder.spilled_communications
+    # Only the requests whose loading never ended are still known
+    assert not set(recorder._request_urls) & ended
+    assert not set(recorder._mime_types) & ended
+    assert not set(recorder._request_sessions) & ended
+    assert not set(recorder._pending_fetches) & ended
+    assert not recorder._unfinished
+    # Only the communications that can still be spilled keep their position
+    assert set(recorder._positions) <= set(recorder._spillable) | set(recorder.request_map) - ended
+    assert not set(recorder._positions) & recorder._spilled
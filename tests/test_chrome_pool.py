@@ -0,0 +1,82 @@
+import os
+
+from unittest.mock import MagicMock, patch
+
+from twisted.internet import defer
+
+from cdprecorder.chrome_pool import ChromePool
+
+
+def run_now(func, *args):
+    return defer.maybeDeferred(func, *args)
+
+
+def launchers(ChromeLauncher):
+    return [call.kwargs for call in ChromeLauncher.call_args_list]
+
+
+@patch("cdprecorder.chrome_pool.threads.deferToThread", run_now)
+@patch("cdprecorder.chrome_pool.wait_for_devtools")
+@patch("cdprecorder.chrome_pool.ChromeLauncher")
+def test_chrome_pool_reuses_browsers(ChromeLauncher, wait_for_devtools):
+    ChromeLauncher.side_effect = lambda **kwargs: MagicMock()
+    pool = ChromePool("chrome", size=2, base_port=9250, max_recordings=2)
+    defer.ensureDeferred(pool.start())
+
+    assert pool.idle == 2
+    assert [kwargs["args"][0] for kwargs in launchers(ChromeLauncher)] == [
+        "--remote-debugging-port=9250",
+        "--remote-debugging-port=9251",
+    ]
+    assert [call.args for call in wait_for_devtools.call_args_list] == [
+        ("http://localhost:9250", 30.0),
+        ("http://localhost:9251", 30.0),
+    ]
+
+    # Back-to-back recordings get the same browser, without launching
+    browser = defer.ensureDeferred(pool.acquire()).result
+    defer.ensureDeferred(pool.release(browser))
+    assert defer.ensureDeferred(pool.acquire()).result is browser
+    assert ChromeLauncher.call_count == 2
+
+    # After its last recording, the browser is replaced, on the same port
+    defer.ensureDeferred(pool.release(browser))
+    browser.chrome.kill.assert_called_once()
+    assert ChromeLauncher.call_count == 3
+    assert launchers(ChromeLauncher)[-1]["args"][0] == f"--remote-debugging-port={browser.port}"
+    assert pool.idle == 2
+
+    # A failed browser is replaced
+    failed = defer.ensureDeferred(pool.acquire()).result
+    defer.ensureDeferred(pool.release(failed, healthy=False))
+    failed.chrome.kill.assert_called_once()
+    assert ChromeLauncher.call_count == 4
+
+    idle = list(pool._idle)
+    defer.ensureDeferred(pool.close())
+    assert pool.idle == 0
+    for browser in idle:
+        browser.chrome.kill.assert_called_once()
+
+
+@patch("cdprecorder.chrome_pool.threads.deferToThread", run_now)
+@patch("cdprecorder.chrome_pool.wait_for_devtools")
+@patch("cdprecorder.chrome_pool.ChromeLauncher")
+def test_chrome_pool_launches_when_empty(ChromeLauncher, wait_for_devtools):
+    ChromeLauncher.side_effect = lambda **kwargs: MagicMock()
+    pool = ChromePool("chrome", size=1)
+
+    first = defer.ensureDeferred(pool.acquire()).result
+    second = defer.ensureDeferred(pool.acquire()).result
+    assert first.port != second.port
+
+    # Only one browser is kept
+    defer.ensureDeferred(pool.release(first))
+    defer.ensureDeferred(pool.release(second))
+    assert pool.idle == 1
+    second.chrome.kill.assert_called_once()
+
+    # Removes the profile directory of the kept browser
+    defer.ensureDeferred(pool.close())
+    assert pool.idle == 0
+    assert not os.path.exists(first.profile_dir)
@@ -0,0 +1,96 @@
+import pycdp
+import pytest
+
+from twisted.internet import defer
+
+from cdprecorder.event_buffer import AdaptiveEventQueue
+
+
+async def drain(queue):
+    queue.close()
+    return [event async for event in queue]
+
+
+@pytest.mark.asyncio
+async def test_queue_grows_before_spilling():
+    queue = AdaptiveEventQueue("page", capacity=2, max_capacity=8)
+    for i in range(8):
+        queue.put(i)
+
+    assert await drain(queue) == list(range(8))
+    assert queue.stats.capacity == 8
+    assert queue.stats.growths == 2
+    assert queue.stats.spilled == 0
+    assert queue.stats.peak_depth == 8
+
+
+@pytest.mark.asyncio
+async def test_queue_spills_and_keeps_order():
+    queue = AdaptiveEventQueue("page", capacity=2, max_capacity=2)
+    for i in range(5):
+        queue.put({"id": i})
+    assert [await queue.get() for _ in range(3)] == [{"id": 0}, {"id": 1}, {"id": 2}]
+
+    # New events go after the spilled ones
+    queue.put({"id": 5})
+
+    assert await drain(queue) == [{"id": 3}, {"id": 4}, {"id": 5}]
+    assert queue.stats.spilled == 4
+    assert queue.stats.dropped == 0
+    assert queue.stats.received == queue.stats.delivered == 6
+
+
+@pytest.mark.asyncio
+async def test_queue_drops_without_spilling():
+    queue = AdaptiveEventQueue("page", capacity=2, max_capacity=2, spill=False)
+    for i in range(5):
+        queue.put(i)
+
+    assert await drain(queue) == [0, 1]
+    assert queue.stats.dropped == 3
+
+
+@pytest.mark.asyncio
+async def test_queue_delivers_to_waiting_consumer():
+    queue = AdaptiveEventQueue("page")
+    waiting = queue.get()
+    queue.put("event")
+
+    assert await waiting == "event"
+    assert queue.stats.peak_depth == 0
+
+
+def test_queue_cancelled_get():
+    queue = AdaptiveEventQueue("page")
+    waiting = queue.get()
+    waiting.addErrback(lambda failure: failure.trap(defer.CancelledError))
+    waiting.cancel()
+
+    queue.put("event")
+    assert queue.get().result == "event"
+
+
+def test_closed_queue_rejects_events():
+    queue = AdaptiveEventQueue("page")
+    queue.close()
+
+    with pytest.raises(pycdp.exceptions.CDPEventListenerClosed):
+        queue.put("event")
+    assert queue.get().result is None
+
+
+class Session:
+    """Can't be pickled, like a CDP session."""
+    def __reduce__(self):
+        raise TypeError("sessions can't be pickled")
+
+
+@pytest.mark.asyncio
+async def test_queue_spills_events_with_references():
+    session = Session()
+    queue = AdaptiveEventQueue("merged", capacity=1, max_capacity=1, keep_in_memory=(Session,))
+    for i in range(3):
+        queue.put((session, i))
+
+    assert await drain(queue) == [(session, 0), (session, 1), (session, 2)]
+    assert queue.stats.spilled == 2
@@ -0,0 +1,135 @@
+import json
+import os
+import shutil
+import subprocess
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock
+
+import cdprecorder
+from cdprecorder.recorder import RuntimeContext
+
+NODE = shutil.which("node")
+PACKAGE_DIR = os.path.dirname(cdprecorder.__file__)
+
+# Runs event_listener.js and send_hooks.js in a fake page, and prints what
+# reached Python and the network, in order. In the browser, they run in two
+# worlds that share only the DOM.
+HARNESS = """
+const fs = require('fs');
+const vm = require('vm');
+
+const log = [];
+const handlers = {};
+globalThis.window = globalThis;
+globalThis.addEventListener = (type, handler) => {
+    (handlers[type] = handlers[type] || []).push(handler);
+};
+globalThis.document = new EventTarget();
+document.visibilityState = 'visible';
+globalThis.MutationObserver = class {
+    observe() {}
+    takeRecords() { return []; }
+};
+globalThis.event = {};
+globalThis.navigator = {sendBeacon: (url) => log.push(['request', url])};
+globalThis.fetch = (url) => log.push(['request', url]);
+globalThis.XMLHttpRequest = class {
+    open(method, url) { this.url = url; }
+    send() { log.push(['request', this.url]); }
+};
+
+vm.runInThisContext(fs.readFileSync(process.argv[2], 'utf8'));
+vm.runInThisContext(fs.readFileSync(process.argv[3], 'utf8'));
+globalThis.sendRecordedEvent = (message) => {
+    for (const recordedEvent of JSON.parse(message)) {
+        log.push([recordedEvent.event, recordedEvent.value]);
+    }
+};
+
+const input = {tagName: 'INPUT', className: '', value: '', attributes: {length: 0}};
+input.parentNode = {children: [input]};
+const type = (value) => {
+    input.value = value;
+    for (const handler of handlers['input']) {
+        handler({timeStamp: 1, composedPath: () => [input]});
+    }
+};
+"""
+
+SEND_BEFORE_REQUESTS = """
+// The page asks for suggestions while the typed values wait in the batch
+type('c');
+type('ca');
+fetch('/suggest?q=ca');
+type('dog');
+const xhr = new XMLHttpRequest();
+xhr.open('GET', '/suggest?q=dog');
+xhr.send();
+type('done');
+navigator.sendBeacon('/log');
+
+console.log(JSON.stringify(log));
+process.exit(0);
+"""
+
+TAKE_WHEN_STOPPED = """
+type('last');
+const pending = JSON.parse(takeRecordedEvents());
+// The timers of the batch were stopped, and nothing is left to send
+setTimeout(() => {
+    console.log(JSON.stringify({pending, log, left: JSON.parse(takeRecordedEvents())}));
+}, 2500);
+"""
+
+
+def run_in_page(tmp_path, scenario):
+    harness = tmp_path / "harness.js"
+    harness.write_text(HARNESS + scenario, encoding="utf8")
+
+    result = subprocess.run(
+        [
+            NODE,
+            str(harness),
+            os.path.join(PACKAGE_DIR, "event_listener.js"),
+            os.path.join(PACKAGE_DIR, "send_hooks.js"),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout)
+
+
+@pytest.mark.skipif(NODE is None, reason="node is not installed")
+def test_batched_input_is_sent_before_request(tmp_path):
+    assert run_in_page(tmp_path, SEND_BEFORE_REQUESTS) == [
+        ["input", "ca"],
+        ["request", "/suggest?q=ca"],
+        ["input", "dog"],
+        ["request", "/suggest?q=dog"],
+        ["input", "done"],
+        ["request", "/log"],
+    ]
+
+
+@pytest.mark.skipif(NODE is None, reason="node is not installed")
+def test_take_recorded_events(tmp_path):
+    result = run_in_page(tmp_path, TAKE_WHEN_STOPPED)
+
+    assert [event["value"] for event in result["pending"]] == ["last"]
+    assert result["log"] == []
+    assert result["left"] == []
+
+
+@pytest.mark.asyncio
+async def test_runtime_context_takes_pending_events():
+    session = MagicMock()
+    payload = json.dumps([{"event": "input", "selector": "#q", "value": "cat", "timestamp": 1.5}])
+    session.execute = AsyncMock(return_value=(MagicMock(value=payload), None))
+    runtime = RuntimeContext(session, "listener", 1)
+
+    await runtime.take_pending_events()
+
+    actions = runtime.pop_actions()
+    assert [(action.text, action.selector) for action in actions] == [("cat", "#q")]
@@ -0,0 +1,146 @@
+import asyncio
+import json
+import os
+import pytest
+
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from pycdp import cdp
+
+from .mocks import UrlfilterMock
+from cdprecorder.backends import get_backend
+from cdprecorder.capture_log import CaptureLogWriter
+from cdprecorder.farm import BrowserScheduler, Flow, FlowError, FlowStep, RecordingFarm, load_flows, run_flow_steps
+from cdprecorder.recorder import RecorderOptions
+
+
+class PageSessionMock:
+    """Answers Runtime.evaluate with the given values, and remembers the
+    executed commands."""
+    def __init__(self, values):
+        self.values = list(values)
+        self.commands = []
+
+    async def execute(self, method_generator):
+        method = next(method_generator)
+        self.commands.append(method)
+        if method["method"] == "Runtime.evaluate":
+            return cdp.runtime.RemoteObject(type_="boolean", value=self.values.pop(0)), None
+        return None
+
+
+def test_load_flows(tmp_path):
+    path = tmp_path / "flows.json"
+    path.write_text(
+        json.dumps(
+            [
+                {
+                    "name": "log in / out",
+                    "start_url": "https://example.com",
+                    "steps": [{"action": "click", "selector": "#login"}, {"action": "wait", "seconds": 1}],
+                },
+                {"name": "home", "start_url": "https://example.com", "timeout": 5},
+            ]
+        )
+    )
+
+    flows = load_flows(str(path))
+
+    assert flows[0].steps == (FlowStep("click", selector="#login"), FlowStep("wait", seconds=1))
+    assert flows[0].directory_name == "log_in_out"
+    assert flows[1] == Flow("home", "https://example.com", (), 5.0)
+
+
+def test_load_flows_rejects_duplicate_names(tmp_path):
+    path = tmp_path / "flows.json"
+    flow = {"name": "home", "start_url": "https://example.com"}
+    path.write_text(json.dumps([flow, flow]))
+
+    with pytest.raises(ValueError):
+        load_flows(str(path))
+
+
+def test_flow_step_validation():
+    with pytest.raises(ValueError):
+        FlowStep("hover", selector="#menu")
+    with pytest.raises(ValueError):
+        FlowStep("type", selector="#user")
+
+
+@pytest.mark.asyncio
+async def test_run_flow_steps():
+    # The element isn't there at the first check
+    session = PageSessionMock([False, True, None, True, None])
+    steps = [FlowStep("click", selector="#go"), FlowStep("type", selector="input[name='q']", value="cats")]
+
+    await run_flow_steps(session, steps, get_backend("asyncio"))
+
+    expressions = [cmd["params"]["expression"] for cmd in session.commands if cmd["method"] == "Runtime.evaluate"]
+    assert expressions == [
+        'document.querySelector("#go") !== null',
+        'document.querySelector("#go") !== null',
+        'document.querySelector("#go").click()',
+        "document.querySelector(\"input[name='q']\") !== null",
+        "document.querySelector(\"input[name='q']\").focus()",
+    ]
+    assert session.commands[-1] == {"method": "Input.insertText", "params": {"text": "cats"}}
+
+
+@pytest.mark.asyncio
+async def test_run_flow_steps_times_out():
+    session = PageSessionMock([False] * 10)
+
+    with pytest.raises(FlowError):
+        await run_flow_steps(session, [FlowStep("click", selector="#missing", timeout=0)], get_backend("asyncio"))
+
+
+@patch("cdprecorder.farm.available_memory", return_value=3 * 1024**3)
+@patch("os.cpu_count", return_value=8)
+def test_browser_scheduler_limit(cpu_count, available_memory):
+    assert BrowserScheduler().limit == 6
+    assert BrowserScheduler(cpus_per_browser=2).limit == 4
+    assert BrowserScheduler(max_browsers=2).limit == 2
+    assert BrowserScheduler(memory_per_browser=4 * 1024**3).limit == 1
+
+
+@pytest.mark.asyncio
+async def test_recording_farm_runs_twice(tmp_path):
+    async def record(options, urlfilter, script, chrome_pool=None):
+        CaptureLogWriter(options.capture_dir).close()
+
+    chrome_pool = MagicMock(start=AsyncMock())
+    farm = RecordingFarm(
+        str(tmp_path),
+        options=RecorderOptions("", backend="asyncio"),
+        urlfilter=UrlfilterMock(),
+        chrome_pool=chrome_pool,
+    )
+    flows = [Flow("login", "https://example.com/login"), Flow("search", "https://example.com/")]
+
+    with patch("cdprecorder.farm.record", side_effect=record), patch("time.strftime", return_value="run"):
+        first = await farm.run(flows)
+        second = await farm.run(flows)
+
+    assert all(result.ok for result in first + second)
+    # The second run didn't reuse the capture logs of the first
+    assert [result.capture_dir for result in first + second] == [
+        os.path.join(str(tmp_path), "login", "run"),
+        os.path.join(str(tmp_path), "search", "run"),
+        os.path.join(str(tmp_path), "login", "run-1"),
+        os.path.join(str(tmp_path), "search", "run-1"),
+    ]
+
+
+@pytest.mark.asyncio
+async def test_browser_scheduler_waits_for_a_free_browser():
+    scheduler = BrowserScheduler(max_browsers=1, backend=get_backend("asyncio"))
+    await scheduler.acquire()
+
+    waiting = asyncio.ensure_future(scheduler.acquire())
+    await asyncio.sleep(0)
+    assert not waiting.done()
+
+    with patch.object(scheduler, "is_overloaded", return_value=False):
+        scheduler.release()
+        await asyncio.wait_for(waiting, 5)
+    assert scheduler.running == 1
@@ -0,0 +1,30 @@
+from unittest.mock import MagicMock, patch
+
+from cdprecorder.filters import FilterListCache
+
+
+def make_response(status_code, text="", headers=None):
+    res = MagicMock()
+    res.status_code = status_code
+    res.text = text
+    res.headers = headers or {}
+    return res
+
+
+@patch("cdprecorder.filters.requests.get")
+def test_filter_list_cache_revalidates(get, tmp_path):
+    cache = FilterListCache("https://filters.test/list.txt", str(tmp_path))
+    assert cache.load_rules() is None
+    assert cache.age() is None
+
+    get.return_value = make_response(200, "[Adblock]\n||ads.test^\n##.banner", {"ETag": '"v1"'})
+    urlfilter = cache.refresh()
+    assert urlfilter.should_block("https://ads.test/x.js")
+    # The element hiding rule is not kept
+    assert cache.load_rules() == ["||ads.test^"]
+    assert cache.age() < 60
+
+    get.return_value = make_response(304)
+    assert cache.refresh() is None
+    assert get.call_args.kwargs["headers"] == {"If-None-Match": '"v1"'}
+    assert cache.load_rules() == ["||ads.test^"]
@@ -0,0 +1,150 @@
+import base64
+import io
+import json
+import pytest
+
+from cdprecorder.action import RequestAction, ResponseAction
+from cdprecorder.analyser import analyse_actions
+from cdprecorder.body_spool import BodySpool, LazyBody, StoredBody
+from cdprecorder.body_store import BodyStore
+from cdprecorder.har import HarFormatError, iter_har_entries, load_har_actions
+
+
+def har_entry(method, url, status, request_headers=(), response_headers=(), post_text=None, content=None):
+    entry = {
+        "startedDateTime": "2024-01-01T00:00:00.000Z",
+        "time": 12.5,
+        "request": {
+            "method": method,
+            "url": url,
+            "httpVersion": "HTTP/1.1",
+            "headers": [{"name": name, "value": value} for name, value in request_headers],
+            "cookies": [],
+            "queryString": [],
+            "headersSize": -1,
+            "bodySize": 0,
+        },
+        "response": {
+            "status": status,
+            "statusText": "",
+            "httpVersion": "HTTP/1.1",
+            "headers": [{"name": name, "value": value} for name, value in response_headers],
+            "cookies": [],
+            "content": content or {"size": 0, "mimeType": ""},
+            "redirectURL": "",
+            "headersSize": -1,
+            "bodySize": -1,
+        },
+        "cache": {},
+        "timings": {"send": 0, "wait": 10, "receive": 2.5},
+    }
+    if post_text is not None:
+        entry["request"]["postData"] = {"mimeType": "application/x-www-form-urlencoded", "text": post_text}
+    return entry
+
+
+def write_har(path, entries):
+    har = {
+        "log": {
+            "version": "1.2",
+            "creator": {"name": "test", "version": "1.0"},
+            "pages": [{"id": "page_1", "title": "[{\"entries\": []}]"}],
+            "entries": entries,
+        }
+    }
+    with open(path, "w", encoding="utf8") as f:
+        json.dump(har, f, indent=2)
+
+
+@pytest.fixture
+def login_har(tmp_path):
+    page = b'<html><input name="csrf" value="a1b2c3d4e5"></html>'
+    entries = [
+        har_entry(
+            "GET",
+            "https://example.com/login",
+            200,
+            request_headers=[(":authority", "example.com"), ("Cookie", "session=xyz"), ("cookie", "lang=en")],
+            response_headers=[("Set-Cookie", "a=1"), ("Set-Cookie", "b=2"), ("Content-Type", "text/html")],
+            content={"size": len(page), "mimeType": "text/html", "text": base64.b64encode(page).decode(), "encoding": "base64"},
+        ),
+        har_entry(
+            "POST",
+            "https://example.com/login",
+            302,
+            post_text="user=alice&csrf=a1b2c3d4e5",
+            response_headers=[("Location", "/home")],
+        ),
+        har_entry("GET", "https://tracker.example.com/pixel", 0),
+    ]
+    path = tmp_path / "login.har"
+    write_har(path, entries)
+    return str(path)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024 * 1024])
+def test_iter_har_entries_in_chunks(login_har, chunk_size):
+    with open(login_har, encoding="utf8") as f:
+        expected = json.load(f)["log"]["entries"]
+
+    with open(login_har, encoding="utf8") as f:
+        assert list(iter_har_entries(f, chunk_size)) == expected
+
+
+def test_iter_har_entries_invalid():
+    with pytest.raises(HarFormatError):
+        list(iter_har_entries(io.StringIO('{"log": {"entries": [{"request": '), 4))
+    with pytest.raises(HarFormatError):
+        list(iter_har_entries(io.StringIO('{"log": {"entries": []}} {}')))
+    assert list(iter_har_entries(io.StringIO('{"log": {"version": 1.2}}'), 3)) == []
+
+
+def test_load_har_actions(login_har):
+    actions = load_har_actions(login_har)
+
+    assert [type(action) for action in actions] == [RequestAction, ResponseAction, RequestAction, ResponseAction, RequestAction]
+    assert [action.ID for action in actions] == [0, 1, 2, 3, 4]
+
+    page_request, page, login, redirect, pixel = actions
+    assert page_request.has_response
+    assert ":authority" not in page_request.headers
+    assert page_request.cookies_to_dict() == {"session": "xyz", "lang": "en"}
+    assert page.headers["set-cookie"] == "a=1\nb=2"
+    assert page.status == 200
+
+    # The bodies are decoded when they are read
+    assert isinstance(vars(page)["body"], LazyBody)
+    assert page.body == b'<html><input name="csrf" value="a1b2c3d4e5"></html>'
+    assert vars(page)["body"] is page.body
+    assert login.body == b"user=alice&csrf=a1b2c3d4e5"
+    assert redirect.body is None
+
+    # A request without a response
+    assert not pixel.has_response
+    assert pixel.status is None
+
+
+def test_load_har_actions_spooled_bodies(login_har):
+    actions = load_har_actions(login_har, spool_threshold=10)
+
+    assert isinstance(vars(actions[1])["body"].data, BodySpool)
+    assert actions == load_har_actions(login_har)
+
+
+def test_load_har_actions_body_store(login_har):
+    store = BodyStore()
+    actions = load_har_actions(login_har, body_store=store)
+
+    assert isinstance(vars(actions[1])["body"], StoredBody)
+    assert actions[1].body == b'<html><input name="csrf" value="a1b2c3d4e5"></html>'
+    # The request bodies stay lazy
+    assert isinstance(vars(actions[2])["body"], LazyBody)
+    assert len(store) == 1
+
+
+def test_analyse_har_actions(login_har):
+    actions = load_har_actions(login_har)
+    analyse_actions(actions)
+
+    # The CSRF token of the login comes from the login page
+    assert actions[2].targets
@@ -1,3 +1,4 @@
+import copy
 import json
 import pytest
 
@@ -7,8 +8,11 @@ from .mocks import EventMock, UrlfilterMock
 from .action_serializer import replace_action_body_with_length, replace_date_headers, ActionsJSONEncoder, json_actions_loads
 
 import cdprecorder
-from main import parse_communications_into_actions
-from cdprecorder.recorder import collect_communications, set_runtime_context
+from cdprecorder import generate_python
+from main import parse_communications_into_actions, run
+from cdprecorder.action import RequestAction
+from cdprecorder.analyser import IncrementalAnalyser, analyse_actions
+from cdprecorder.recorder import RecorderOptions, collect_communications, set_runtime_context
 
 
 @pytest.mark.parametrize(
@@ -43,3 +47,49 @@ async def test_parse_communications_into_actions(RuntimeContext, events_file, ac
         replace_action_body_with_length(action)
 
     assert actions == expected_actions
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@pytest.mark.asyncio
+@patch("cdprecorder.recorder.RuntimeContext")
+async def test_incremental_analyser(RuntimeContext, events_file, tmp_path):
+    """Adding the actions one by one finds the same targets as analysing the
+    whole list, so the generated code is the same."""
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    event_mock = EventMock(events)
+    set_runtime_context(RuntimeContext())
+    communications = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10)
+    set_runtime_context(None)
+
+    actions = parse_communications_into_actions(communications)
+    for idx, action in enumerate(actions):
+        action.ID = idx
+    expected = copy.deepcopy(actions)
+    analyse_actions(expected)
+
+    analyser = IncrementalAnalyser()
+    for action in actions:
+        analyser.add_action(action)
+
+    assert [action.ID for action in analyser.actions] == [action.ID for action in expected]
+    generate_python.write_python_code(expected, str(tmp_path / "expected.py"))
+    generate_python.write_python_code(analyser.actions, str(tmp_path / "generated.py"))
+    assert (tmp_path / "generated.py").read_text() == (tmp_path / "expected.py").read_text()
+
+
+def test_incremental_analyser_keeps_non_form_bodies():
+    analyser = IncrementalAnalyser()
+    analyser.add_action(RequestAction(method="POST", url="https://example.com/api", body=b'{"a": 1}'))
+    analyser.add_action(RequestAction(method="POST", url="https://example.com/log", body=b"not a form"))
+
+    assert [action.ID for action in analyser.actions] == [0, 1]
+
+
+@pytest.mark.asyncio
+@patch("main.record")
+async def test_run_rejects_parse_processes_when_streaming(record):
+    with pytest.raises(ValueError):
+        await run(RecorderOptions("https://example.com"), streaming=True, parse_processes=2)
+    record.assert_not_called()
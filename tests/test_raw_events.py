@@ -0,0 +1,112 @@
+import collections
+import json
+import pickle
+import pytest
+
+from pycdp import cdp
+from unittest.mock import patch
+
+from .mocks import EventMock, UrlfilterMock
+from cdprecorder.event_buffer import AdaptiveEventQueue, listen_adaptive
+from cdprecorder.raw_events import RawEvent, request_url, resource_type
+from cdprecorder.recorder import HttpCommunication, collect_communications, set_runtime_context
+
+
+def load_events(events_file="tests/events_youtube.json"):
+    with open(events_file, encoding="utf8") as f:
+        return json.load(f)
+
+
+class RawEventMock(EventMock):
+    """Yields the network events unparsed, like a session with the raw
+    event hook."""
+    async def __anext__(self):
+        await super().__anext__()
+        event = self.emitted_events[-1]
+        if event["method"].startswith("Network."):
+            return RawEvent.from_json(event)
+        return cdp.util.parse_json_event(event)
+
+
+class SessionMock:
+    """Dispatches the events like pycdp's sessions."""
+    def __init__(self):
+        self._listeners = collections.defaultdict(set)
+
+    def _handle_event(self, data):
+        event = cdp.util.parse_json_event(data)
+        for listener in self._listeners[type(event)]:
+            listener.put(event)
+
+
+def test_raw_event_is_parsed_on_first_use():
+    data = next(event for event in load_events() if event["method"] == "Network.requestWillBeSent")
+    event = RawEvent.from_json(data)
+
+    assert event.event_type is cdp.network.RequestWillBeSent
+    assert event.request_id == data["params"]["requestId"]
+    assert request_url(event) == "http://youtube.com/"
+    assert resource_type(event) == cdp.network.ResourceType.DOCUMENT
+    assert not event.parsed
+
+    assert event.request.url == "http://youtube.com/"
+    assert event.parsed
+    assert event == cdp.util.parse_json_event(data)
+
+    copy = pickle.loads(pickle.dumps(event))
+    assert copy == event
+    assert not copy.parsed
+
+
+@pytest.mark.asyncio
+async def test_listen_adaptive_with_raw_events():
+    session = SessionMock()
+    raw_listener = listen_adaptive(
+        session,
+        (cdp.network.RequestWillBeSent, cdp.network.LoadingFinished),
+        "page",
+        raw_event_types=(cdp.network.RequestWillBeSent,),
+    )
+    listener = AdaptiveEventQueue("other")
+    session._listeners[cdp.network.RequestWillBeSent].add(listener)
+
+    events = [event for event in load_events() if event["method"] != "Runtime.consoleAPICalled"]
+    for event in events:
+        session._handle_event(event)
+    raw_listener.close()
+    listener.close()
+
+    received = [event async for event in raw_listener]
+    assert [type(event) for event in received] == [
+        RawEvent if event["method"] == "Network.requestWillBeSent" else type(cdp.util.parse_json_event(event))
+        for event in events
+        if event["method"] in ("Network.requestWillBeSent", "Network.loadingFinished")
+    ]
+    # The other listener gets the parsed events
+    parsed = [event async for event in listener]
+    assert parsed == [event.event for event in received if isinstance(event, RawEvent)]
+    assert all(isinstance(event, cdp.network.RequestWillBeSent) for event in parsed)
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_collect_communications_with_raw_events(RuntimeContext, events_file):
+    """The communications are the same as with parsed events, and the events
+    of the ignored communications are never parsed."""
+    set_runtime_context(RuntimeContext())
+    event_mock = EventMock(load_events(events_file))
+    expected = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10)
+
+    event_mock = RawEventMock(load_events(events_file))
+    communications = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10)
+    set_runtime_context(None)
+
+    ignored = [comm for comm in communications if isinstance(comm, HttpCommunication) and comm.ignored]
+    assert ignored
+    assert not any(event.parsed for comm in ignored for event in comm.events)
+
+    assert communications == expected
+    for comm in communications:
+        if isinstance(comm, HttpCommunication):
+            assert not any(isinstance(event, RawEvent) for event in comm.typed_events())
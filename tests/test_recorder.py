@@ -2,12 +2,19 @@ import json
 import pytest
 
 from pycdp import cdp
-from unittest.mock import patch
+from twisted.internet import defer
+from types import SimpleNamespace
+from unittest.mock import MagicMock, patch
 
 import cdprecorder
 from .mocks import UrlfilterMock, EventMock
+from cdprecorder.backends import get_backend
 from cdprecorder.recorder import (
+    PAGE_STATS_FILE,
+    RuntimeContext,
+    _report_page_stats,
     collect_communications,
+    execute_pipelined,
     extract_origin,
     is_url_ignored,
     set_runtime_context,
@@ -469,3 +476,152 @@ async def test_collect_communications(RuntimeContext,
     assert len(communications) == comm_count
     assert communications[0] == first_comm
     assert communications[-1] == last_comm
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch('cdprecorder.recorder.RuntimeContext')
+@pytest.mark.asyncio
+async def test_collect_communications_finished_callback(RuntimeContext, events_file):
+    """Every communication that isn't ignored is passed to the callback
+    once, complete."""
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    finished = []
+    event_mock = EventMock(events)
+    set_runtime_context(RuntimeContext())
+    communications = await collect_communications(
+        event_mock, event_mock, UrlfilterMock(), timeout=10, on_communication_finished=finished.append
+    )
+    set_runtime_context(None)
+
+    expected = [comm for comm in communications if not getattr(comm, "ignored", False)]
+    assert len(finished) == len(expected)
+    finished_by_id = {comm.request_id: comm for comm in finished}
+    for comm in expected:
+        assert finished_by_id[comm.request_id] == comm
+
+
+@pytest.mark.asyncio
+async def test_runtime_context_batched_events():
+    """event_listener.js sends its events in batches. Single events are still read."""
+    runtime = RuntimeContext(None, "", cdp.runtime.ExecutionContextId(1))
+    batch = [
+        {"event": "keypress", "timestamp": 1.0, "selector": "input", "value": "", "charCode": 97},
+        {"event": "input", "timestamp": 2.0, "selector": "input", "value": "alice"},
+        {"event": "click", "timestamp": 3.0, "selector": "button"},
+        {"event": "input", "timestamp": 4.0, "selector": "input[type=password]", "value": "secret"},
+    ]
+    await runtime.on_event_send(json.dumps(batch))
+    await runtime.on_event_send(json.dumps({"event": "input", "timestamp": 5.0, "selector": "textarea", "value": "hi"}))
+
+    actions = runtime.pop_actions()
+    assert [(action.text, action.selector, action.timestamp) for action in actions] == [
+        ("alice", "input", 2.0),
+        ("secret", "input[type=password]", 4.0),
+        ("hi", "textarea", 5.0),
+    ]
+    assert runtime.pop_actions() == []
+
+
+class EvaluateSessionMock:
+    def __init__(self, value):
+        self.value = value
+        self.expressions = []
+
+    async def execute(self, method_generator):
+        method = next(method_generator)
+        self.expressions.append(method["params"]["expression"])
+        return SimpleNamespace(value=self.value), None
+
+
+@pytest.mark.asyncio
+async def test_report_page_stats(tmp_path):
+    stats = {
+        "events": 40,
+        "handlerTime": 12.5,
+        "maxHandlerTime": 1.5,
+        "selectorCacheHits": 390,
+        "selectorCacheMisses": 10,
+        "selectorInvalidations": 3,
+        "observerTime": 0.5,
+        "batches": 4,
+        "sendTime": 0.25,
+    }
+    session = EvaluateSessionMock(stats)
+    runtime = RuntimeContext(session, "", cdp.runtime.ExecutionContextId(1))
+
+    await _report_page_stats(runtime, get_backend("asyncio"), MagicMock(directory=str(tmp_path)))
+
+    assert session.expressions == ["recorderStats"]
+    with open(tmp_path / PAGE_STATS_FILE, encoding="utf8") as f:
+        assert json.load(f) == stats
+
+
+@pytest.mark.asyncio
+async def test_report_page_stats_adds_up_pages(tmp_path):
+    left_page = {
+        "events": 10,
+        "handlerTime": 2.0,
+        "maxHandlerTime": 1.5,
+        "selectorCacheHits": 90,
+        "selectorCacheMisses": 10,
+        "selectorInvalidations": 1,
+        "observerTime": 0.5,
+        "batches": 2,
+        "sendTime": 0.25,
+    }
+    current_page = dict(left_page, events=5, maxHandlerTime=0.5, selectorCacheHits=20, batches=1)
+    session = EvaluateSessionMock(current_page)
+    runtime = RuntimeContext(session, "", cdp.runtime.ExecutionContextId(1))
+    # Sent by the page at pagehide
+    await runtime.on_event_send(json.dumps([{"event": "stats", "stats": left_page}]))
+    assert runtime.pop_actions() == []
+
+    await _report_page_stats(runtime, get_backend("asyncio"), MagicMock(directory=str(tmp_path)))
+
+    with open(tmp_path / PAGE_STATS_FILE, encoding="utf8") as f:
+        assert json.load(f) == {
+            "events": 15,
+            "handlerTime": 4.0,
+            "maxHandlerTime": 1.5,
+            "selectorCacheHits": 110,
+            "selectorCacheMisses": 20,
+            "selectorInvalidations": 2,
+            "observerTime": 1.0,
+            "batches": 3,
+            "sendTime": 0.5,
+        }
+
+
+class RepliesLaterSessionMock:
+    """CDP session whose replies arrive only when the test sends them."""
+    def __init__(self):
+        self.sent = []
+
+    async def execute(self, method_generator):
+        method = next(method_generator)
+        reply = defer.Deferred()
+        self.sent.append((method["method"], reply))
+        return await reply
+
+
+def test_execute_pipelined():
+    session = RepliesLaterSessionMock()
+    commands = [cdp.page.enable(), cdp.runtime.disable(), cdp.runtime.enable()]
+    d = defer.ensureDeferred(execute_pipelined(session, commands, get_backend("twisted")))
+
+    # All the commands are sent before any reply, in order
+    assert [method for method, _ in session.sent] == ["Page.enable", "Runtime.disable", "Runtime.enable"]
+    for index, (_, reply) in reversed(list(enumerate(session.sent))):
+        reply.callback(index)
+    assert d.result == [0, 1, 2]
+
+    session = RepliesLaterSessionMock()
+    d = defer.ensureDeferred(execute_pipelined(session, [cdp.page.enable(), cdp.network.enable()]))
+    session.sent[0][1].errback(ValueError("failed"))
+    assert not d.called
+    session.sent[1][1].callback(None)
+    failures = []
+    d.addErrback(failures.append)
+    assert failures[0].check(ValueError)
@@ -0,0 +1,138 @@
+import threading
+import time
+import pytest
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from cdprecorder.action import RequestAction, ResponseAction
+from cdprecorder.datasource import HeaderSource, JSONContainer, JSONFieldTarget, SubstrSource
+from cdprecorder.datatarget import BodyTarget, HeaderTarget
+from cdprecorder.http_types import Cookie
+from cdprecorder.json_analyser import JSONSchema
+from cdprecorder.replay import ReplayEngine
+
+
+class RecordingHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    received = []
+
+    def do_GET(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.received.append((self.client_address, self.command, self.path, self.headers.get("Cookie"), self.rfile.read(length)))
+        body = b"ok"
+        if self.path.startswith("/slow"):
+            time.sleep(0.2)
+        self.send_response(200)
+        if self.path == "/login":
+            self.send_header("Set-Cookie", "session=abc; Path=/")
+        if self.path == "/token":
+            self.send_header("X-Token", "token-" + self.path)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RecordingHandler.received = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), RecordingHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_replay_reuses_connection_and_cookies(server):
+    actions = [
+        RequestAction(method="GET", url=server + "/login"),
+        RequestAction(method="GET", url=server + "/home", cookies=[Cookie("lang", "en")]),
+        RequestAction(method="POST", url=server + "/form", body=b"a=1"),
+    ]
+    with ReplayEngine() as replay:
+        responses = [replay.send(action) for action in actions]
+
+    assert [response.status_code for response in responses] == [200, 200, 200]
+    received = RecordingHandler.received
+    # All the requests went over the same connection
+    assert len({client for client, *_ in received}) == 1
+    assert [cookie for *_, cookie, _ in received] == [None, "session=abc; lang=en", "session=abc"]
+    assert received[2][1:3] == ("POST", "/form")
+    assert received[2][4] == b"a=1"
+
+    assert [timing.status for timing in replay.timings] == [200, 200, 200]
+    assert all(timing.elapsed > 0 for timing in replay.timings)
+    assert replay.report().splitlines()[-1].startswith("3 requests in ")
+
+
+def test_replay_prepares_request_once(server):
+    action = RequestAction(method="GET", url=server + "/page", headers={"x-test": "1"})
+    replay = ReplayEngine(max_templates=2)
+
+    first, second = replay.prepare(action), replay.prepare(action)
+    assert first is not second
+    assert len(replay._templates) == 1
+
+    action.headers["x-test"] = "2"
+    assert replay.prepare(action).headers["x-test"] == "2"
+    replay.prepare(RequestAction(method="GET", url=server + "/other"))
+    assert len(replay._templates) == 2
+
+
+def request(server, path, *targets, set_cookie=False):
+    action = RequestAction(method="GET", url=server + path, has_response=True)
+    action.targets = list(targets)
+    headers = {"set-cookie": "a=1"} if set_cookie else {}
+    return [action, ResponseAction(headers=headers, status=200)]
+
+
+def test_replay_dependencies(server):
+    token = HeaderSource(1, "x-token")
+    actions = (
+        request(server, "/token")
+        + request(server, "/slow1")
+        + request(server, "/use", HeaderTarget(SubstrSource(token, 0, 5), "x-used", ""))
+        + request(server, "/login", set_cookie=True)
+        + request(server, "/slow2", BodyTarget(JSONContainer(JSONSchema('{"a": "b"}'), [JSONFieldTarget(token, ["a"])])))
+        + request(server, "/slow3")
+    )
+
+    replay = ReplayEngine()
+    assert replay.dependencies(actions) == {0: set(), 2: set(), 4: {0}, 6: set(), 8: {0, 6}, 10: {6}}
+    assert replay.dependencies(actions, barriers=[4], wait_for_cookies=False) == {
+        0: set(),
+        2: set(),
+        4: {0, 2},
+        6: {4},
+        8: {0, 4},
+        10: {4},
+    }
+
+
+def test_replay_run_concurrently(server):
+    token = HeaderSource(1, "x-token")
+    actions = (
+        request(server, "/token")
+        + request(server, "/slow1")
+        + request(server, "/slow2")
+        + request(server, "/slow3", HeaderTarget(token, "x-used", ""))
+    )
+
+    with ReplayEngine() as replay:
+        result = replay.run(actions, workers=4)
+
+    assert sorted(result.timings) == [0, 2, 4, 6]
+    assert [action.status for action in result.actions[1::2]] == [200, 200, 200, 200]
+    # The target read the token of the replayed response
+    assert result.actions[6].headers["x-used"] == "token-/token"
+    assert "x-used" not in actions[6].headers
+    # The slow requests were sent at the same time
+    assert result.wall_time < result.sequential_time
+    assert result.critical_path() in ([0, 6], [2], [4])
+    assert result.critical_path_time <= result.wall_time
+    assert "critical path" in result.summary()
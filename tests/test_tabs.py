@@ -0,0 +1,84 @@
+from pycdp import cdp
+from twisted.internet import defer, task
+
+from cdprecorder.tabs import TabVisibilityCache, obtain_active_tab
+
+
+class TabSessionMock:
+    def __init__(self, target_id, hidden):
+        self.session_id = f"session-{target_id}"
+        self.hidden = hidden
+
+    async def execute(self, method_generator):
+        if self.hidden is None:
+            # A frozen tab never answers
+            await defer.Deferred()
+        return cdp.runtime.RemoteObject(type_="boolean", value=self.hidden), None
+
+
+class ConnectionMock:
+    """Opens a session on each tab. `tabs` maps the target ids to their
+    `document.hidden`, or to None for tabs that don't answer."""
+    def __init__(self, tabs):
+        self.tabs = tabs
+        self.connected = []
+        self.removed = []
+
+    async def connect_session(self, target_id):
+        self.connected.append(target_id)
+        return TabSessionMock(target_id, self.tabs[target_id])
+
+    async def execute(self, method_generator):
+        return None
+
+    def remove_session(self, session_id):
+        self.removed.append(session_id)
+
+
+def make_targets(conn):
+    return [
+        cdp.target.TargetInfo(
+            target_id=cdp.target.TargetID(target_id),
+            type_="page",
+            title=target_id,
+            url=f"https://example.com/{target_id}",
+            attached=False,
+            can_access_opener=False,
+        )
+        for target_id in conn.tabs
+    ]
+
+
+def find_active_tab(conn, cache, clock):
+    result = defer.ensureDeferred(obtain_active_tab(make_targets(conn), conn, timeout=2, cache=cache, clock=clock))
+    clock.advance(2)
+    clock.advance(2)
+    return result.result
+
+
+def test_obtain_active_tab(tmp_path):
+    conn = ConnectionMock({"a": True, "b": False, "frozen": None, "c": True})
+    clock = task.Clock()
+
+    active = find_active_tab(conn, TabVisibilityCache(str(tmp_path)), clock)
+
+    assert active.target_id == "b"
+    # The tabs are probed at once, and every session is removed, even the frozen one
+    assert sorted(conn.connected) == ["a", "b", "c", "frozen"]
+    assert sorted(conn.removed) == [f"session-{target_id}" for target_id in ["a", "b", "c", "frozen"]]
+
+
+def test_obtain_active_tab_from_cache(tmp_path):
+    cache = TabVisibilityCache(str(tmp_path))
+    clock = task.Clock()
+    find_active_tab(ConnectionMock({"a": True, "b": False, "c": True}), cache, clock)
+
+    # The tab that was visible is still visible, so the others are not probed
+    conn = ConnectionMock({"a": True, "b": False, "c": True})
+    assert find_active_tab(conn, cache, clock).target_id == "b"
+    assert conn.connected == ["b"]
+
+    # The user switched tabs
+    conn = ConnectionMock({"a": False, "b": True, "c": True})
+    assert find_active_tab(conn, cache, clock).target_id == "a"
+    assert sorted(conn.connected) == ["a", "b", "c"]
@@ -0,0 +1,70 @@
+import json
+import pytest
+
+from unittest.mock import patch
+
+from .mocks import UrlfilterMock, EventMock
+from cdprecorder.recorder import HttpCommunication, collect_communications, set_runtime_context
+from cdprecorder.targets import TargetEvent
+
+
+class WorkerSessionMock:
+    """The session of a worker target. It answers like the page's session,
+    and remembers the requests whose bodies were fetched through it."""
+    def __init__(self, page_session):
+        self.page_session = page_session
+        self.fetched_request_ids = set()
+
+    async def execute(self, method_generator):
+        for method in method_generator:
+            if method["method"] == "Network.getResponseBody":
+                self.fetched_request_ids.add(method["params"]["requestId"])
+                return self.page_session.get_response_body(method["params"])
+
+
+class TargetEventMock(EventMock):
+    """Yields the events as if they came from a TargetAttacher. Half of the
+    requests come from a worker target."""
+    def __init__(self, events):
+        super().__init__(events)
+        self.worker_session = WorkerSessionMock(self)
+
+    @staticmethod
+    def is_worker_request(request_id):
+        return sum(map(ord, request_id)) % 2 == 1
+
+    async def __anext__(self):
+        event = await super().__anext__()
+        request_id = getattr(event, "request_id", None)
+        if request_id is not None and self.is_worker_request(request_id):
+            return TargetEvent("worker", self.worker_session, event)
+        return TargetEvent("page", self, event)
+
+
+@pytest.mark.parametrize("events_file", ["tests/events_youtube.json"])
+@patch("cdprecorder.recorder.RuntimeContext")
+@pytest.mark.asyncio
+async def test_collect_communications_from_several_targets(RuntimeContext, events_file):
+    with open(events_file, encoding="utf8") as f:
+        events = json.load(f)
+
+    set_runtime_context(RuntimeContext())
+    event_mock = EventMock(list(events))
+    expected = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10)
+
+    event_mock = TargetEventMock(list(events))
+    communications = await collect_communications(event_mock, event_mock, UrlfilterMock(), timeout=10)
+    set_runtime_context(None)
+
+    assert len(communications) == len(expected)
+    targets = set()
+    for comm, expected_comm in zip(communications, expected):
+        if isinstance(comm, HttpCommunication):
+            is_worker = TargetEventMock.is_worker_request(comm.request_id)
+            assert comm.target_id == ("worker" if is_worker else "page")
+            if any(body is not None for body in comm.response_bodies):
+                assert (comm.request_id in event_mock.worker_session.fetched_request_ids) == is_worker
+            targets.add(comm.target_id)
+            comm.target_id = None
+        assert comm == expected_comm
+    assert targets == {"page", "worker"}
@@ -0,0 +1,66 @@
+import pytest
+
+from adblockparser import AdblockRules
+
+from cdprecorder.url_matcher import AhoCorasick, URLMatcher
+
+RULES = [
+    "||ads.example.com^",
+    "||tracker.net/pixel",
+    "||cdn.example.org^*/banner",
+    "||metrics.io:8080/",
+    "/adserver/",
+    "-advert-",
+    "*/sponsored*",
+    "/track*.gif",
+    "|https://popup.",
+    "swf|",
+    "/ad[0-9]+x[0-9]+/",
+    "@@||ads.example.com/allowed/",
+    "@@/adserver/ok",
+    "||thirdparty.com^$third-party",
+]
+
+URLS = [
+    "https://ads.example.com/x.js",
+    "https://sub.ads.example.com:443/x",
+    "https://ads.example.com.evil.net/",
+    "https://notads.example.com/",
+    "https://ads.example.com/allowed/ok.js",
+    "http://tracker.net/pixel?x=1",
+    "http://tracker.net/other",
+    "https://cdn.example.org/img/banner.png",
+    "https://metrics.io:8080/collect",
+    "https://metrics.io/collect",
+    "https://site.com/adserver/get",
+    "https://site.com/adserver/ok",
+    "https://site.com/img-ADVERT-1.png",
+    "https://site.com/x/SPONSORED/y",
+    "https://site.com/tracking/pixel.gif",
+    "https://popup.site.com/",
+    "https://site.com/?u=https://popup.x",
+    "https://site.com/movie.swf",
+    "https://site.com/movie.swf?x",
+    "https://site.com/ad300x250/",
+    "https://thirdparty.com/",
+    "//ads.example.com/relative",
+]
+
+
+@pytest.mark.parametrize("url", URLS)
+def test_url_matcher_agrees_with_adblockparser(url):
+    rules = AdblockRules(RULES)
+    matcher = URLMatcher(rules.rules)
+
+    assert matcher.should_block(url) == rules.should_block(url)
+    # Memoized decision
+    assert matcher.should_block(url) == rules.should_block(url)
+    assert matcher.hits == 1
+
+
+def test_aho_corasick_finds_overlapping_patterns():
+    automaton = AhoCorasick([("he", 0), ("she", 1), ("hers", 2), ("is", 3)])
+
+    assert set(automaton.iter_values("ushers")) == {0, 1, 2}
+    assert set(automaton.iter_values("this")) == {3}
+    assert list(automaton.iter_values("nothing")) == []